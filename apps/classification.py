@@ -1,7 +1,7 @@
 import io
 import os
 import base64
-import pickle
+import logging
 import datetime
 from PIL import Image
 
@@ -13,9 +13,12 @@ import dash_bootstrap_components as dbc
 import dash_table
 from dash.dependencies import Input, Output, State
 
-from server import app, shell_family, config
-from sql_app.crud import create_image, create_shell_images
+from server import app, shell_family, config, inference_queue
+from inference_queue import InferenceQueueFullError
+from src.utils import load_image
+from sql_app.crud import create_image, create_shell_images, get_cached_image_features, create_cached_image_features, content_hash
 from sql_app.database import SessionLocal, engine
+from sql_app.feature_encoding import encode_array, decode_array
 
 
 help_modal = dbc.Modal(
@@ -154,18 +157,28 @@ def generate_uploaded_zip_file_summary(content, name, date):
             file_extension = name.split('.')[1]
             # Split away meta data (i.e. 'data:image/png;base64,...base 64 stuff....')
             decoded_content = base64.b64decode(content.split(',')[1])
-            img_buf = io.BytesIO(decoded_content)
-            # Loading into PIL Image
-            img = Image.open(img_buf).convert("RGB")
-            # Resize by size used for model
-            resized_img = img.resize((config['model']['target_size'], config['model']['target_size']))
-            img_array = np.array(resized_img)
-            # Expand dims due to keras model including batch dimensions
-            img_array = np.expand_dims(resized_img, 0)
-            # Preprocess with keras' preprocess_input based on the respective model architecture
-            preprocessed_img_array = shell_family.preprocessor_preprocess_function(img_array)
-            # Generate features
-            sample_features = shell_family.preprocessor.predict(preprocessed_img_array)
+            # Reuse the features of byte identical images already extracted by the same backbone
+            db = SessionLocal()
+            try:
+                image_content_hash = content_hash(decoded_content)
+                cached_image_features = get_cached_image_features(db, [image_content_hash], shell_family.feature_extractor_model, config['model']['target_size'], shell_family.preprocessing_version)
+                if image_content_hash in cached_image_features:
+                    sample_features = np.expand_dims(decode_array(cached_image_features[image_content_hash]), 0)
+                else:
+                    # Decode, at a reduced size if reduced_decode is on, and resize by size used for model
+                    img_array = load_image(io.BytesIO(decoded_content), (config['model']['target_size'], config['model']['target_size']), config['model']['reduced_decode'])
+                    # Expand dims due to keras model including batch dimensions
+                    img_array = np.expand_dims(img_array, 0)
+                    # Generate features with the compiled inference path, whose model applies the backbone's preprocess_input,
+                    # batched with any concurrent classification requests
+                    sample_features = inference_queue.extract_features(img_array)
+                    # Percentiles are computed over a window of recent requests, only when they are logged
+                    if app.logger.isEnabledFor(logging.DEBUG):
+                        app.logger.debug('Feature extraction latency over recent requests: {}'.format(
+                            ', '.join('{}={:.1f}ms'.format(percentile, latency) for percentile, latency in shell_family.feature_extractor.latency_percentiles().items())))
+                    create_cached_image_features(db, [image_content_hash], shell_family.feature_extractor_model, config['model']['target_size'], shell_family.preprocessing_version, [encode_array(sample_features[0])])
+            finally:
+                db.close()
             # Perform classification
             class_index, class_name, score, full_results = shell_family.score(sample_features, 0.5, with_update=False, return_full_results=True)
             # Sort results
@@ -181,15 +194,23 @@ def generate_uploaded_zip_file_summary(content, name, date):
                 output_results.append({'class-name-column': class_name, 'distance-column': abs(distance)})
             # Copy image to best match folder
             save_path = os.path.join(config['dash_environment']['save_image_directory'], sorted_class_names[0], name)
-            img.save(save_path)
+            # Write the uploaded bytes as they are instead of decoding and re-encoding the image
+            with open(save_path, 'wb') as image_file:
+                image_file.write(decoded_content)
             ### TODO: Add thresholding and model updates here ###
             db = SessionLocal()
-            create_image_result = create_image(db, sorted_class_names[0], save_path)
-            create_shell_images_result = create_shell_images(db, shell_family.shell_family_id, sorted_class_names[0], save_path, pickle.dumps(sample_features[0]), datetime.datetime.utcnow())
-            db.close()
+            try:
+                create_image_result = create_image(db, sorted_class_names[0], save_path)
+                create_shell_images_result = create_shell_images(db, shell_family.shell_family_id, sorted_class_names[0], save_path, encode_array(sample_features[0]), datetime.datetime.utcnow(), shell_family.preprocessing_version)
+            finally:
+                db.close()
             app.logger.info('Successfully perform classification!')
             closest_match_name = "Closest Match: {}".format(sorted_class_names[0])
             return content, closest_match_name, output_results, False
+        except InferenceQueueFullError as e:
+            app.logger.info(e)
+            app.logger.info('Classification request shed as the server is overloaded!')
+            return None, None, None, True
         except Exception as e:
             app.logger.info(e)
             app.logger.info('Error in performing classification!')
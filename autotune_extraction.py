@@ -0,0 +1,44 @@
+import os
+import sys
+# Mute tensorflow logs except for errors as it is flooding the cli
+os.environ['TF_CPP_MIN_LOG_LEVEL'] = '2'
+
+import yaml
+
+# src modules import their siblings by bare name, so import them the same way to load each module once
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'src'))
+from batch_sizing import autotune_extraction_profile
+from sql_app.database import SessionLocal
+from sql_app.crud import get_all_images
+
+
+def main():
+    """Autotune the feature extraction batch size and TensorFlow thread counts for the feature extractor, target_size
+        and memory budget in config.yaml and save the profile to autotune_profile_filepath, which the task-app loads
+        on its next start. Every measurement runs in a spawned process, so this is its own entry point rather than
+        part of the task-app's startup.
+    """
+    with open('config.yaml') as f:
+        config = yaml.load(f, Loader=yaml.FullLoader)
+    # Quantized feature extractors are converted on stored images the first time they are measured
+    db = SessionLocal()
+    try:
+        calibration_image_paths = [image_details.image_path for image_details in get_all_images(db, limit=config['model']['num_calibration_images'])]
+    finally:
+        db.close()
+    profile = autotune_extraction_profile(config['model']['feature_extractor_model'],
+                                          config['model']['target_size'],
+                                          config['model']['extraction_memory_budget_mb'],
+                                          config['model']['autotune_profile_filepath'],
+                                          calibration_image_paths=calibration_image_paths,
+                                          quantized_model_directory=config['model']['quantized_model_directory'])
+    print('Saved extraction profile to {}: inference_batch_size={}, intra_op_parallelism_threads={}, inter_op_parallelism_threads={}, {:.1f} images per second'.format(
+        config['model']['autotune_profile_filepath'],
+        profile['inference_batch_size'],
+        profile['intra_op_parallelism_threads'],
+        profile['inter_op_parallelism_threads'],
+        profile['images_per_second']))
+
+
+if __name__ == "__main__":
+    main()
@@ -1,4 +1,3 @@
-import pickle
 import requests
 import time
 from collections import OrderedDict
@@ -21,6 +20,7 @@ from server import app, config, shell_family, VALID_USERNAME_PASSWORD_PAIRS
 from apps import home, classification, add_class, remove_class, error, admin
 from sql_app.database import SessionLocal, engine
 from sql_app.crud import get_shell_family_by_shell_family_id, create_shell_family, get_all_shells_by_shell_family_id
+from sql_app.feature_encoding import decode_array, decode_feature_matrix
 
 def load_auth_layout(pathname):
     if pathname == "/remove-class":
@@ -139,16 +139,16 @@ def generate_model_statistics_table():
 
 def generate_shell_mean_plot():
     db = SessionLocal()
-    shell_mean = []
     shell_classes = []
     tab_content = None
     try:
         shells_results = get_all_shells_by_shell_family_id(db, config['model']['shell_family_id'])
+        # Decode every shell mean straight into one C x D matrix
+        shell_mean = decode_feature_matrix([shell.shell_mean for shell in shells_results])
         for shell in shells_results:
-            shell_mean.append(pickle.loads(shell.shell_mean)[0])
             shell_classes.append(shell.shell_id)
         pca = PCA(n_components=2)
-        pca_shell_mean = pca.fit_transform(np.array(shell_mean))
+        pca_shell_mean = pca.fit_transform(shell_mean)
         pca_df = pd.DataFrame(
             {
                 "PC1": pca_shell_mean[:, 0],
@@ -408,10 +408,10 @@ def update_shell_family(n_interval):
             # As a result, the state preservation is not done proper and hence needs a custom timer
             FINAL_STATE_DICT['start_timer'] = time.time()
             shell_family.feature_extractor_model = get_shell_family_result.feature_extractor_model
-            shell_family.create_preprocessor(shell_family.feature_extractor_model)
+            shell_family.create_preprocessor(shell_family.feature_extractor_model, config['model']['target_size'])
             shell_family.instances = get_shell_family_result.instances
             shell_family.mapping = get_shell_family_result.mapping
-            shell_family.global_mean = (get_shell_family_result.global_mean if get_shell_family_result.global_mean is None else pickle.loads(get_shell_family_result.global_mean))
+            shell_family.global_mean = decode_array(get_shell_family_result.global_mean)
             shell_family.updated_at = get_shell_family_result.updated_at
             # Extract shells from database baased on shell_family_id
             get_shell_family_shells_database_results = get_all_shells_by_shell_family_id(db, shell_family.shell_family_id)
@@ -422,7 +422,7 @@ def update_shell_family(n_interval):
                 for shell_details in get_shell_family_shells_database_results:
                     shell_family.classifiers[shell_details.shell_id] = shell_v2.ShellModel()
                     shell_family.classifiers[shell_details.shell_id].shell_id = shell_details.shell_id
-                    shell_family.classifiers[shell_details.shell_id].shell_mean = (shell_details.shell_mean if shell_details.shell_mean is None else pickle.loads(shell_details.shell_mean))
+                    shell_family.classifiers[shell_details.shell_id].shell_mean = decode_array(shell_details.shell_mean)
                     shell_family.classifiers[shell_details.shell_id].num_instances = shell_details.num_instances
                     shell_family.classifiers[shell_details.shell_id].noise_mean = shell_details.noise_mean
                     shell_family.classifiers[shell_details.shell_id].noise_std = shell_details.noise_std
@@ -1,6 +1,6 @@
 import logging
-import pickle
 import os
+import sys
 # Mute tensorflow logs except for errors as it is flooding the cli
 os.environ['TF_CPP_MIN_LOG_LEVEL'] = '2'
 
@@ -8,10 +8,15 @@ import yaml
 import dash
 import dash_bootstrap_components as dbc
 
+# src modules import their siblings by bare name, so import them the same way to load each module once
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'src'))
 from src import shell_v2
+from inference_queue import InferenceQueue
 from sql_app import crud, models, schemas
 from sql_app.database import SessionLocal, engine
-from sql_app.crud import get_shell_family_by_shell_family_id, create_shell_family, get_all_shells_by_shell_family_id 
+from sql_app.migrations import upgrade_database
+from sql_app.feature_encoding import decode_array
+from sql_app.crud import get_shell_family_by_shell_family_id, create_shell_family, get_all_shells_by_shell_family_id, get_all_images
 
 ######################################
 # Added Auth For Specific Users Only #
@@ -20,6 +25,7 @@ VALID_USERNAME_PASSWORD_PAIRS = {"mitb-il-admin": "mitb-il-2021"}
 
 # Connect to database
 models.Base.metadata.create_all(bind=engine)
+upgrade_database(engine)
 
 app = dash.Dash(
     __name__,
@@ -75,10 +81,14 @@ else:
     app.logger.info('Loading model with shell_family_id: {}'.format(config['model']['shell_family_id']))
 shell_family.shell_family_id = get_shell_family_result.shell_family_id
 shell_family.feature_extractor_model = get_shell_family_result.feature_extractor_model
-shell_family.create_preprocessor(shell_family.feature_extractor_model)
+shell_family.quantized_model_directory = config['model']['quantized_model_directory']
+shell_family.calibration_image_paths = [image_details.image_path for image_details in get_all_images(db, limit=config['model']['num_calibration_images'])]
+shell_family.create_preprocessor(shell_family.feature_extractor_model, config['model']['target_size'])
+if getattr(shell_family.preprocessor, 'drift_report', None) is not None:
+    app.logger.info('Feature drift of {} against its float model: {}'.format(shell_family.feature_extractor_model, shell_family.preprocessor.drift_report))
 shell_family.instances = get_shell_family_result.instances
 shell_family.mapping = get_shell_family_result.mapping
-shell_family.global_mean = (get_shell_family_result.global_mean if get_shell_family_result.global_mean is None else pickle.loads(get_shell_family_result.global_mean))
+shell_family.global_mean = decode_array(get_shell_family_result.global_mean)
 shell_family.updated_at = get_shell_family_result.updated_at
 # Extract shells from database baased on shell_family_id
 get_shell_family_shells_database_results = get_all_shells_by_shell_family_id(db, config['model']['shell_family_id'])
@@ -87,13 +97,18 @@ if get_shell_family_shells_database_results:
     for shell_details in get_shell_family_shells_database_results:
         shell_family.classifiers[shell_details.shell_id] = shell_v2.ShellModel()
         shell_family.classifiers[shell_details.shell_id].shell_id = shell_details.shell_id
-        shell_family.classifiers[shell_details.shell_id].shell_mean = (shell_details.shell_mean if shell_details.shell_mean is None else pickle.loads(shell_details.shell_mean))
+        shell_family.classifiers[shell_details.shell_id].shell_mean = decode_array(shell_details.shell_mean)
         shell_family.classifiers[shell_details.shell_id].num_instances = shell_details.num_instances
         shell_family.classifiers[shell_details.shell_id].noise_mean = shell_details.noise_mean
         shell_family.classifiers[shell_details.shell_id].noise_std = shell_details.noise_std
         shell_family.classifiers[shell_details.shell_id].created_at = shell_details.created_at
         shell_family.classifiers[shell_details.shell_id].updated_at = shell_details.updated_at
 app.logger.info('Model Loaded!')
+### Batch concurrent feature extraction requests ###
+inference_queue = InferenceQueue(shell_family.extract_features,
+                                 max_batch_size=config['dash_environment']['inference_max_batch_size'],
+                                 max_wait_ms=config['dash_environment']['inference_max_wait_ms'],
+                                 max_queue_depth=config['dash_environment']['inference_max_queue_depth']).start()
 # Close database
 db.close()
 
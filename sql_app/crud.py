@@ -1,14 +1,16 @@
 from PIL import Image
-import pickle
+import hashlib
 import os
 import sys
 sys.path.append(os.getcwd())
 
 import numpy as np
-from sqlalchemy import and_, or_, not_, desc
+from sqlalchemy import and_, or_, not_, desc, func
 from sqlalchemy.orm import Session
+from sqlalchemy.dialects.postgresql import insert
 from . import models, schemas
-from src.utils import ImageGeneratorV2
+from .feature_encoding import encode_array
+from src.utils import ImageGeneratorV2, load_image
 
 #####################
 # Shell Family CRUD #
@@ -44,6 +46,16 @@ def update_shell_family(db: Session, shell_family_id: str, feature_extractor_mod
     db.refresh(db_shell_family_to_update)
     return db_shell_family_to_update
 
+def update_shell_family_watermark(db: Session, shell_family_id: str, last_shell_image_id: int, last_assigned_at, shell_images_count: int):
+    db.query(models.ShellFamily).filter(models.ShellFamily.shell_family_id == shell_family_id).update(
+        {
+            models.ShellFamily.last_shell_image_id: last_shell_image_id,
+            models.ShellFamily.last_assigned_at: last_assigned_at,
+            models.ShellFamily.shell_images_count: shell_images_count
+        }, synchronize_session=False)
+    db.commit()
+    return True
+
 def delete_shell_family(db: Session, shell_family_id: str):
     db.query(models.ShellFamily).filter(models.ShellFamily.shell_family_id == shell_family_id).delete()
     db.commit()
@@ -88,6 +100,40 @@ def update_shell_for_shell_family(db: Session, shell_family_id: str, shell_id: s
     db.refresh(db_shell_to_update)
     return db_shell_to_update
 
+def update_shell_feature_sums_for_shell_family(db: Session, shell_family_id: str, shell_feature_sums: dict):
+    """Set the feature sum and count of several shells of a family in one commit.
+    Args:
+        shell_feature_sums (dict): Shell id to a (feature_sum, feature_count) tuple, feature_sum being None for an empty shell
+    """
+    for shell_id, (feature_sum, feature_count) in shell_feature_sums.items():
+        db.query(models.Shell).filter(and_(models.Shell.shell_family_id == shell_family_id, models.Shell.shell_id == shell_id)).update(
+            {
+                models.Shell.feature_sum: (feature_sum if feature_sum is None else feature_sum_to_bytes(feature_sum)),
+                models.Shell.feature_count: feature_count
+            }, synchronize_session=False)
+    db.commit()
+    return True
+
+def get_shell_family_feature_sum_by_shell_family_id(db: Session, shell_family_id: str):
+    """Sum the per shell feature sums and counts of a family, so its global mean costs O(C x D).
+    Returns:
+        feature_sum (np.ndarray): float64 array of shape (1, D), None if no shell has features
+        feature_count (int): Number of features summed
+    """
+    shell_feature_sums = db.query(models.Shell.feature_sum, models.Shell.feature_count).filter(
+        and_(
+            models.Shell.shell_family_id == shell_family_id,
+            models.Shell.feature_count > 0
+            )
+        ).all()
+    feature_sum = None
+    feature_count = 0
+    for shell_feature_sum, shell_feature_count in shell_feature_sums:
+        shell_feature_sum = feature_sum_from_bytes(shell_feature_sum)
+        feature_sum = shell_feature_sum if feature_sum is None else feature_sum + shell_feature_sum
+        feature_count += shell_feature_count
+    return feature_sum, feature_count
+
 def bulk_create_shells_for_shell_family(db: Session, shell_family_id: str, shell_id_list: list, shell_mean_list:float, num_instances_list: int, noise_mean_list: float, noise_std_list: float):
     db.bulk_insert_mappings(
         models.Shell,
@@ -117,13 +163,55 @@ def delete_shell_for_shell_family(db: Session, shell_family_id: str, shell_id: s
 def get_shell_images(db: Session, id: int):
     return db.query(models.ShellImages).filter(models.ShellImages.id == id).first()
 
-def get_all_shell_images_by_shell_family_id_and_shell_id(db: Session, shell_family_id: str, shell_id: str):
-    return db.query(models.ShellImages).filter(
+def get_all_shell_images_by_shell_family_id_and_shell_id(db: Session, shell_family_id: str, shell_id: str, max_shell_image_id: int = None):
+    query = db.query(models.ShellImages).filter(
         and_(
             models.ShellImages.shell_family_id == shell_family_id,
             models.ShellImages.shell_id == shell_id
             )
-        ).all()
+        )
+    if max_shell_image_id is not None:
+        query = query.filter(models.ShellImages.id <= max_shell_image_id)
+    return query.all()
+
+def get_shell_image_features_page(db: Session, shell_family_id: str, shell_id: str, after_shell_image_id: int, max_shell_image_id: int, limit: int):
+    """Id and image_features of the next page of shell images of a shell, in id order after after_shell_image_id
+        and up to max_shell_image_id.
+    """
+    return db.query(models.ShellImages.id, models.ShellImages.image_features).filter(
+        and_(
+            models.ShellImages.shell_family_id == shell_family_id,
+            models.ShellImages.shell_id == shell_id,
+            models.ShellImages.id > after_shell_image_id,
+            models.ShellImages.id <= max_shell_image_id
+            )
+        ).order_by(models.ShellImages.id).limit(limit).all()
+
+def get_shell_images_watermark_by_shell_family_id(db: Session, shell_family_id: str):
+    """Largest id, latest assigned_at and number of the shell_images of a family, in one aggregate query.
+    """
+    return tuple(db.query(
+        func.max(models.ShellImages.id),
+        func.max(models.ShellImages.assigned_at),
+        func.count(models.ShellImages.id)
+        ).filter(models.ShellImages.shell_family_id == shell_family_id).one())
+
+def get_shell_images_summary_by_shell_family_id(db: Session, shell_family_id: str, max_shell_image_id: int = None):
+    """Summarize the shell_images of every shell of a family in one grouped query.
+    Returns:
+        shell_images_summary (dict): Shell id to a row with pending_count (images with no image features),
+            latest_assigned_at, image_count and max_shell_image_id
+    """
+    query = db.query(
+        models.ShellImages.shell_id,
+        func.count(models.ShellImages.id).filter(models.ShellImages.image_features.is_(None)).label('pending_count'),
+        func.max(models.ShellImages.assigned_at).label('latest_assigned_at'),
+        func.count(models.ShellImages.id).label('image_count'),
+        func.max(models.ShellImages.id).label('max_shell_image_id')
+        ).filter(models.ShellImages.shell_family_id == shell_family_id)
+    if max_shell_image_id is not None:
+        query = query.filter(models.ShellImages.id <= max_shell_image_id)
+    return {shell_images_summary.shell_id: shell_images_summary for shell_images_summary in query.group_by(models.ShellImages.shell_id).all()}
 
 def get_latest_shell_image_by_shell_family_id(db: Session, shell_family_id: str):
     return db.query(models.ShellImages).filter(
@@ -148,11 +236,12 @@ def get_all_shell_images_by_shell_family_id_and_shell_id_with_no_image_features(
             )
         ).all()
 
+
 def get_all_shell_images(db: Session, skip: int = 0, limit: int = 100):
     return db.query(models.ShellImages).offset(skip).limit(limit).all()
     
-def create_shell_images(db: Session, shell_family_id: str, shell_id: str, image_path: str, image_features: bytes, assigned_at):
-    db_shell_images = models.ShellImages(shell_family_id=shell_family_id, shell_id=shell_id, image_path=image_path, image_features=image_features, assigned_at=assigned_at)
+def create_shell_images(db: Session, shell_family_id: str, shell_id: str, image_path: str, image_features: bytes, assigned_at, preprocessing_version: int = None):
+    db_shell_images = models.ShellImages(shell_family_id=shell_family_id, shell_id=shell_id, image_path=image_path, image_features=image_features, preprocessing_version=preprocessing_version, assigned_at=assigned_at)
     db.add(db_shell_images)
     db.commit()
     db.refresh(db_shell_images)
@@ -174,35 +263,71 @@ def bulk_create_shell_images_for_one_shell_family(db: Session, shell_family_id:
     return True
 
 
-def update_all_shell_images_by_shell_family_id_and_shell_id_with_no_image_features(db: Session, shell_family_id: str, shell_id: str, shell_family, batch_size: int, target_size: int, update_datetime):
-    shell_images_to_update = db.query(models.ShellImages).filter(
+def get_shell_images_with_no_image_features_page(db: Session, shell_family_id: str, shell_id: str, after_shell_image_id: int, limit: int):
+    """Id and image_path of the next page of shell images with no image features, in id order after after_shell_image_id.
+    """
+    return db.query(models.ShellImages.id, models.ShellImages.image_path).filter(
         and_(
             models.ShellImages.shell_family_id == shell_family_id,
             models.ShellImages.shell_id == shell_id,
-            models.ShellImages.image_features.is_(None)
-        )).all()
-    all_shell_image_paths = [shell_image.image_path for shell_image in shell_images_to_update]
-    all_images_features = np.array([])
-    image_generator = ImageGeneratorV2(all_shell_image_paths, batch_size, target_size)
-    for (batch_images, batch_filepaths) in image_generator:
-        images_features = shell_family.preprocessor.predict(batch_images)
-        if all_images_features.shape[0] == 0:
-            all_images_features = images_features
-        else:
-            all_images_features = np.concatenate(
-                [
-                    all_images_features,
-                    images_features
-                ],
-                axis=0,
-            )
-    for i in range(len(shell_images_to_update)):
-        shell_image = shell_images_to_update[i]
-        shell_image_feature = all_images_features[i]
-        shell_image.image_features = pickle.dumps(shell_image_feature)
-        shell_image.assigned_at = update_datetime
-    db.commit()
-    return True
+            models.ShellImages.image_features.is_(None),
+            models.ShellImages.id > after_shell_image_id
+        )).order_by(models.ShellImages.id).limit(limit).all()
+
+def update_all_shell_images_by_shell_family_id_and_shell_id_with_no_image_features(db: Session, shell_family_id: str, shell_id: str, shell_family, decode_batch_size: int, inference_batch_size: int, target_size: int, update_datetime, decode_workers: int = 1, prefetch_batches: int = 1, decode_pool: str = 'thread', reduced_decode: bool = False):
+    """Extract and write the features of every shell image with no image features. Images are streamed in keyset
+        paginated pages of prefetch_batches + 1 decode batches, and the features of every decoded batch are written
+        back with one bulk update and commit. Written images are no longer pending, so a failure only loses the
+        batch in progress and a restarted task app resumes with the images left.
+    Returns:
+        num_updated (int): Number of shell images whose features were written
+    """
+    page_size = decode_batch_size * (max(prefetch_batches, 0) + 1)
+    num_updated = 0
+    last_shell_image_id = 0
+    while True:
+        shell_images_page = get_shell_images_with_no_image_features_page(db, shell_family_id, shell_id, last_shell_image_id, page_size)
+        if not shell_images_page:
+            break
+        last_shell_image_id = shell_images_page[-1].id
+        # Only extract features of images whose content was never seen by this backbone
+        pending_shell_images = [(shell_image.id, image_path_to_content_hash(shell_image.image_path)) for shell_image in shell_images_page]
+        cached_image_features = get_cached_image_features(db, [content_hash for _, content_hash in pending_shell_images], shell_family.feature_extractor_model, target_size, shell_family.preprocessing_version)
+        uncached_image_paths = {}
+        for shell_image, (_, content_hash) in zip(shell_images_page, pending_shell_images):
+            if content_hash not in cached_image_features:
+                uncached_image_paths.setdefault(content_hash, shell_image.image_path)
+        uncached_content_hashes = list(uncached_image_paths.keys())
+        image_generator = ImageGeneratorV2([uncached_image_paths[content_hash] for content_hash in uncached_content_hashes],
+                                           decode_batch_size,
+                                           target_size,
+                                           decode_workers,
+                                           prefetch_batches,
+                                           decode_pool,
+                                           reduced_decode)
+        try:
+            num_extracted = 0
+            while True:
+                # Write back every pending image whose features are known
+                resolved_shell_images = [dict(id=shell_image_id, image_features=cached_image_features[content_hash], preprocessing_version=shell_family.preprocessing_version, assigned_at=update_datetime)
+                                         for shell_image_id, content_hash in pending_shell_images if content_hash in cached_image_features]
+                if resolved_shell_images:
+                    db.bulk_update_mappings(models.ShellImages, resolved_shell_images)
+                    db.commit()
+                    num_updated += len(resolved_shell_images)
+                pending_shell_images = [(shell_image_id, content_hash) for shell_image_id, content_hash in pending_shell_images if content_hash not in cached_image_features]
+                if not pending_shell_images:
+                    break
+                batch_images, batch_filepaths = next(image_generator)
+                batch_content_hashes = uncached_content_hashes[num_extracted : num_extracted + batch_images.shape[0]]
+                num_extracted += batch_images.shape[0]
+                extracted_image_features = [encode_array(image_features) for image_features in shell_family.preprocessor.predict(batch_images, batch_size=inference_batch_size)]
+                create_cached_image_features(db, batch_content_hashes, shell_family.feature_extractor_model, target_size, shell_family.preprocessing_version, extracted_image_features)
+                cached_image_features.update(zip(batch_content_hashes, extracted_image_features))
+        finally:
+            # Stop the decode workers even if extraction or a write fails
+            image_generator.close()
+    return num_updated
 
 
 def delete_shell_image(db: Session, shell_family_id: str, shell_id: str, image_path: str):
@@ -264,15 +389,70 @@ def delete_image(db: Session, image_path: str):
     return True
 
 
+############################
+# Image Feature Cache CRUD #
+############################
+def get_cached_image_features(db: Session, content_hashes: list, feature_extractor_model: str, target_size: int, preprocessing_version: int):
+    """Get the cached features of images extracted by a backbone with the given preprocessing version.
+    Returns:
+        cached_image_features (dict): Content hash to encoded image features for every cached content hash
+    """
+    if not content_hashes:
+        return {}
+    cached_results = db.query(models.ImageFeatureCache.content_hash, models.ImageFeatureCache.image_features).filter(
+        and_(
+            models.ImageFeatureCache.content_hash.in_(set(content_hashes)),
+            models.ImageFeatureCache.feature_extractor_model == feature_extractor_model,
+            models.ImageFeatureCache.target_size == target_size,
+            models.ImageFeatureCache.preprocessing_version == preprocessing_version
+        )
+    ).all()
+    return {content_hash: image_features for content_hash, image_features in cached_results}
+
+def create_cached_image_features(db: Session, content_hashes: list, feature_extractor_model: str, target_size: int, preprocessing_version: int, image_features_list: list):
+    # Images cached concurrently by another process are left as they are
+    db.execute(
+        insert(models.ImageFeatureCache).values(
+            [
+                dict(content_hash=content_hashes[i],
+                     feature_extractor_model=feature_extractor_model,
+                     target_size=target_size,
+                     preprocessing_version=preprocessing_version,
+                     image_features=image_features_list[i]) for i in range(len(content_hashes))
+            ]
+        ).on_conflict_do_nothing(index_elements=["content_hash", "feature_extractor_model", "target_size", "preprocessing_version"])
+    )
+    db.commit()
+    return True
+
+
 ###################
 # Helper Function #
 ###################
-def image_path_to_image_features(image_path, shell_family, target_size):
-    with Image.open(image_path).convert("RGB") as img:
-        resized_img = img.resize((target_size, target_size))
-        resized_img_array = np.array(resized_img)
-        expanded_resized_img_array = np.expand_dims(resized_img_array, 0)
-        preprocessed_img_array = shell_family.preprocessor_preprocess_function(expanded_resized_img_array)
-        sample_features = shell_family.preprocessor.predict(preprocessed_img_array)
-    return pickle.dumps(sample_features[0])
-
+def feature_sum_to_bytes(feature_sum):
+    return np.asarray(feature_sum, dtype='<f4').tobytes()
+
+def feature_sum_from_bytes(feature_sum_bytes: bytes):
+    return np.frombuffer(feature_sum_bytes, dtype='<f4').astype(np.float64).reshape((1, -1))
+
+def content_hash(content: bytes):
+    return hashlib.sha256(content).hexdigest()
+
+def image_path_to_content_hash(image_path):
+    with open(image_path, 'rb') as image_file:
+        return content_hash(image_file.read())
+
+def image_path_to_image_features(image_path, shell_family, target_size, db: Session = None, reduced_decode: bool = False):
+    # With a database session, features of a byte-identical image already extracted by the same backbone are reused
+    if db is not None:
+        image_content_hash = image_path_to_content_hash(image_path)
+        cached_image_features = get_cached_image_features(db, [image_content_hash], shell_family.feature_extractor_model, target_size, shell_family.preprocessing_version)
+        if image_content_hash in cached_image_features:
+            return cached_image_features[image_content_hash]
+    resized_img_array = load_image(image_path, (target_size, target_size), reduced_decode)
+    expanded_resized_img_array = np.expand_dims(resized_img_array, 0)
+    sample_features = shell_family.preprocessor.predict(expanded_resized_img_array)
+    image_features = encode_array(sample_features[0])
+    if db is not None:
+        create_cached_image_features(db, [image_content_hash], shell_family.feature_extractor_model, target_size, shell_family.preprocessing_version, [image_features])
+    return image_features
@@ -0,0 +1,91 @@
+import pickle
+import struct
+
+import numpy as np
+
+# Versioned encoding of the numpy arrays stored in LargeBinary columns (image features, shell means and
+# global means): a header with the magic, the version, the little-endian numpy dtype string and the
+# number of dimensions, each dimension as a uint32, then the raw little-endian array bytes.
+FEATURE_ENCODING_MAGIC = b'ILFE'
+FEATURE_ENCODING_VERSION = 1
+FEATURE_ENCODING_HEADER = struct.Struct('<4sB4sB')
+
+
+##########################
+# Feature Array Encoding #
+##########################
+def encode_array(array):
+    """Encode a numpy array as a versioned header followed by its raw little-endian bytes.
+    Args:
+        array (np.ndarray): Array to encode
+
+    Returns:
+        data (bytes): Encoded array
+    """
+    array = np.asarray(array)
+    dtype = array.dtype.newbyteorder('<')
+    array = np.ascontiguousarray(array, dtype=dtype)
+    header = FEATURE_ENCODING_HEADER.pack(FEATURE_ENCODING_MAGIC, FEATURE_ENCODING_VERSION, dtype.str.encode('ascii').ljust(4), array.ndim)
+    return header + struct.pack('<{}I'.format(array.ndim), *array.shape) + array.tobytes()
+
+
+def is_encoded_array(data):
+    """Whether data was written by encode_array, as opposed to a pickled array from before the encoding.
+    """
+    return data is not None and bytes(data[:len(FEATURE_ENCODING_MAGIC)]) == FEATURE_ENCODING_MAGIC
+
+
+def decode_array_header(data):
+    """Read the header of an encoded array.
+    Returns:
+        dtype (np.dtype): Array dtype
+        shape (tuple): Array shape
+        offset (int): Offset of the raw array bytes in data
+    """
+    magic, version, dtype_string, ndim = FEATURE_ENCODING_HEADER.unpack_from(data, 0)
+    if version != FEATURE_ENCODING_VERSION:
+        raise ValueError("Unsupported feature encoding version {}! Expected version {}".format(version, FEATURE_ENCODING_VERSION))
+    shape = struct.unpack_from('<{}I'.format(ndim), data, FEATURE_ENCODING_HEADER.size)
+    return np.dtype(dtype_string.decode('ascii').strip()), shape, FEATURE_ENCODING_HEADER.size + 4 * ndim
+
+
+def decode_array(data):
+    """Decode an array written by encode_array without copying it, or a pickled array written
+        before the encoding existed. The decoded array is read only.
+    Args:
+        data (bytes): Encoded or pickled array, or None
+
+    Returns:
+        array (np.ndarray): Decoded array, None if data is None
+    """
+    if data is None:
+        return None
+    if not is_encoded_array(data):
+        return pickle.loads(data)
+    dtype, shape, offset = decode_array_header(data)
+    return np.frombuffer(data, dtype=dtype, count=int(np.prod(shape)), offset=offset).reshape(shape)
+
+
+def decode_feature_matrix(data_list, dtype=np.float32):
+    """Decode a result set of feature vectors straight into one preallocated matrix, one row per
+        vector. Vectors of shape (D,) or (1, D) are both flattened into a row.
+    Args:
+        data_list (list): Encoded or pickled feature vectors
+        dtype (np.dtype): dtype of the matrix
+
+    Returns:
+        features (np.ndarray): Feature matrix of shape (N, D), None if data_list is empty
+    """
+    if not data_list:
+        return None
+    feature_dimension = np.size(decode_array(data_list[0]))
+    features = np.empty((len(data_list), feature_dimension), dtype=dtype)
+    for index, data in enumerate(data_list):
+        if is_encoded_array(data):
+            array_dtype, shape, offset = decode_array_header(data)
+            if int(np.prod(shape)) != feature_dimension:
+                raise ValueError("Feature vector {} has {} values, expected {}!".format(index, int(np.prod(shape)), feature_dimension))
+            features[index] = np.frombuffer(data, dtype=array_dtype, count=feature_dimension, offset=offset)
+        else:
+            features[index] = np.ravel(pickle.loads(data))
+    return features
@@ -0,0 +1,122 @@
+import datetime
+
+from sqlalchemy import text
+
+from .feature_encoding import FEATURE_ENCODING_MAGIC, encode_array, decode_array
+
+# Columns added to existing tables after their first release. create_all only creates
+# missing tables, so these are added in place to databases created by older versions.
+ADDED_COLUMNS = [
+    ("shell", "feature_sum", "BYTEA"),
+    ("shell", "feature_count", "INTEGER"),
+    ("shell_family", "last_shell_image_id", "INTEGER"),
+    ("shell_family", "last_assigned_at", "TIMESTAMP"),
+    ("shell_family", "shell_images_count", "INTEGER"),
+    ("shell_images", "preprocessing_version", "INTEGER"),
+    ("image_feature_cache", "preprocessing_version", "INTEGER"),
+]
+# Backbones whose own preprocess_input is the ResNet50 one (caffe mode) that the task-app applied to every
+# backbone before feature preprocessing version 2, so features they extracted before it are still current
+RESNET50_PREPROCESSED_BACKBONES = ("resnet50", "vgg16")
+# Array columns stored with feature_encoding.encode_array. Older versions pickled the arrays.
+ENCODED_ARRAY_COLUMNS = [
+    ("shell_family", "global_mean"),
+    ("shell", "shell_mean"),
+    ("shell_images", "image_features"),
+    ("image_feature_cache", "image_features"),
+]
+
+
+def upgrade_database(engine):
+    """Add any columns missing from tables created by older versions of the application and
+        run the data migrations not applied yet, see DATA_MIGRATIONS.
+    Args:
+        engine (sqlalchemy.engine.Engine): Engine connected to the application database
+    """
+    with engine.begin() as connection:
+        for table_name, column_name, column_type in ADDED_COLUMNS:
+            connection.execute(text("ALTER TABLE {} ADD COLUMN IF NOT EXISTS {} {}".format(table_name, column_name, column_type)))
+        applied_migrations = set(row[0] for row in connection.execute(text("SELECT name FROM schema_migration")).fetchall())
+    for migration_name, migration in DATA_MIGRATIONS:
+        if migration_name in applied_migrations:
+            continue
+        migration(engine)
+        # Migrations are idempotent, so one started by both the dash and task apps is only recorded once
+        with engine.begin() as connection:
+            connection.execute(text("INSERT INTO schema_migration (name, applied_at) VALUES (:name, :applied_at) ON CONFLICT (name) DO NOTHING"),
+                               {"name": migration_name, "applied_at": datetime.datetime.utcnow()})
+    return True
+
+
+def encode_pickled_array_columns(engine):
+    """Re-encode the arrays pickled by older versions in every column of ENCODED_ARRAY_COLUMNS.
+    """
+    for table_name, column_name in ENCODED_ARRAY_COLUMNS:
+        encode_pickled_arrays(engine, table_name, column_name)
+    return True
+
+
+def encode_pickled_arrays(engine, table_name, column_name, batch_size=1000):
+    """Re-encode the pickled arrays of a column with feature_encoding.encode_array, one committed
+        batch of rows at a time so an interrupted upgrade resumes where it stopped.
+    Returns:
+        num_encoded (int): Number of rows re-encoded
+    """
+    num_encoded = 0
+    last_id = 0
+    while True:
+        with engine.begin() as connection:
+            pickled_rows = connection.execute(
+                text("SELECT id, {column} FROM {table} WHERE id > :last_id AND {column} IS NOT NULL "
+                     "AND substring({column} from 1 for {magic_length}) <> :magic ORDER BY id LIMIT :batch_size".format(
+                         table=table_name, column=column_name, magic_length=len(FEATURE_ENCODING_MAGIC))),
+                {"last_id": last_id, "magic": FEATURE_ENCODING_MAGIC, "batch_size": batch_size}).fetchall()
+            if not pickled_rows:
+                break
+            encoded_rows = []
+            for row_id, data in pickled_rows:
+                array = decode_array(bytes(data))
+                encoded_rows.append({"id": row_id, "data": None if array is None else encode_array(array)})
+            connection.execute(text("UPDATE {table} SET {column} = :data WHERE id = :id".format(table=table_name, column=column_name)), encoded_rows)
+        num_encoded += len(pickled_rows)
+        last_id = pickled_rows[-1][0]
+    return num_encoded
+
+
+
+def invalidate_features_before_preprocessing_version_2(engine):
+    """Stamp the stored features that were extracted with their backbone's own preprocessing as preprocessing
+        version 2 and clear the others, such as MobileNet features extracted with ResNet50 preprocessing. The
+        cleared shell images are re-extracted by the task-app, whose watermark is reset for their shell families,
+        and the cleared cached features are deleted. The unique key of the feature cache gains preprocessing_version.
+    """
+    current_backbones = ", ".join("'{}'".format(backbone) for backbone in RESNET50_PREPROCESSED_BACKBONES)
+    with engine.begin() as connection:
+        connection.execute(text(
+            "UPDATE shell_images SET preprocessing_version = 2 WHERE preprocessing_version IS NULL AND image_features IS NOT NULL "
+            "AND shell_family_id IN (SELECT shell_family_id FROM shell_family WHERE split_part(feature_extractor_model, '_', 1) IN ({}))".format(current_backbones)))
+        connection.execute(text(
+            "UPDATE shell_family SET last_shell_image_id = NULL, last_assigned_at = NULL, shell_images_count = NULL "
+            "WHERE shell_family_id IN (SELECT DISTINCT shell_family_id FROM shell_images WHERE preprocessing_version IS NULL AND image_features IS NOT NULL)"))
+        connection.execute(text("UPDATE shell_images SET image_features = NULL WHERE preprocessing_version IS NULL AND image_features IS NOT NULL"))
+        connection.execute(text(
+            "UPDATE image_feature_cache SET preprocessing_version = 2 WHERE preprocessing_version IS NULL "
+            "AND split_part(feature_extractor_model, '_', 1) IN ({})".format(current_backbones)))
+        connection.execute(text("DELETE FROM image_feature_cache WHERE preprocessing_version IS NULL"))
+        # Replace the unnamed unique key of older versions, tables created since already have image_feature_cache_key
+        connection.execute(text(
+            "DO $$ DECLARE unique_constraint_name text; BEGIN "
+            "FOR unique_constraint_name IN SELECT conname FROM pg_constraint WHERE contype = 'u' AND conname <> 'image_feature_cache_key' "
+            "AND conrelid = (SELECT oid FROM pg_class WHERE relname = 'image_feature_cache' AND relkind = 'r') LOOP "
+            "EXECUTE 'ALTER TABLE image_feature_cache DROP CONSTRAINT ' || quote_ident(unique_constraint_name); END LOOP; "
+            "IF NOT EXISTS (SELECT 1 FROM pg_constraint WHERE conname = 'image_feature_cache_key') THEN "
+            "ALTER TABLE image_feature_cache ADD CONSTRAINT image_feature_cache_key UNIQUE (content_hash, feature_extractor_model, target_size, preprocessing_version); "
+            "END IF; END $$"))
+    return True
+
+
+# Data migrations run once per database in order, recorded by name in the schema_migration table
+DATA_MIGRATIONS = [
+    ("encode_pickled_arrays", encode_pickled_array_columns),
+    ("feature_preprocessing_version_2", invalidate_features_before_preprocessing_version_2),
+]
@@ -1,5 +1,5 @@
 import datetime
-from sqlalchemy import Boolean, Column, ForeignKey, Integer, Float, String, DateTime, LargeBinary, ARRAY
+from sqlalchemy import Boolean, Column, ForeignKey, Integer, Float, String, DateTime, LargeBinary, ARRAY, UniqueConstraint
 from sqlalchemy.orm import relationship
 
 from .database import Base
@@ -14,6 +14,10 @@ class ShellFamily(Base):
     global_mean = Column(LargeBinary)
     created_at = Column(DateTime, default=datetime.datetime.utcnow)
     updated_at = Column(DateTime, default=datetime.datetime.utcnow)
+    # High-water mark of the shell_images rows the task app has processed for this family
+    last_shell_image_id = Column(Integer)
+    last_assigned_at = Column(DateTime)
+    shell_images_count = Column(Integer)
 
 class Shell(Base):
     __tablename__ = "shell"
@@ -24,6 +28,9 @@ class Shell(Base):
     num_instances = Column(Integer)
     noise_mean = Column(Float)
     noise_std = Column(Float)
+    # Exact sum (float32 bytes) and number of the features of every image in the shell
+    feature_sum = Column(LargeBinary)
+    feature_count = Column(Integer)
     created_at = Column(DateTime, default=datetime.datetime.utcnow)
     updated_at = Column(DateTime, default=datetime.datetime.utcnow)
 
@@ -34,6 +41,8 @@ class ShellImages(Base):
     shell_id = Column(String)
     image_path = Column(String)
     image_features = Column(LargeBinary)
+    # Preprocessing version image_features were extracted with, see FEATURE_PREPROCESSING_VERSION in src/feature_extractors.py
+    preprocessing_version = Column(Integer)
     assigned_at = Column(DateTime, default=datetime.datetime.utcnow)
 
 class Images(Base):
@@ -42,3 +51,21 @@ class Images(Base):
     image_class = Column(String)
     image_path = Column(String)
     uploaded_at = Column(DateTime, default=datetime.datetime.utcnow)
+
+class ImageFeatureCache(Base):
+    __tablename__ = "image_feature_cache"
+    __table_args__ = (UniqueConstraint("content_hash", "feature_extractor_model", "target_size", "preprocessing_version", name="image_feature_cache_key"),)
+    id = Column(Integer, primary_key=True, index=True, autoincrement=True)
+    content_hash = Column(String, index=True)
+    feature_extractor_model = Column(String)
+    target_size = Column(Integer)
+    preprocessing_version = Column(Integer)
+    image_features = Column(LargeBinary)
+    created_at = Column(DateTime, default=datetime.datetime.utcnow)
+
+class SchemaMigration(Base):
+    # Data migrations of sql_app.migrations already applied to the database
+    __tablename__ = "schema_migration"
+    id = Column(Integer, primary_key=True, index=True, autoincrement=True)
+    name = Column(String, unique=True)
+    applied_at = Column(DateTime, default=datetime.datetime.utcnow)
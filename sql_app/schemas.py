@@ -20,6 +20,9 @@ class ShellFamily(ShellFamilyBase):
     global_mean: bytes
     created_at: datetime.datetime
     updated_at: datetime.datetime
+    last_shell_image_id: Optional[int] = None
+    last_assigned_at: Optional[datetime.datetime] = None
+    shell_images_count: Optional[int] = None
     class Config:
         orm_mode = True
 
@@ -40,6 +43,8 @@ class Shell(ShellBase):
     num_instances: int
     noise_mean: float
     noise_std: float
+    feature_sum: Optional[bytes] = None
+    feature_count: Optional[int] = None
     created_at: datetime.datetime
     updated_at: datetime.datetime
     class Config:
@@ -80,4 +85,24 @@ class Images(ImagesBase):
     image_path = str
     uploaded_at = datetime.datetime
     class Config:
-        orm_mode = True
\ No newline at end of file
+        orm_mode = True
+
+###############################
+# Image Feature Cache Schemas #
+###############################
+class ImageFeatureCacheBase(BaseModel):
+    pass
+
+class ImageFeatureCacheCreate(ImageFeatureCacheBase):
+    pass
+
+class ImageFeatureCache(ImageFeatureCacheBase):
+    id: int
+    content_hash: str
+    feature_extractor_model: str
+    target_size: int
+    preprocessing_version: Optional[int] = None
+    image_features: bytes
+    created_at: datetime.datetime
+    class Config:
+        orm_mode = True
@@ -0,0 +1,175 @@
+import os
+import json
+import time
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import tensorflow as tf
+
+from quantization import split_quantized_feature_extractor_model
+from feature_extractors import ACCEPTED_PREPROCESSORS, get_feature_extractor
+
+# Rough peak activation memory of a forward pass per input pixel, in bytes, for inference only.
+# The two largest consecutive float32 feature maps plus allocator overhead at the given backbone's widest layers
+BACKBONE_ACTIVATION_BYTES_PER_PIXEL = {'vgg16': 320,
+                                       'resnet50': 200,
+                                       'mobilenet': 110}
+# Approximate size of each backbone's weights without the classification head, in bytes
+BACKBONE_WEIGHT_BYTES = {'vgg16': 60 * 2**20,
+                         'resnet50': 100 * 2**20,
+                         'mobilenet': 15 * 2**20}
+# Fraction of the memory budget left for the decoded batches waiting for inference
+DECODE_MEMORY_FRACTION = 0.5
+# Never trace or measure inference batches larger than this
+MAX_INFERENCE_BATCH_SIZE = 256
+
+
+########################################
+# Memory Budget Extraction Batch Sizes #
+########################################
+def batch_sizes_from_memory_budget(memory_budget_mb, feature_extractor_model, target_size, prefetch_batches=1, inference_batch_size=None):
+    """Pick the decode and inference batch sizes of feature extraction from a memory budget.
+        Half of the budget holds the uint8 batches decoded ahead of inference, the current batch
+        and prefetch_batches more. The other half holds the backbone's weights and the activations
+        of one inference batch. The decode batch size is a multiple of the inference batch size
+        so every decoded batch splits into whole inference batches.
+    Args:
+        memory_budget_mb (float): Memory available to feature extraction in MiB
+        feature_extractor_model (str): Backbone name, quantized variants such as 'resnet50_int8' are sized as their backbone
+        target_size (int): Height and width of the images
+        prefetch_batches (int): Number of decoded batches waiting ahead of the current one
+        inference_batch_size (int): Inference batch size to use instead of the one fitting the budget, such as
+            an autotuned one. It is still capped by the budget
+
+    Returns:
+        decode_batch_size (int): Number of images decoded per batch
+        inference_batch_size (int): Number of images per forward pass
+    """
+    backbone, _ = split_quantized_feature_extractor_model(feature_extractor_model)
+    if backbone not in ACCEPTED_PREPROCESSORS:
+        raise ValueError("Preprocessor model not found! Please enter the following models: {}".format(ACCEPTED_PREPROCESSORS))
+    memory_budget = memory_budget_mb * 2**20
+    image_pixels = target_size * target_size
+    inference_memory = memory_budget * (1 - DECODE_MEMORY_FRACTION) - BACKBONE_WEIGHT_BYTES[backbone]
+    max_inference_batch_size = int(min(inference_memory // (BACKBONE_ACTIVATION_BYTES_PER_PIXEL[backbone] * image_pixels), MAX_INFERENCE_BATCH_SIZE))
+    if max_inference_batch_size < 1:
+        raise ValueError("Memory budget of {} MiB is too small to run {} on a single {}x{} image!".format(memory_budget_mb, backbone, target_size, target_size))
+    inference_batch_size = max_inference_batch_size if inference_batch_size is None else max(min(inference_batch_size, max_inference_batch_size), 1)
+    decode_memory = memory_budget * DECODE_MEMORY_FRACTION
+    max_decode_batch_size = int(decode_memory // ((max(prefetch_batches, 0) + 1) * image_pixels * 3))
+    decode_batch_size = max(max_decode_batch_size // inference_batch_size, 1) * inference_batch_size
+    return decode_batch_size, inference_batch_size
+
+
+#################################
+# Feature Extraction Autotuning #
+#################################
+def default_thread_settings():
+    """Candidate (intra_op, inter_op) TensorFlow thread settings for this machine, 0 leaving the choice to TensorFlow.
+    """
+    num_cpus = os.cpu_count() or 1
+    thread_settings = [(0, 0), (num_cpus, 1), (max(num_cpus // 2, 1), 2)]
+    return list(dict.fromkeys(thread_settings))
+
+
+def autotune_extraction_profile(feature_extractor_model, target_size, memory_budget_mb, profile_filepath, thread_settings=None, num_batches=3, calibration_image_paths=None, quantized_model_directory='models'):
+    """Measure feature extraction throughput on this machine at every power of two inference batch
+        size fitting the memory budget, under each TensorFlow thread setting, and save the fastest
+        as a profile. Thread settings are fixed once TensorFlow initializes, so each one is
+        measured in a fresh process.
+    Args:
+        feature_extractor_model (str): Backbone name
+        target_size (int): Height and width of the images
+        memory_budget_mb (float): Memory available to feature extraction in MiB
+        profile_filepath (str): JSON file to save the profile to
+        thread_settings (list): (intra_op, inter_op) thread counts to try, default_thread_settings if None
+        num_batches (int): Number of timed batches per batch size, after one untimed warm up batch
+        calibration_image_paths (list): Paths of stored images, only used to convert quantized backbones
+        quantized_model_directory (str): Directory caching converted quantized backbones
+
+    Returns:
+        profile (dict): Fastest setting, with every measurement under 'measurements'
+    """
+    _, max_inference_batch_size = batch_sizes_from_memory_budget(memory_budget_mb, feature_extractor_model, target_size)
+    batch_sizes = [2**exponent for exponent in range(int(np.log2(max_inference_batch_size)) + 1)]
+    measurements = []
+    for intra_op_parallelism_threads, inter_op_parallelism_threads in (thread_settings or default_thread_settings()):
+        with ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context('spawn')) as executor:
+            measurements += executor.submit(_measure_extraction_throughput,
+                                            feature_extractor_model,
+                                            target_size,
+                                            batch_sizes,
+                                            intra_op_parallelism_threads,
+                                            inter_op_parallelism_threads,
+                                            num_batches,
+                                            calibration_image_paths,
+                                            quantized_model_directory).result()
+    best_measurement = max(measurements, key=lambda measurement: measurement['images_per_second'])
+    profile = {'feature_extractor_model': feature_extractor_model,
+               'target_size': target_size,
+               'memory_budget_mb': memory_budget_mb,
+               'inference_batch_size': best_measurement['batch_size'],
+               'intra_op_parallelism_threads': best_measurement['intra_op_parallelism_threads'],
+               'inter_op_parallelism_threads': best_measurement['inter_op_parallelism_threads'],
+               'images_per_second': best_measurement['images_per_second'],
+               'measurements': measurements}
+    profile_directory = os.path.dirname(profile_filepath)
+    if profile_directory:
+        os.makedirs(profile_directory, exist_ok=True)
+    with open(profile_filepath + '.tmp', 'w') as profile_file:
+        json.dump(profile, profile_file, indent=2)
+    os.replace(profile_filepath + '.tmp', profile_filepath)
+    return profile
+
+
+def load_extraction_profile(profile_filepath, feature_extractor_model, target_size, memory_budget_mb):
+    """Load a saved autotune profile.
+    Returns:
+        profile (dict): Saved profile, None if there is none or it was measured for another backbone, size or budget
+    """
+    if not profile_filepath or not os.path.isfile(profile_filepath):
+        return None
+    with open(profile_filepath) as profile_file:
+        profile = json.load(profile_file)
+    if (profile.get('feature_extractor_model') != feature_extractor_model
+            or profile.get('target_size') != target_size
+            or profile.get('memory_budget_mb') != memory_budget_mb):
+        return None
+    return profile
+
+
+def apply_thread_settings(profile):
+    """Set TensorFlow's intra-op and inter-op thread counts from a profile. Only takes effect
+        before TensorFlow runs its first operation in this process.
+    Returns:
+        applied (bool): Whether the thread counts were set
+    """
+    try:
+        tf.config.threading.set_intra_op_parallelism_threads(profile['intra_op_parallelism_threads'])
+        tf.config.threading.set_inter_op_parallelism_threads(profile['inter_op_parallelism_threads'])
+    except RuntimeError:
+        return False
+    return True
+
+
+def _measure_extraction_throughput(feature_extractor_model, target_size, batch_sizes, intra_op_parallelism_threads, inter_op_parallelism_threads, num_batches, calibration_image_paths, quantized_model_directory):
+    """Worker for autotune_extraction_profile. Runs in a fresh process so the thread counts apply.
+    """
+    tf.config.threading.set_intra_op_parallelism_threads(intra_op_parallelism_threads)
+    tf.config.threading.set_inter_op_parallelism_threads(inter_op_parallelism_threads)
+    model = get_feature_extractor(feature_extractor_model, target_size, calibration_image_paths, quantized_model_directory)
+    random_state = np.random.RandomState(0)
+    measurements = []
+    for batch_size in batch_sizes:
+        images = random_state.randint(0, 256, size=(batch_size, target_size, target_size, 3)).astype(np.uint8)
+        model.predict(images, batch_size=batch_size)
+        start_time = time.perf_counter()
+        for _ in range(num_batches):
+            model.predict(images, batch_size=batch_size)
+        elapsed_time = time.perf_counter() - start_time
+        measurements.append({'batch_size': batch_size,
+                             'intra_op_parallelism_threads': intra_op_parallelism_threads,
+                             'inter_op_parallelism_threads': inter_op_parallelism_threads,
+                             'images_per_second': batch_size * num_batches / elapsed_time})
+    return measurements
@@ -0,0 +1,316 @@
+import os
+import abc
+import json
+import tempfile
+import threading
+import time
+from collections import deque
+
+import numpy as np
+import tensorflow as tf
+from tensorflow.keras.applications.vgg16 import VGG16
+from tensorflow.keras.applications.vgg16 import preprocess_input as vgg16_preprocess_input
+from tensorflow.keras.applications.resnet50 import ResNet50
+from tensorflow.keras.applications.resnet50 import preprocess_input as resnet50_preprocess_input
+from tensorflow.keras.applications import MobileNet
+from tensorflow.keras.applications.mobilenet import preprocess_input as mobilenet_preprocess_input
+from tensorflow.keras.layers import Input, Lambda, GlobalAvgPool2D
+from tensorflow.keras import Model
+
+from quantization import QUANTIZATION_MODES, split_quantized_feature_extractor_model, load_calibration_images, convert_to_tflite, feature_drift_report
+
+ACCEPTED_PREPROCESSORS = ("vgg16", "resnet50", "mobilenet")
+PREPROCESSORS_PREPROCESS_FUNCTIONS = {'vgg16': vgg16_preprocess_input,
+                                      'resnet50': resnet50_preprocess_input,
+                                      'mobilenet': mobilenet_preprocess_input}
+PREPROCESSORS_BACKBONES = {'vgg16': VGG16,
+                           'resnet50': ResNet50,
+                           'mobilenet': MobileNet}
+# TFLite post-training quantized variant of every backbone, such as 'resnet50_int8'
+ACCEPTED_QUANTIZED_PREPROCESSORS = tuple('{}_{}'.format(backbone, quantization_mode) for backbone in ACCEPTED_PREPROCESSORS for quantization_mode in QUANTIZATION_MODES)
+PREPROCESSORS_PREPROCESS_FUNCTIONS.update({quantized_backbone: PREPROCESSORS_PREPROCESS_FUNCTIONS[split_quantized_feature_extractor_model(quantized_backbone)[0]]
+                                           for quantized_backbone in ACCEPTED_QUANTIZED_PREPROCESSORS})
+
+# Version of the image preprocessing the feature extractors apply, stored along with extracted features so features
+# from older preprocessing are never mixed with current ones. Version 2 applies each backbone's own preprocess_input
+# inside the model, where the task-app used to apply ResNet50's preprocess_input to every backbone.
+FEATURE_PREPROCESSING_VERSION = 2
+# Batch sizes the compiled feature extractors are traced for. Batches are padded up to the closest size
+FEATURE_EXTRACTOR_BATCH_BUCKETS = (1, 4, 16, 64)
+# Number of recent calls kept by each compiled feature extractor for its latency percentiles
+FEATURE_EXTRACTOR_LATENCY_WINDOW = 1000
+
+# Process-wide feature extractors keyed by backbone name, shared by every ShellFamily using them
+_FEATURE_EXTRACTORS = {}
+_COMPILED_FEATURE_EXTRACTORS = {}
+_FEATURE_EXTRACTORS_LOCK = threading.RLock()
+
+
+##############################
+# BaseFeatureExtractor Class #
+##############################
+class BaseFeatureExtractor(abc.ABC):
+    """Inference path that keeps the latency of recent calls. Subclasses implement predict on uint8
+    images, the backbone's preprocessing being part of the model.
+    """
+    def __init__(self):
+        self.latencies = deque(maxlen=FEATURE_EXTRACTOR_LATENCY_WINDOW)
+
+    def __call__(self, images):
+        """Extract the features of a batch of images.
+        Args:
+            images (np.ndarray): uint8 image array of shape (N, H, W, 3)
+
+        Returns:
+            features (np.ndarray): Feature array of shape (N, D)
+        """
+        start_time = time.perf_counter()
+        features = self.predict(images)
+        self.latencies.append(time.perf_counter() - start_time)
+        return features
+
+    @abc.abstractmethod
+    def predict(self, images):
+        """Extract the features of a batch of images.
+        Args:
+            images (np.ndarray): uint8 image array of shape (N, H, W, 3)
+
+        Returns:
+            features (np.ndarray): Feature array of shape (N, D)
+        """
+
+    def latency_percentiles(self, percentiles=(50, 99)):
+        """Latency percentiles in milliseconds of the most recent calls.
+        Returns:
+            latency_percentiles (dict): Percentile name such as 'p50' to latency, empty before the first call
+        """
+        if not self.latencies:
+            return {}
+        latencies = np.percentile(np.array(self.latencies) * 1000, percentiles)
+        return {'p{}'.format(percentile): float(latency) for percentile, latency in zip(percentiles, latencies)}
+
+
+##################################
+# CompiledFeatureExtractor Class #
+##################################
+class CompiledFeatureExtractor(BaseFeatureExtractor):
+    """Low latency inference wrapper around a feature extractor model.
+
+    The model is traced once per batch size in batch_buckets with a fixed input signature, and
+    every call is padded up to the closest traced batch size, so calls never retrace and skip
+    the per call overhead of Model.predict. warm_up runs every traced function once so the first
+    real call does not pay for tracing either.
+    """
+    def __init__(self, model, batch_buckets=FEATURE_EXTRACTOR_BATCH_BUCKETS):
+        super().__init__()
+        self.model = model
+        self.batch_buckets = tuple(sorted(batch_buckets))
+        self.functions = {batch_bucket: tf.function(self.__forward, input_signature=[tf.TensorSpec([batch_bucket, None, None, 3], tf.uint8)])
+                          for batch_bucket in self.batch_buckets}
+        self.warmed_up_sizes = set()
+
+    def __forward(self, images):
+        return self.model(images, training=False)
+
+    def predict(self, images):
+        """Extract the features of a batch of images.
+        Args:
+            images (np.ndarray): uint8 image array of shape (N, H, W, 3)
+
+        Returns:
+            features (np.ndarray): Feature array of shape (N, D)
+        """
+        largest_batch_bucket = self.batch_buckets[-1]
+        features = []
+        for batch_start in range(0, images.shape[0], largest_batch_bucket):
+            batch_images = np.asarray(images[batch_start : batch_start + largest_batch_bucket], dtype=np.uint8)
+            num_images = batch_images.shape[0]
+            batch_bucket = next(batch_bucket for batch_bucket in self.batch_buckets if batch_bucket >= num_images)
+            if batch_bucket > num_images:
+                padding = np.zeros((batch_bucket - num_images,) + batch_images.shape[1:], dtype=np.uint8)
+                batch_images = np.concatenate([batch_images, padding], axis=0)
+            features.append(self.functions[batch_bucket](tf.constant(batch_images)).numpy()[:num_images])
+        return np.concatenate(features, axis=0)
+
+    def warm_up(self, target_size):
+        """Run every traced batch size once on images of shape (target_size, target_size, 3).
+        """
+        if target_size in self.warmed_up_sizes:
+            return
+        for batch_bucket in self.batch_buckets:
+            self.functions[batch_bucket](tf.zeros([batch_bucket, target_size, target_size, 3], dtype=tf.uint8))
+        self.warmed_up_sizes.add(target_size)
+
+
+################################
+# TFLiteFeatureExtractor Class #
+################################
+class TFLiteFeatureExtractor(BaseFeatureExtractor):
+    """Inference wrapper around a TFLite feature extractor, such as a post-training quantized backbone.
+    predict mirrors Model.predict so it can stand in for the Keras model as a ShellFamily preprocessor.
+    The converted model takes float32 pixels, so uint8 images are only cast one invocation at a time.
+    """
+    def __init__(self, model_content, num_threads=None):
+        super().__init__()
+        self.interpreter = tf.lite.Interpreter(model_content=model_content, num_threads=num_threads)
+        self.input_index = self.interpreter.get_input_details()[0]['index']
+        self.output_index = self.interpreter.get_output_details()[0]['index']
+        self.input_batch_size = None
+        # Accuracy drift of the features against the float model, see quantization.feature_drift_report
+        self.drift_report = None
+        # A TFLite interpreter must not be invoked from several threads at once
+        self.lock = threading.Lock()
+
+    def predict(self, images, batch_size=32):
+        """Extract the features of a batch of images.
+        Args:
+            images (np.ndarray): uint8 image array of shape (N, H, W, 3)
+            batch_size (int): Number of images per interpreter invocation
+
+        Returns:
+            features (np.ndarray): Feature array of shape (N, D)
+        """
+        features = []
+        with self.lock:
+            for batch_start in range(0, images.shape[0], batch_size):
+                batch_images = np.asarray(images[batch_start : batch_start + batch_size], dtype=np.float32)
+                if batch_images.shape[0] != self.input_batch_size:
+                    self.interpreter.resize_tensor_input(self.input_index, batch_images.shape)
+                    self.interpreter.allocate_tensors()
+                    self.input_batch_size = batch_images.shape[0]
+                self.interpreter.set_tensor(self.input_index, batch_images)
+                self.interpreter.invoke()
+                features.append(self.interpreter.get_tensor(self.output_index).copy())
+        return np.concatenate(features, axis=0)
+
+    def warm_up(self, target_size):
+        self.predict(np.zeros((1, target_size, target_size, 3), dtype=np.uint8))
+
+
+##############################
+# Feature Extractor Registry #
+##############################
+def build_feature_extractor(feature_extractor_model):
+    """Build a backbone with ImageNet weights that pools its last feature map into one feature vector.
+        The model takes uint8 images and casts them to float32 and applies the backbone's own
+        preprocess_input inside the graph, so batches stay uint8 on the host until they enter the model.
+    Args:
+        feature_extractor_model (str): Backbone name, one of ACCEPTED_PREPROCESSORS
+
+    Returns:
+        model (tf.keras.Model): Feature extractor model
+    """
+    if feature_extractor_model not in ACCEPTED_PREPROCESSORS:
+        raise ValueError("Preprocessor model not found! Please enter the following models: {}".format(ACCEPTED_PREPROCESSORS))
+    preprocess_function = PREPROCESSORS_PREPROCESS_FUNCTIONS[feature_extractor_model]
+    inputs = Input(shape=(None, None, 3), dtype=tf.uint8)
+    preprocessed_inputs = Lambda(lambda images: preprocess_function(tf.cast(images, tf.float32)), name='preprocess_input')(inputs)
+    features = PREPROCESSORS_BACKBONES[feature_extractor_model](weights='imagenet', include_top=False)(preprocessed_inputs)
+    features = GlobalAvgPool2D()(features)
+    return Model(inputs, features, name='{}_feature_extractor'.format(feature_extractor_model))
+
+
+def build_quantized_feature_extractor(feature_extractor_model, target_size, calibration_image_paths=None, quantized_model_directory='models'):
+    """Load a quantized variant of a backbone from quantized_model_directory. If it was never converted,
+        the float backbone is converted with TFLite post-training quantization, calibrated on half of the
+        calibration images, and the feature drift against the float backbone on the other half is saved
+        next to the converted model. Only the locally cached weights of the float backbone are needed.
+        An int8 backbone cannot be converted without calibration images, such as on an empty database.
+    Args:
+        feature_extractor_model (str): Quantized backbone name, one of ACCEPTED_QUANTIZED_PREPROCESSORS
+        target_size (int): Height and width of the images the extractor will be called on
+        calibration_image_paths (list): Paths of stored images to calibrate and evaluate the conversion on
+        quantized_model_directory (str): Directory caching the converted models and their drift reports
+
+    Returns:
+        feature_extractor (TFLiteFeatureExtractor): Quantized feature extractor
+    """
+    if feature_extractor_model not in ACCEPTED_QUANTIZED_PREPROCESSORS:
+        raise ValueError("Preprocessor model not found! Please enter the following models: {}".format(ACCEPTED_PREPROCESSORS + ACCEPTED_QUANTIZED_PREPROCESSORS))
+    backbone, quantization_mode = split_quantized_feature_extractor_model(feature_extractor_model)
+    model_filepath = os.path.join(quantized_model_directory, '{}_{}.tflite'.format(feature_extractor_model, target_size))
+    drift_report_filepath = os.path.join(quantized_model_directory, '{}_{}_drift_report.json'.format(feature_extractor_model, target_size))
+    if os.path.isfile(model_filepath):
+        with open(model_filepath, 'rb') as model_file:
+            feature_extractor = TFLiteFeatureExtractor(model_file.read())
+    else:
+        images = load_calibration_images(calibration_image_paths or [], target_size)
+        # Features are stored and cached under the backbone name, so never stand in another variant for it
+        if quantization_mode == 'int8' and images.shape[0] == 0:
+            raise ValueError("No calibration images to convert {} with! Please store images first or use {}_float16".format(feature_extractor_model, backbone))
+        # Hold out every other image to measure the drift on images the conversion was not calibrated on
+        calibration_images, evaluation_images = (images[::2], images[1::2]) if images.shape[0] > 1 else (images, images)
+        model = get_feature_extractor(backbone)
+        model_content = convert_to_tflite(model, quantization_mode, target_size, calibration_images)
+        os.makedirs(quantized_model_directory, exist_ok=True)
+        feature_extractor = TFLiteFeatureExtractor(model_content)
+        # Processes converting the same backbone at once, such as the dash and task apps, each write
+        # their own temporary file and atomically replace the cached files with it
+        if evaluation_images.shape[0] > 0:
+            drift_report = feature_drift_report(model.predict(evaluation_images), feature_extractor.predict(evaluation_images))
+            with tempfile.NamedTemporaryFile('w', dir=quantized_model_directory, suffix='.tmp', delete=False) as drift_report_file:
+                json.dump(drift_report, drift_report_file, indent=2)
+            os.replace(drift_report_file.name, drift_report_filepath)
+        with tempfile.NamedTemporaryFile('wb', dir=quantized_model_directory, suffix='.tmp', delete=False) as model_file:
+            model_file.write(model_content)
+        os.replace(model_file.name, model_filepath)
+    if os.path.isfile(drift_report_filepath):
+        with open(drift_report_filepath) as drift_report_file:
+            feature_extractor.drift_report = json.load(drift_report_file)
+    return feature_extractor
+
+
+def get_feature_extractor(feature_extractor_model, target_size=224, calibration_image_paths=None, quantized_model_directory='models'):
+    """Get the process-wide feature extractor of a backbone, loading its weights on first use only.
+    Args:
+        feature_extractor_model (str): Backbone name, one of ACCEPTED_PREPROCESSORS or ACCEPTED_QUANTIZED_PREPROCESSORS
+        target_size (int): Height and width of the images, only used by quantized backbones
+        calibration_image_paths (list): Paths of stored images, only used to convert quantized backbones
+        quantized_model_directory (str): Directory caching converted quantized backbones
+
+    Returns:
+        model (tf.keras.Model or TFLiteFeatureExtractor): Shared feature extractor model
+    """
+    model = _FEATURE_EXTRACTORS.get(feature_extractor_model)
+    if model is None:
+        with _FEATURE_EXTRACTORS_LOCK:
+            # Another thread may have loaded the backbone while this one waited for the lock
+            model = _FEATURE_EXTRACTORS.get(feature_extractor_model)
+            if model is None:
+                if split_quantized_feature_extractor_model(feature_extractor_model)[1] is not None:
+                    model = build_quantized_feature_extractor(feature_extractor_model, target_size, calibration_image_paths, quantized_model_directory)
+                else:
+                    model = build_feature_extractor(feature_extractor_model)
+                _FEATURE_EXTRACTORS[feature_extractor_model] = model
+    return model
+
+
+def get_compiled_feature_extractor(feature_extractor_model, target_size, calibration_image_paths=None, quantized_model_directory='models'):
+    """Get the process-wide CompiledFeatureExtractor of a backbone, warmed up for target_size.
+        Quantized backbones are already compiled, so their TFLiteFeatureExtractor is returned instead.
+    Args:
+        feature_extractor_model (str): Backbone name, one of ACCEPTED_PREPROCESSORS or ACCEPTED_QUANTIZED_PREPROCESSORS
+        target_size (int): Height and width of the images the extractor will be called on
+        calibration_image_paths (list): Paths of stored images, only used to convert quantized backbones
+        quantized_model_directory (str): Directory caching converted quantized backbones
+
+    Returns:
+        feature_extractor (BaseFeatureExtractor): Shared compiled feature extractor
+    """
+    model = get_feature_extractor(feature_extractor_model, target_size, calibration_image_paths, quantized_model_directory)
+    if isinstance(model, TFLiteFeatureExtractor):
+        model.warm_up(target_size)
+        return model
+    with _FEATURE_EXTRACTORS_LOCK:
+        feature_extractor = _COMPILED_FEATURE_EXTRACTORS.get(feature_extractor_model)
+        if feature_extractor is None:
+            feature_extractor = CompiledFeatureExtractor(model)
+            _COMPILED_FEATURE_EXTRACTORS[feature_extractor_model] = feature_extractor
+        feature_extractor.warm_up(target_size)
+    return feature_extractor
+
+
+def loaded_feature_extractors():
+    """Names of the backbones loaded in this process.
+    """
+    return list(_FEATURE_EXTRACTORS.keys())
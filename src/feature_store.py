@@ -0,0 +1,122 @@
+import os
+import json
+import shutil
+from urllib.parse import quote, unquote
+
+import numpy as np
+
+FEATURE_STORE_DTYPE = np.dtype('<f4')
+FEATURE_STORE_METADATA_FILENAME = 'store.json'
+FEATURE_SEGMENT_EXTENSION = '.f32'
+
+
+######################
+# FeatureStore Class #
+######################
+class FeatureStore():
+    """Append-only on-disk store of the raw features of every shell in one shell family.
+
+    Each shell's features live in one segment file of little endian float32 rows under
+    <directory>/<shell_family_id>/<shell_id>.f32, which read opens with np.memmap so only
+    the pages that are used are brought into memory.
+    """
+    def __init__(self, directory, shell_family_id):
+        self.directory = os.path.join(directory, quote(shell_family_id, safe=''))
+        os.makedirs(self.directory, exist_ok=True)
+        self.metadata_filepath = os.path.join(self.directory, FEATURE_STORE_METADATA_FILENAME)
+        self.feature_dimension = None
+        if os.path.isfile(self.metadata_filepath):
+            with open(self.metadata_filepath) as metadata_file:
+                self.feature_dimension = json.load(metadata_file)['feature_dimension']
+
+    def segment_filepath(self, shell_id):
+        return os.path.join(self.directory, quote(shell_id, safe='') + FEATURE_SEGMENT_EXTENSION)
+
+    def shell_ids(self):
+        return [unquote(filename[:-len(FEATURE_SEGMENT_EXTENSION)]) for filename in os.listdir(self.directory)
+                if filename.endswith(FEATURE_SEGMENT_EXTENSION)]
+
+    def count(self, shell_id):
+        """Number of complete feature rows stored for a shell.
+        """
+        segment_filepath = self.segment_filepath(shell_id)
+        if self.feature_dimension is None or not os.path.isfile(segment_filepath):
+            return 0
+        return os.path.getsize(segment_filepath) // (self.feature_dimension * FEATURE_STORE_DTYPE.itemsize)
+
+    def append(self, shell_id, features):
+        """Append features to a shell's segment file.
+        Args:
+            shell_id (str): Shell to append to
+            features (np.ndarray): Raw feature array of shape (N, D)
+        """
+        self.__set_feature_dimension(features.shape[1])
+        segment_filepath = self.segment_filepath(shell_id)
+        row_bytes = self.feature_dimension * FEATURE_STORE_DTYPE.itemsize
+        with open(segment_filepath, 'ab') as segment_file:
+            # Drop a partially written row left behind by an interrupted append
+            segment_file.truncate(self.count(shell_id) * row_bytes)
+            segment_file.write(np.ascontiguousarray(features, dtype=FEATURE_STORE_DTYPE).tobytes())
+        return True
+
+    def write(self, shell_id, features):
+        """Replace all the features of a shell. The new segment file is swapped in atomically.
+        Args:
+            shell_id (str): Shell to write
+            features (np.ndarray): Raw feature array of shape (N, D)
+        """
+        self.__set_feature_dimension(features.shape[1])
+        segment_filepath = self.segment_filepath(shell_id)
+        with open(segment_filepath + '.tmp', 'wb') as segment_file:
+            segment_file.write(np.ascontiguousarray(features, dtype=FEATURE_STORE_DTYPE).tobytes())
+        os.replace(segment_filepath + '.tmp', segment_filepath)
+        return True
+
+    def update_rows(self, shell_id, rows, features):
+        """Overwrite some of the feature rows of a shell in place, without rewriting its segment file.
+        Args:
+            shell_id (str): Shell to update
+            rows (np.ndarray): Indexes of the rows to overwrite of shape (M,)
+            features (np.ndarray): Raw feature array of shape (M, D)
+        """
+        self.__set_feature_dimension(features.shape[1])
+        segment_features = np.memmap(self.segment_filepath(shell_id), dtype=FEATURE_STORE_DTYPE, mode='r+', shape=(self.count(shell_id), self.feature_dimension))
+        segment_features[rows] = features
+        segment_features.flush()
+        del segment_features
+        return True
+
+    def read(self, shell_id):
+        """Memory map the features of a shell.
+        Args:
+            shell_id (str): Shell to read
+
+        Returns:
+            features (np.memmap): Read only raw feature array of shape (N, D), None if the shell has no features
+        """
+        num_features = self.count(shell_id)
+        if num_features == 0:
+            return None
+        return np.memmap(self.segment_filepath(shell_id), dtype=FEATURE_STORE_DTYPE, mode='r', shape=(num_features, self.feature_dimension))
+
+    def delete(self, shell_id):
+        segment_filepath = self.segment_filepath(shell_id)
+        if os.path.isfile(segment_filepath):
+            os.remove(segment_filepath)
+        return True
+
+    def clear(self):
+        """Delete every shell's features from the store.
+        """
+        shutil.rmtree(self.directory, ignore_errors=True)
+        os.makedirs(self.directory, exist_ok=True)
+        self.feature_dimension = None
+        return True
+
+    def __set_feature_dimension(self, feature_dimension):
+        if self.feature_dimension is None:
+            self.feature_dimension = int(feature_dimension)
+            with open(self.metadata_filepath, 'w') as metadata_file:
+                json.dump({'feature_dimension': self.feature_dimension}, metadata_file)
+        elif self.feature_dimension != feature_dimension:
+            raise ValueError("Feature dimension {} does not match the store's feature dimension {}!".format(feature_dimension, self.feature_dimension))
@@ -0,0 +1,112 @@
+import queue
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import Future
+
+import numpy as np
+
+
+class InferenceQueueFullError(Exception):
+    """Raised when a request is shed because the inference queue is at its maximum depth.
+    """
+    pass
+
+
+########################
+# InferenceQueue Class #
+########################
+class InferenceQueue():
+    """In-process micro-batching queue in front of a feature extraction function.
+
+    Concurrent requests are collected for up to max_wait_ms after the first one arrives, or
+    until max_batch_size images are waiting, and run as one batch on a worker thread. Each
+    caller gets back the features of its own images. At most max_queue_depth requests wait
+    at a time, beyond which requests fail straight away with InferenceQueueFullError.
+    """
+    def __init__(self, extract_features, max_batch_size=16, max_wait_ms=5, max_queue_depth=64):
+        self.extract_features_function = extract_features
+        self.max_batch_size = max_batch_size
+        self.max_wait_ms = max_wait_ms
+        self.requests = queue.Queue(maxsize=max_queue_depth)
+        self.worker = None
+        self.stopped = threading.Event()
+
+    def start(self):
+        if self.worker is None or not self.worker.is_alive():
+            self.stopped.clear()
+            self.worker = threading.Thread(target=self.__run, name='inference-queue', daemon=True)
+            self.worker.start()
+        return self
+
+    def stop(self):
+        self.stopped.set()
+        if self.worker is not None:
+            self.worker.join()
+            self.worker = None
+
+    def submit(self, images):
+        """Queue a batch of images for feature extraction.
+        Args:
+            images (np.ndarray): Image array of shape (N, H, W, 3)
+
+        Returns:
+            future (concurrent.futures.Future): Resolves to the feature array of shape (N, D)
+        """
+        future = Future()
+        try:
+            self.requests.put_nowait((images, future))
+        except queue.Full:
+            raise InferenceQueueFullError("Inference queue is full with {} waiting requests!".format(self.requests.maxsize))
+        return future
+
+    def extract_features(self, images, timeout=None):
+        """Extract the features of a batch of images, batched with any concurrent requests.
+        Args:
+            images (np.ndarray): Image array of shape (N, H, W, 3)
+            timeout (float): Seconds to wait for the result, waits indefinitely if None
+
+        Returns:
+            features (np.ndarray): Feature array of shape (N, D)
+        """
+        return self.submit(images).result(timeout=timeout)
+
+    def __next_batch(self):
+        """Block for the first request, then collect requests until the batch is full or max_wait_ms passed.
+        """
+        try:
+            batch = [self.requests.get(timeout=0.1)]
+        except queue.Empty:
+            return []
+        num_images = batch[0][0].shape[0]
+        deadline = time.monotonic() + self.max_wait_ms / 1000
+        while num_images < self.max_batch_size:
+            remaining_time = deadline - time.monotonic()
+            if remaining_time <= 0:
+                break
+            try:
+                request = self.requests.get(timeout=remaining_time)
+            except queue.Empty:
+                break
+            batch.append(request)
+            num_images += request[0].shape[0]
+        return batch
+
+    def __run(self):
+        while not self.stopped.is_set():
+            batch = self.__next_batch()
+            # Requests can only share a forward pass if their images have the same shape
+            batch_groups = OrderedDict()
+            for images, future in batch:
+                if future.set_running_or_notify_cancel():
+                    batch_groups.setdefault(images.shape[1:], []).append((images, future))
+            for requests in batch_groups.values():
+                try:
+                    features = self.extract_features_function(np.concatenate([images for images, _ in requests], axis=0))
+                except Exception as e:
+                    for _, future in requests:
+                        future.set_exception(e)
+                    continue
+                split_indexes = np.cumsum([images.shape[0] for images, _ in requests])[:-1]
+                for (_, future), request_features in zip(requests, np.split(features, split_indexes)):
+                    future.set_result(request_features)
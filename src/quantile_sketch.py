@@ -0,0 +1,101 @@
+import numpy as np
+
+
+########################
+# QuantileSketch Class #
+########################
+class QuantileSketch():
+    """Mergeable streaming quantile sketch for bounded non-negative values such as the noise
+    distances of a shell. Normalized features and shell means have a norm of at most 1, so
+    noise distances always lie in [0, 2].
+
+    Values are counted in num_bins equal width bins and quantiles are interpolated linearly
+    within a bin, so the absolute error is bounded by upper_bound / num_bins. Sketches with
+    the same bins are merged by adding their counts, which makes them mergeable across
+    batches and processes.
+    """
+    def __init__(self, num_bins=4096, upper_bound=2.0):
+        self.num_bins = num_bins
+        self.upper_bound = upper_bound
+        self.counts = np.zeros(num_bins, dtype=np.int64)
+        self.count = 0
+        self.total = 0.0
+
+    def __len__(self):
+        return self.count
+
+    @classmethod
+    def from_values(cls, values, num_bins=4096, upper_bound=2.0):
+        sketch = cls(num_bins=num_bins, upper_bound=upper_bound)
+        sketch.add(values)
+        return sketch
+
+    def add(self, values):
+        """Add values to the sketch.
+        Args:
+            values (np.ndarray): Array of values to add
+        """
+        values = np.asarray(values, dtype=np.float64).ravel()
+        bins = np.clip((values / self.upper_bound * self.num_bins).astype(np.int64), 0, self.num_bins - 1)
+        self.counts += np.bincount(bins, minlength=self.num_bins)
+        self.count += values.shape[0]
+        self.total += float(np.sum(values))
+
+    def merge(self, other):
+        """Merge another sketch with the same bins into this sketch.
+        Args:
+            other (QuantileSketch): Sketch to merge
+        """
+        if other.num_bins != self.num_bins or other.upper_bound != self.upper_bound:
+            raise ValueError("Sketches can only be merged if they share the same bins!")
+        self.counts += other.counts
+        self.count += other.count
+        self.total += other.total
+
+    def mean(self):
+        return self.total / self.count
+
+    def cdf(self, values):
+        """Fraction of values in the sketch smaller than the given values, interpolated within bins.
+        """
+        values = np.clip(np.asarray(values, dtype=np.float64), 0, self.upper_bound)
+        cumulative_counts = np.concatenate([[0], np.cumsum(self.counts)])
+        positions = values / self.upper_bound * self.num_bins
+        bins = np.minimum(positions.astype(np.int64), self.num_bins - 1)
+        fractions = positions - bins
+        return (cumulative_counts[bins] + fractions * self.counts[bins]) / self.count
+
+    def quantile(self, q):
+        """Value below which a fraction q of the values in the sketch lie.
+        Args:
+            q (float): Quantile between 0 and 1
+
+        Returns:
+            value (float): Estimated quantile
+        """
+        cumulative_counts = np.cumsum(self.counts)
+        rank = q * self.count
+        bin_index = min(int(np.searchsorted(cumulative_counts, rank)), self.num_bins - 1)
+        previous_count = cumulative_counts[bin_index - 1] if bin_index > 0 else 0
+        fraction = (rank - previous_count) / self.counts[bin_index] if self.counts[bin_index] > 0 else 0.0
+        return (bin_index + fraction) * self.upper_bound / self.num_bins
+
+    def median_absolute_deviation(self, center, num_iterations=50):
+        """Median of the absolute deviation of the values in the sketch from a center.
+            Solved by bisection on the radius whose interval around center holds half the values.
+        Args:
+            center (float): Center to measure the absolute deviations from
+            num_iterations (int): Number of bisection steps
+
+        Returns:
+            value (float): Estimated median absolute deviation
+        """
+        low, high = 0.0, self.upper_bound
+        for _ in range(num_iterations):
+            radius = (low + high) / 2
+            lower_cdf, upper_cdf = self.cdf([center - radius, center + radius])
+            if upper_cdf - lower_cdf < 0.5:
+                low = radius
+            else:
+                high = radius
+        return (low + high) / 2
@@ -0,0 +1,100 @@
+from PIL import Image
+
+import numpy as np
+import tensorflow as tf
+
+QUANTIZATION_MODES = ('int8', 'float16')
+
+
+#######################################
+# Post-Training Quantization (TFLite) #
+#######################################
+def split_quantized_feature_extractor_model(feature_extractor_model):
+    """Split a feature extractor name such as 'resnet50_int8' into its backbone and quantization mode.
+    Returns:
+        backbone (str): Backbone name
+        quantization_mode (str): One of QUANTIZATION_MODES, None if the name is not a quantized variant
+    """
+    backbone, _, quantization_mode = feature_extractor_model.rpartition('_')
+    if backbone and quantization_mode in QUANTIZATION_MODES:
+        return backbone, quantization_mode
+    return feature_extractor_model, None
+
+
+def load_calibration_images(image_paths, target_size):
+    """Load and resize the images used to calibrate and evaluate a quantized feature extractor.
+        Images that cannot be read are skipped.
+    Args:
+        image_paths (list): Paths of stored images
+        target_size (int): Height and width to resize the images to
+
+    Returns:
+        images (np.ndarray): uint8 image array of shape (N, target_size, target_size, 3)
+    """
+    images = []
+    for image_path in image_paths:
+        try:
+            images.append(np.array(Image.open(image_path).convert("RGB").resize((target_size, target_size))))
+        except (IOError, OSError):
+            continue
+    return np.array(images, dtype=np.uint8).reshape((-1, target_size, target_size, 3))
+
+
+def convert_to_tflite(model, quantization_mode, target_size, calibration_images=None):
+    """Convert a Keras feature extractor with TFLite post-training quantization. Inputs are float32
+        pixel values in [0, 255] and outputs float32 features, with the backbone's preprocessing
+        converted along with the rest of the graph.
+    Args:
+        model (tf.keras.Model): Float feature extractor taking uint8 images
+        quantization_mode (str): 'int8' for full integer quantization calibrated on calibration_images,
+            or 'float16' for float16 weights
+        target_size (int): Height and width of the model's input images
+        calibration_images (np.ndarray): uint8 image array of shape (N, target_size, target_size, 3), required for int8
+
+    Returns:
+        model_content (bytes): Serialized TFLite model
+    """
+    # TFLite needs static spatial dimensions. The layers after the uint8 input are reused on a float32
+    # input, since the uint8 to float32 cast in front of the preprocessing does not quantize
+    inputs = tf.keras.Input(shape=(target_size, target_size, 3))
+    outputs = inputs
+    for layer in model.layers[1:]:
+        outputs = layer(outputs)
+    fixed_input_model = tf.keras.Model(inputs, outputs)
+    converter = tf.lite.TFLiteConverter.from_keras_model(fixed_input_model)
+    converter.optimizations = [tf.lite.Optimize.DEFAULT]
+    if quantization_mode == 'int8':
+        if calibration_images is None or calibration_images.shape[0] == 0:
+            raise ValueError("int8 quantization needs calibration images!")
+        def representative_dataset():
+            for calibration_image in calibration_images:
+                yield [np.array(calibration_image[np.newaxis], dtype=np.float32)]
+        converter.representative_dataset = representative_dataset
+        converter.target_spec.supported_ops = [tf.lite.OpsSet.TFLITE_BUILTINS_INT8]
+    elif quantization_mode == 'float16':
+        converter.target_spec.supported_types = [tf.float16]
+    else:
+        raise ValueError("Quantization mode not found! Please enter the following modes: {}".format(QUANTIZATION_MODES))
+    return converter.convert()
+
+
+def feature_drift_report(reference_features, quantized_features):
+    """Compare the pooled features of a quantized feature extractor against the float model on the same images.
+    Args:
+        reference_features (np.ndarray): Float model feature array of shape (N, D)
+        quantized_features (np.ndarray): Quantized model feature array of shape (N, D)
+
+    Returns:
+        report (dict): Cosine similarity and relative L2 error statistics over the images
+    """
+    reference_features = reference_features.astype(np.float64)
+    quantized_features = quantized_features.astype(np.float64)
+    reference_norms = np.linalg.norm(reference_features, axis=1)
+    quantized_norms = np.linalg.norm(quantized_features, axis=1)
+    cosine_similarities = np.einsum('ij,ij->i', reference_features, quantized_features) / np.maximum(reference_norms * quantized_norms, np.finfo(np.float64).tiny)
+    relative_errors = np.linalg.norm(quantized_features - reference_features, axis=1) / np.maximum(reference_norms, np.finfo(np.float64).tiny)
+    return {'num_images': int(reference_features.shape[0]),
+            'mean_cosine_similarity': float(np.mean(cosine_similarities)),
+            'min_cosine_similarity': float(np.min(cosine_similarities)),
+            'mean_relative_error': float(np.mean(relative_errors)),
+            'max_relative_error': float(np.max(relative_errors))}
@@ -157,7 +157,8 @@ class ShellFamily():
                 # Generate class features
                 indexes = np.where(classes == class_index)
                 target_images = images[indexes]
-                class_features = self.preprocessor.predict(target_images)
+                # Image generators yield uint8 images, apply the backbone's own preprocessing
+                class_features = self.preprocessor.predict(self.preprocessor_preprocess_function(target_images.astype(np.float32)))
                 # Update shell family params
                 if self.global_mean is None:
                     self.global_mean = np.mean(class_features,
@@ -0,0 +1,124 @@
+import numpy as np
+
+
+#####################
+# Shell Index Class #
+#####################
+class ShellIndex():
+    """Clustered inverted-file index over the normalized shell means of a shell family.
+
+    Shell means are grouped into num_lists clusters with k-means. A query only visits the
+    shells in its num_probes closest clusters, so num_probes is the recall/latency knob:
+    num_probes == num_lists is exhaustive while num_probes == 1 is the fastest.
+    """
+    def __init__(self, num_lists=None, num_probes=1, num_iterations=10, rebuild_ratio=0.5, seed=0):
+        self.num_lists = num_lists
+        self.num_probes = num_probes
+        self.num_iterations = num_iterations
+        # Fraction of shells added or moved to another cluster since the last build before the clusters are retrained
+        self.rebuild_ratio = rebuild_ratio
+        self.seed = seed
+        self.centroids = None
+        self.centroids_squared_norms = None
+        self.inverted_lists = []
+        self.assignments = {}
+        self.updates_since_build = 0
+
+    def __len__(self):
+        return len(self.assignments)
+
+    def build(self, shell_names, shell_means):
+        """Train the cluster centroids with k-means and assign every shell to its closest cluster.
+        Args:
+            shell_names (list): Shell names in the same order as shell_means
+            shell_means (np.ndarray): Normalized shell mean array of shape (C, D)
+        """
+        num_shells = shell_means.shape[0]
+        num_lists = self.num_lists if self.num_lists is not None else int(np.ceil(np.sqrt(num_shells)))
+        num_lists = max(1, min(num_lists, num_shells))
+        random_state = np.random.RandomState(self.seed)
+        centroids = shell_means[random_state.choice(num_shells, num_lists, replace=False)].astype(np.float64)
+        for _ in range(self.num_iterations):
+            labels = self.__closest_centroids(shell_means, centroids)
+            counts = np.bincount(labels, minlength=num_lists)
+            sums = np.zeros_like(centroids)
+            np.add.at(sums, labels, shell_means)
+            # Keep the previous centroid for clusters that lost all of their shells
+            non_empty = counts > 0
+            centroids[non_empty] = sums[non_empty] / counts[non_empty, np.newaxis]
+        self.centroids = centroids.astype(shell_means.dtype)
+        self.centroids_squared_norms = np.einsum('ij,ij->i', self.centroids, self.centroids)
+        self.inverted_lists = [set() for _ in range(num_lists)]
+        self.assignments = {}
+        labels = self.__closest_centroids(shell_means, self.centroids)
+        for shell_name, label in zip(shell_names, labels):
+            self.inverted_lists[label].add(shell_name)
+            self.assignments[shell_name] = label
+        self.updates_since_build = 0
+
+    def update(self, shell_names, shell_means, all_shell_names=None, all_shell_means=None):
+        """Reassign new or changed shells to their closest cluster without retraining. Only shells
+            that are new or land in another cluster count towards the rebuild, so refitting shells
+            whose means barely move keeps the index incremental. If all shells are given and too
+            many shells moved since the last build, the clusters are retrained instead.
+        Args:
+            shell_names (list): Names of the shells that are new or whose means changed
+            shell_means (np.ndarray): Normalized shell mean array of shape (len(shell_names), D)
+            all_shell_names (list): Names of every shell in the family
+            all_shell_means (np.ndarray): Normalized shell means of every shell in the family
+        """
+        if len(shell_names) == 0:
+            return
+        if all_shell_names is None:
+            all_shell_names, all_shell_means = shell_names, shell_means
+        if self.centroids is None:
+            self.build(all_shell_names, all_shell_means)
+            return
+        labels = self.__closest_centroids(shell_means, self.centroids)
+        moved_shells = [(shell_name, label) for shell_name, label in zip(shell_names, labels) if self.assignments.get(shell_name) != label]
+        self.updates_since_build += len(moved_shells)
+        if self.updates_since_build > self.rebuild_ratio * len(all_shell_names):
+            self.build(all_shell_names, all_shell_means)
+            return
+        for shell_name, label in moved_shells:
+            if shell_name in self.assignments:
+                self.inverted_lists[self.assignments[shell_name]].discard(shell_name)
+            self.inverted_lists[label].add(shell_name)
+            self.assignments[shell_name] = label
+
+    def remove(self, shell_names):
+        """Remove shells from the index.
+        Args:
+            shell_names (list): Names of the shells to remove
+        """
+        for shell_name in shell_names:
+            if shell_name in self.assignments:
+                self.inverted_lists[self.assignments.pop(shell_name)].discard(shell_name)
+
+    def search(self, normalized_feat, num_probes=None, min_candidates=0):
+        """Find the candidate shells in the clusters closest to a query. Past the num_probes closest
+            clusters, the next closest ones are visited until at least min_candidates shells are found.
+        Args:
+            normalized_feat (np.ndarray): Normalized feature array of shape (1, D)
+            num_probes (int): Number of closest clusters to visit, defaults to self.num_probes
+            min_candidates (int): Smallest number of candidate shells to return, if the index holds that many
+
+        Returns:
+            candidate_shell_names (list): Names of the shells in the visited clusters
+        """
+        num_probes = self.num_probes if num_probes is None else num_probes
+        num_probes = max(1, min(num_probes, len(self.inverted_lists)))
+        squared_distances = self.centroids_squared_norms - 2 * np.dot(self.centroids, normalized_feat[0])
+        candidate_shell_names = []
+        for num_probed_lists, list_index in enumerate(np.argsort(squared_distances, kind='stable')):
+            if num_probed_lists >= num_probes and len(candidate_shell_names) >= min_candidates:
+                break
+            candidate_shell_names.extend(self.inverted_lists[list_index])
+        return candidate_shell_names
+
+    @staticmethod
+    def __closest_centroids(shell_means, centroids):
+        """Find the closest centroid of every shell mean using the GEMM distance expansion.
+        """
+        squared_distances = np.einsum('ij,ij->i', centroids, centroids)[np.newaxis, :] - 2 * np.dot(shell_means, centroids.T)
+        return np.argmin(squared_distances, axis=1)
@@ -0,0 +1,227 @@
+import os
+import atexit
+import tempfile
+import threading
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+import numpy as np
+
+SHARED_FEATURES_SUFFIX = '.refit'
+# Process pool kept for the life of the application, see get_refit_executor
+_REFIT_EXECUTOR = None
+_REFIT_EXECUTOR_WORKERS = 0
+_REFIT_EXECUTOR_LOCK = threading.Lock()
+
+
+##############################
+# Segmented Shell Statistics #
+##############################
+def segment_offsets(counts):
+    """Create segment offsets from the number of features in each segment.
+    Args:
+        counts (list): Number of features in each segment
+
+    Returns:
+        offsets (np.ndarray): Array of shape (C + 1,) where segment i spans offsets[i]:offsets[i + 1]
+    """
+    return np.concatenate([[0], np.cumsum(counts)]).astype(np.int64)
+
+
+def segmented_medians(values, offsets):
+    """Compute the median of every segment of a 1D array with a single partition.
+        Values are shifted by their segment index times a span larger than their range, so
+        that one np.partition call over every segment's middle ranks yields all medians.
+    Args:
+        values (np.ndarray): Non-negative value array of shape (N,)
+        offsets (np.ndarray): Segment offsets of shape (C + 1,)
+
+    Returns:
+        medians (np.ndarray): Median of each segment of shape (C,)
+    """
+    counts = np.diff(offsets)
+    segment_ids = np.repeat(np.arange(counts.shape[0]), counts)
+    span = float(np.max(values)) + 1.0
+    keys = values.astype(np.float64) + segment_ids * span
+    lower_ranks = offsets[:-1] + (counts - 1) // 2
+    upper_ranks = offsets[:-1] + counts // 2
+    partitioned = np.partition(keys, np.unique(np.concatenate([lower_ranks, upper_ranks])))
+    segment_shifts = np.arange(counts.shape[0]) * span
+    return (partitioned[lower_ranks] + partitioned[upper_ranks]) / 2 - segment_shifts
+
+
+def segmented_shell_statistics(features, offsets, global_mean):
+    """Compute the parameters of every shell in one vectorized pass. Equivalent to fitting
+        each shell on its own segment of features with ShellModel.fit.
+    Args:
+        features (np.ndarray or list): Raw feature array of shape (N, D) where shell i owns rows
+            offsets[i]:offsets[i + 1], or a list with the raw feature array of each shell
+        offsets (np.ndarray): Segment offsets of shape (C + 1,)
+        global_mean (np.ndarray): Global mean of shape (1, D)
+
+    Returns:
+        statistics (dict): Arrays with one entry per shell for shell_means, noise_means, noise_stds,
+            noise_distance_means, min_centered_norms and num_instances, plus the noise distances
+            of every feature in noise_distances. Shells without features are left unfitted with
+            NaN parameters and num_instances of 0.
+    """
+    offsets = np.asarray(offsets, dtype=np.int64)
+    counts = np.diff(offsets)
+    if np.any(counts <= 0):
+        return _non_empty_segmented_shell_statistics(features, counts, global_mean)
+    segment_starts = offsets[:-1]
+    segment_ids = np.repeat(np.arange(counts.shape[0]), counts)
+    # One working buffer holds the centered, then normalized, then shell centered features
+    if isinstance(features, np.ndarray):
+        working_features = features - global_mean
+    else:
+        working_features = np.empty((offsets[-1], global_mean.shape[1]), dtype=np.result_type(features[0], global_mean))
+        for segment_index, segment_features in enumerate(features):
+            np.subtract(segment_features, global_mean, out=working_features[offsets[segment_index] : offsets[segment_index + 1]])
+    centered_norms = np.sqrt(np.einsum('ij,ij->i', working_features, working_features))
+    working_features /= centered_norms[:, np.newaxis]
+    shell_means = np.add.reduceat(working_features, segment_starts, axis=0) / counts[:, np.newaxis]
+    shell_means = shell_means.astype(working_features.dtype)
+    # Shell center each segment in place rather than through an N x D gather of the shell means
+    for segment_index in range(counts.shape[0]):
+        working_features[offsets[segment_index] : offsets[segment_index + 1]] -= shell_means[segment_index]
+    noise_distances = np.sqrt(np.einsum('ij,ij->i', working_features, working_features))
+    noise_distance_means = np.add.reduceat(noise_distances.astype(np.float64), segment_starts) / counts
+    noise_means = segmented_medians(noise_distances, offsets)
+    noise_stds = segmented_medians(np.absolute(noise_distances - noise_distance_means[segment_ids]), offsets)
+    return {'shell_means': shell_means,
+            'noise_means': noise_means,
+            'noise_stds': noise_stds,
+            'noise_distance_means': noise_distance_means,
+            'min_centered_norms': np.minimum.reduceat(centered_norms, segment_starts),
+            'num_instances': counts,
+            'noise_distances': noise_distances}
+
+
+def _non_empty_segmented_shell_statistics(features, counts, global_mean):
+    """Compute segmented_shell_statistics over the segments holding features only and fill the
+        parameters of the empty segments with NaN.
+    """
+    non_empty = counts > 0
+    num_segments = counts.shape[0]
+    if not isinstance(features, np.ndarray):
+        features = [segment_features for segment_features, has_features in zip(features, non_empty) if has_features]
+    if np.any(non_empty):
+        non_empty_statistics = segmented_shell_statistics(features, segment_offsets(counts[non_empty]), global_mean)
+    else:
+        feature_dtype = np.result_type(np.float32, global_mean)
+        non_empty_statistics = {'shell_means': np.empty((0, global_mean.shape[1]), dtype=feature_dtype),
+                                'noise_means': np.empty(0),
+                                'noise_stds': np.empty(0),
+                                'noise_distance_means': np.empty(0),
+                                'min_centered_norms': np.empty(0, dtype=feature_dtype),
+                                'noise_distances': np.empty(0, dtype=feature_dtype)}
+    statistics = {'num_instances': counts, 'noise_distances': non_empty_statistics['noise_distances']}
+    for key in ['shell_means', 'noise_means', 'noise_stds', 'noise_distance_means', 'min_centered_norms']:
+        values = non_empty_statistics[key]
+        statistics[key] = np.full((num_segments,) + values.shape[1:], np.nan, dtype=values.dtype)
+        statistics[key][non_empty] = values
+    return statistics
+
+
+def get_refit_executor(num_workers):
+    """Get the process pool shared by every parallel refit, created on first use and kept until
+        the application exits. Workers are spawned rather than forked so they never inherit the
+        threads and TensorFlow state of the application.
+    Args:
+        num_workers (int): Number of worker processes
+
+    Returns:
+        executor (concurrent.futures.ProcessPoolExecutor): Process pool with num_workers workers
+    """
+    global _REFIT_EXECUTOR, _REFIT_EXECUTOR_WORKERS
+    with _REFIT_EXECUTOR_LOCK:
+        if _REFIT_EXECUTOR is None or _REFIT_EXECUTOR_WORKERS != num_workers:
+            if _REFIT_EXECUTOR is not None:
+                _REFIT_EXECUTOR.shutdown(wait=True)
+            _REFIT_EXECUTOR = ProcessPoolExecutor(max_workers=num_workers, mp_context=multiprocessing.get_context('spawn'))
+            _REFIT_EXECUTOR_WORKERS = num_workers
+        return _REFIT_EXECUTOR
+
+
+def shutdown_refit_executor():
+    """Shut down the process pool of get_refit_executor, a later refit creates a new one.
+    """
+    global _REFIT_EXECUTOR, _REFIT_EXECUTOR_WORKERS
+    with _REFIT_EXECUTOR_LOCK:
+        if _REFIT_EXECUTOR is not None:
+            _REFIT_EXECUTOR.shutdown(wait=False)
+        _REFIT_EXECUTOR = None
+        _REFIT_EXECUTOR_WORKERS = 0
+
+
+atexit.register(shutdown_refit_executor)
+
+
+def parallel_segmented_shell_statistics(features, offsets, global_mean, num_workers, shared_features_directory=None):
+    """Compute segmented_shell_statistics with the shells sharded across the worker processes of
+        get_refit_executor. Features are shared through a memory-mapped file instead of being
+        pickled to workers.
+    Args:
+        features (np.ndarray or list): Raw feature array of shape (N, D), a np.memmap backed by a
+            file, or a list with the raw feature array of each shell, None for shells without features
+        offsets (np.ndarray): Segment offsets of shape (C + 1,)
+        global_mean (np.ndarray): Global mean of shape (1, D)
+        num_workers (int): Number of worker processes
+        shared_features_directory (str): Directory of the memory-mapped file, the system temporary
+            directory if None. Use a directory on disk with room for N x D features rather than a
+            size limited RAM backed one such as /dev/shm in containers.
+
+    Returns:
+        statistics (dict): Same as segmented_shell_statistics
+    """
+    offsets = np.asarray(offsets, dtype=np.int64)
+    num_shards = min(num_workers, offsets.shape[0] - 1)
+    if num_shards <= 1:
+        return segmented_shell_statistics(features, offsets, global_mean)
+    # Split the shells into contiguous shards holding roughly the same number of features
+    shard_boundaries = np.unique(np.searchsorted(offsets, np.linspace(0, offsets[-1], num_shards + 1)[1:-1]))
+    shard_boundaries = np.concatenate([[0], shard_boundaries[(shard_boundaries > 0) & (shard_boundaries < offsets.shape[0] - 1)], [offsets.shape[0] - 1]])
+    shared_features_file = None
+    try:
+        if isinstance(features, np.memmap) and features.filename is not None and features.offset == 0:
+            shared_features = features
+        else:
+            feature_dimension = global_mean.shape[1]
+            feature_dtype = features.dtype if isinstance(features, np.ndarray) else next((segment_features.dtype for segment_features in features if segment_features is not None), np.float32)
+            shared_features_file = tempfile.NamedTemporaryFile(suffix=SHARED_FEATURES_SUFFIX, dir=shared_features_directory, delete=False)
+            shared_features_file.close()
+            shared_features = np.memmap(shared_features_file.name, dtype=feature_dtype, mode='w+', shape=(int(offsets[-1]), feature_dimension))
+            if isinstance(features, np.ndarray):
+                shared_features[:] = features
+            else:
+                for segment_index, segment_features in enumerate(features):
+                    if offsets[segment_index + 1] > offsets[segment_index]:
+                        shared_features[offsets[segment_index] : offsets[segment_index + 1]] = segment_features
+            shared_features.flush()
+        shard_arguments = [(shared_features.filename,
+                            shared_features.dtype.str,
+                            shared_features.shape,
+                            offsets[shard_boundaries[shard] : shard_boundaries[shard + 1] + 1],
+                            global_mean) for shard in range(len(shard_boundaries) - 1)]
+        try:
+            shard_statistics = list(get_refit_executor(num_workers).map(_shard_segmented_shell_statistics, shard_arguments))
+        except BrokenProcessPool:
+            # A worker died, for example killed for running out of memory, retry once on a new pool
+            shutdown_refit_executor()
+            shard_statistics = list(get_refit_executor(num_workers).map(_shard_segmented_shell_statistics, shard_arguments))
+    finally:
+        if shared_features_file is not None:
+            os.remove(shared_features_file.name)
+    return {key: np.concatenate([statistics[key] for statistics in shard_statistics]) for key in shard_statistics[0]}
+
+
+def _shard_segmented_shell_statistics(arguments):
+    """Worker for parallel_segmented_shell_statistics. Maps the shared features read only and
+        computes the statistics of one contiguous shard of shells.
+    """
+    filename, dtype, shape, shard_offsets, global_mean = arguments
+    shared_features = np.memmap(filename, dtype=np.dtype(dtype), mode='r', shape=shape)
+    shard_features = shared_features[shard_offsets[0] : shard_offsets[-1]]
+    return segmented_shell_statistics(shard_features, shard_offsets - shard_offsets[0], global_mean)
@@ -8,38 +8,173 @@ sys.path.append(os.path.dirname(__file__))
 import numpy as np
 from tqdm import tqdm
 from sklearn.svm import OneClassSVM
-from tensorflow.keras.applications.vgg16 import VGG16
-from tensorflow.keras.applications.vgg16 import preprocess_input as vgg16_preprocess_input
-from tensorflow.keras.applications.resnet50 import ResNet50
-from tensorflow.keras.applications.resnet50 import preprocess_input as resnet50_preprocess_input
-from tensorflow.keras.applications import MobileNet
-from tensorflow.keras.applications.mobilenet import preprocess_input as mobilenet_preprocess_input
-from tensorflow.keras.layers import GlobalAvgPool2D
-from tensorflow.keras import Model, Sequential
-from tensorflow.keras.preprocessing import image
 
 from utils import normalize
 from utils import sorted_neighbors_of_i
 # from utils import evaluate
 from utils import fit_to_list
+from shell_index import ShellIndex
+from quantile_sketch import QuantileSketch
+from shell_statistics import segment_offsets, segmented_shell_statistics, parallel_segmented_shell_statistics
+from feature_store import FeatureStore
 
-ACCEPTED_PREPROCESSORS = ("vgg16", "resnet50", "mobilenet")
-PREPROCESSORS_PREPROCESS_FUNCTIONS = {'vgg16': vgg16_preprocess_input,
-                                      'resnet50': resnet50_preprocess_input,
-                                      'mobilenet': mobilenet_preprocess_input}
+# Step sizes of the online median estimates in units of noise_std / num_instances. Adding one sample
+# moves a sample median by about 1 / (2 * n * density at the median), which for roughly normal
+# distances is 1.86 MAD / n for the median distance and 1.17 MAD / n for the MAD itself.
+ONLINE_NOISE_MEAN_STEP = 1.86
+ONLINE_NOISE_STD_STEP = 1.17
+# Standard errors of noise_mean and noise_std fit on a uniform sample of n of a shell's N features in units
+# of noise_std * sqrt((1 - n / N) / n). For roughly normal distances the sample median has a standard error
+# of sqrt(pi / 2) * 1.4826 = 1.86 MAD / sqrt(n) and the sample MAD one of 1.73 MAD / sqrt(n).
+SAMPLED_NOISE_MEAN_STANDARD_ERROR = 1.86
+SAMPLED_NOISE_STD_STANDARD_ERROR = 1.73
 # assumes data has been pre-normalized
 class ShellModel:
     """Creates a shell for one class mean.
     """
     def __init__(self):
         self.shell_id = None
-        self.raw_features = None
+        # raw_features is backed by a growable buffer so that appending is amortized O(d)
+        self.raw_features_buffer = None
+        self.raw_features_count = 0
+        # Optional FeatureStore holding raw_features on disk instead of raw_features_buffer
+        self.feature_store = None
+        # Optional cap on the number of raw features kept. Beyond it raw_features is a uniform reservoir
+        # sample of every feature seen while feature_sum and feature_count stay exact
+        self.raw_features_capacity = None
+        self.reservoir_random_state = None
+        self.feature_sum = None
+        self.feature_count = 0
+        # Standard errors of the parameters fit on a reservoir sample, see sampling_error
+        self.sampling_error = None
         self.shell_mean = None
         self.num_instances = None
         self.noise_mean = None
         self.noise_std = None
         self.created_at = None
         self.updated_at = None
+        # Incremented whenever the shell parameters change so that packed copies can be invalidated
+        self.version = 0
+        # Running mean of the noise distances and online update bookkeeping
+        self.noise_distance_mean = None
+        self.online_updates_since_refit = 0
+        # Optional streaming sketch of the noise distances, see refresh_noise_from_sketch
+        self.noise_sketch = None
+        # Global mean at the last exact fit and the smallest distance of a raw feature from it,
+        # used to bound how far the shell parameters drift as the global mean moves
+        self.fit_global_mean = None
+        self.min_centered_norm = None
+
+    def __setstate__(self, state):
+        """Restore a pickled shell. Shells pickled by older versions have none of the attributes
+            added since and keep raw_features as a plain array, which is moved to the buffer.
+        """
+        legacy_raw_features = state.pop('raw_features', None)
+        self.__init__()
+        self.__dict__.update(state)
+        if legacy_raw_features is not None:
+            self.raw_features = legacy_raw_features
+
+    @property
+    def raw_features(self):
+        if self.feature_store is not None:
+            return self.feature_store.read(self.shell_id)
+        if self.raw_features_buffer is None:
+            return None
+        return self.raw_features_buffer[:self.raw_features_count]
+
+    @raw_features.setter
+    def raw_features(self, features):
+        self.feature_sum = None if features is None else np.sum(features, axis=0, keepdims=True, dtype=np.float64)
+        self.feature_count = 0 if features is None else features.shape[0]
+        if features is not None and self.raw_features_capacity is not None and features.shape[0] > self.raw_features_capacity:
+            # A uniform sample without replacement is a valid reservoir of the features
+            sample = np.sort(self.__reservoir_random_state().choice(features.shape[0], self.raw_features_capacity, replace=False))
+            features = features[sample]
+        if self.feature_store is not None:
+            if features is None:
+                self.feature_store.delete(self.shell_id)
+            else:
+                self.feature_store.write(self.shell_id, features)
+            self.raw_features_count = self.feature_store.count(self.shell_id)
+            return
+        self.raw_features_buffer = features
+        self.raw_features_count = 0 if features is None else features.shape[0]
+
+    def attach_feature_store(self, feature_store):
+        """Keep raw_features in a FeatureStore, memory mapped on read. Features already held in
+            memory are moved to the store, otherwise the features stored for shell_id are used.
+        """
+        features = self.raw_features if self.feature_store is None else None
+        self.feature_store = feature_store
+        self.raw_features_buffer = None
+        if features is not None:
+            feature_store.write(self.shell_id, features)
+        self.raw_features_count = feature_store.count(self.shell_id)
+        if features is None:
+            # Stored features are taken as every feature of the shell, restore feature_sum and
+            # feature_count afterwards for a shell whose store holds a reservoir sample
+            self.feature_sum = None if self.raw_features_count == 0 else np.sum(self.raw_features, axis=0, keepdims=True, dtype=np.float64)
+            self.feature_count = self.raw_features_count
+
+    def append_raw_features(self, features, capacity=None):
+        """Append features to raw_features, growing the underlying buffer geometrically.
+            If the final number of features is known, pass it as capacity to allocate once.
+            Once raw_features_capacity features are kept, new features replace kept ones
+            with reservoir sampling so raw_features stays a uniform sample.
+        """
+        features_sum = np.sum(features, axis=0, keepdims=True, dtype=np.float64)
+        self.feature_sum = features_sum if self.feature_sum is None else self.feature_sum + features_sum
+        previous_count = self.feature_count
+        self.feature_count += features.shape[0]
+        if self.raw_features_capacity is None:
+            self.__append_kept_raw_features(features, capacity)
+            return
+        num_kept = max(0, min(features.shape[0], self.raw_features_capacity - previous_count))
+        if num_kept > 0:
+            self.__append_kept_raw_features(features[:num_kept], capacity if capacity is None else min(capacity, self.raw_features_capacity))
+        self.__replace_sampled_raw_features(features[num_kept:], previous_count + num_kept)
+
+    def __append_kept_raw_features(self, features, capacity):
+        if self.feature_store is not None:
+            self.feature_store.append(self.shell_id, features)
+            self.raw_features_count += features.shape[0]
+            return
+        required_count = self.raw_features_count + features.shape[0]
+        if self.raw_features_buffer is None:
+            self.raw_features_buffer = np.empty((max(required_count, capacity or 0),) + features.shape[1:], dtype=features.dtype)
+        elif required_count > self.raw_features_buffer.shape[0]:
+            new_buffer = np.empty((max(required_count, 2 * self.raw_features_buffer.shape[0], capacity or 0),) + self.raw_features_buffer.shape[1:],
+                                  dtype=self.raw_features_buffer.dtype)
+            new_buffer[:self.raw_features_count] = self.raw_features
+            self.raw_features_buffer = new_buffer
+        self.raw_features_buffer[self.raw_features_count : required_count] = features
+        self.raw_features_count = required_count
+
+    def __replace_sampled_raw_features(self, features, num_seen):
+        """Reservoir sampling step for features arriving after the reservoir is full, where
+            num_seen features were seen before the first of them.
+        """
+        if features.shape[0] == 0:
+            return
+        # Feature i of the batch is the (num_seen + i + 1)th feature seen and takes a uniformly random
+        # slot of those seen so far, so it is only kept if the slot falls inside the reservoir
+        slots = (self.__reservoir_random_state().random_sample(features.shape[0]) * (num_seen + 1 + np.arange(features.shape[0]))).astype(np.int64)
+        kept = np.flatnonzero(slots < self.raw_features_capacity)
+        if kept.shape[0] == 0:
+            return
+        # When several features take the same slot only the last one remains
+        _, last_kept = np.unique(slots[kept][::-1], return_index=True)
+        kept = kept[kept.shape[0] - 1 - last_kept]
+        if self.feature_store is not None:
+            self.feature_store.update_rows(self.shell_id, slots[kept], features[kept])
+        else:
+            self.raw_features_buffer[slots[kept]] = features[kept]
+
+    def __reservoir_random_state(self):
+        if self.reservoir_random_state is None:
+            self.reservoir_random_state = np.random.RandomState()
+        return self.reservoir_random_state
 
     def fit(self, global_mean):
         """Generate the shell parameters based on the global mean the shell family currently sees
@@ -49,16 +184,97 @@ class ShellModel:
     def __generate_one_class_mean(self, global_mean):
         """Generate the one class mean which is the 'center' of the shell along with its 'diameter'
         """
-        normalized_features, _ = normalize(self.raw_features, global_mean)
+        # Same as normalize but keeps the norms to record the distance of the features from global_mean
+        centered_features = self.raw_features - global_mean
+        centered_norms = np.linalg.norm(centered_features, axis=1, keepdims=True)
+        normalized_features = centered_features / centered_norms
         normalized_mean = np.mean(normalized_features, axis=0, keepdims=True)
         # normalized_mean = np.mean(self.raw_features, axis=0, keepdims=True)
         # noise = self.raw_features - normalized_mean
         noise = normalized_features - normalized_mean
         noise = np.linalg.norm(noise, axis=1)
-        self.shell_mean = normalized_mean
-        self.num_instances = normalized_features.shape[0]
-        self.noise_mean = np.median(noise)
-        self.noise_std = np.median(np.absolute(noise - np.mean(noise)))
+        self.set_fit_parameters(global_mean,
+                                normalized_mean,
+                                np.median(noise),
+                                np.median(np.absolute(noise - np.mean(noise))),
+                                np.mean(noise),
+                                float(np.min(centered_norms)),
+                                normalized_features.shape[0],
+                                noise)
+
+    def set_fit_parameters(self, global_mean, shell_mean, noise_mean, noise_std, noise_distance_mean, min_centered_norm, num_instances, noise):
+        """Set the parameters of an exact fit, whether computed by this shell or for many shells at once
+        """
+        self.shell_mean = shell_mean
+        # A shell fit on a reservoir sample still counts every feature it has seen
+        self.num_instances = max(num_instances, self.feature_count)
+        self.noise_mean = noise_mean
+        self.noise_std = noise_std
+        self.noise_distance_mean = noise_distance_mean
+        self.online_updates_since_refit = 0
+        self.sampling_error = self.__sampling_error(noise) if self.num_instances > num_instances else None
+        self.__reset_noise_sketch(noise)
+        self.fit_global_mean = np.array(global_mean)
+        self.min_centered_norm = min_centered_norm
+        self.version += 1
+
+    def __sampling_error(self, noise):
+        """Standard errors of shell_mean, noise_mean and noise_std fit on n sampled noise distances
+            instead of all num_instances features, with the finite population correction.
+        """
+        num_sampled = noise.shape[0]
+        scale = np.sqrt((1 - num_sampled / self.num_instances) / num_sampled)
+        return {'num_sampled': num_sampled,
+                'num_instances': self.num_instances,
+                'shell_mean': float(np.sqrt(np.mean(np.square(noise))) * scale),
+                'noise_mean': float(SAMPLED_NOISE_MEAN_STANDARD_ERROR * self.noise_std * scale),
+                'noise_std': float(SAMPLED_NOISE_STD_STANDARD_ERROR * self.noise_std * scale)}
+
+    def score_error_bound(self, global_mean, score_margin=3.0):
+        """Upper bound on how much any score changes if the shell was refit on a new global mean.
+            A global mean drift of delta moves every normalized feature by at most
+            epsilon = 2 * delta / min_centered_norm, hence the shell mean by epsilon, the noise
+            distances and noise_mean by 2 * epsilon and noise_std by 4 * epsilon. For queries
+            within score_margin noise_std of the shell surface the score changes by at most
+            (3 + 4 * score_margin) * epsilon / (noise_std - 4 * epsilon).
+        Args:
+            global_mean (np.ndarray): New global mean of shape (1, D)
+            score_margin (float): Largest absolute score of the queries the bound covers
+
+        Returns:
+            bound (float): Score error bound, infinite if the shell was never fit
+        """
+        if self.fit_global_mean is None:
+            return np.inf
+        drift = np.linalg.norm(global_mean - self.fit_global_mean)
+        epsilon = 2 * drift / self.min_centered_norm if self.min_centered_norm > 0 else np.inf
+        if self.noise_std - 4 * epsilon <= 0:
+            return np.inf
+        return (3 + 4 * score_margin) * epsilon / (self.noise_std - 4 * epsilon)
+
+    def __reset_noise_sketch(self, noise):
+        """Rebuild the noise sketch, if the shell keeps one, from exact noise distances
+        """
+        if self.noise_sketch is not None:
+            self.noise_sketch = QuantileSketch.from_values(noise,
+                                                           num_bins=self.noise_sketch.num_bins,
+                                                           upper_bound=self.noise_sketch.upper_bound)
+
+    def refresh_noise_from_sketch(self):
+        """Set noise_mean and noise_std from the noise sketch instead of the raw features
+        """
+        self.noise_distance_mean = self.noise_sketch.mean()
+        self.noise_mean = self.noise_sketch.quantile(0.5)
+        self.noise_std = self.noise_sketch.median_absolute_deviation(self.noise_distance_mean)
+        self.version += 1
+
+    def merge_noise_sketch(self, noise_sketch):
+        """Merge a noise sketch built elsewhere, such as another batch or process, into the shell
+        """
+        if self.noise_sketch is None:
+            self.noise_sketch = QuantileSketch(num_bins=noise_sketch.num_bins, upper_bound=noise_sketch.upper_bound)
+        self.noise_sketch.merge(noise_sketch)
+        self.refresh_noise_from_sketch()
 
     def score(self, feat, global_mean, with_norm=True):
         """Perform a distance score based on how far a feature is from the shell
@@ -79,21 +295,46 @@ class ShellModel:
         shell_score = (feat_ - self.noise_mean) / self.noise_std
         return shell_score
 
-    def update(self, feat, global_mean):
+    def update(self, feat, global_mean, online=False, refit_interval=None):
         """Perform an update to shell parameter. To be used for 1 data point of feature to
-            update the model.
+            update the model. With online=True the shell mean and noise statistics are updated
+            from running statistics in O(d), with an exact refit every refit_interval updates.
         """
-        self.raw_features = np.concatenate([self.raw_features,
-                                            feat])
-        normalized_features, _ = normalize(self.raw_features, global_mean)
-        self.shell_mean= np.mean(normalized_features,
-                                 axis=0,
-                                 keepdims=True)
-        self.num_instances = normalized_features.shape[0]
-        noise = normalized_features - self.shell_mean
-        noise = np.linalg.norm(noise , axis=1)
-        self.noise_mean = np.median(noise)
-        self.noise_std = np.median(np.absolute(noise - np.mean(noise)))
+        self.append_raw_features(feat)
+        if online and self.shell_mean is not None:
+            self.__online_update(feat, global_mean)
+            self.online_updates_since_refit += 1
+            # Only refit when the full history of the shell, or a reservoir sample of it, is available
+            has_full_history = self.feature_count >= self.num_instances
+            if refit_interval is not None and self.online_updates_since_refit >= refit_interval and has_full_history:
+                self.fit(global_mean)
+            return
+        self.__generate_one_class_mean(global_mean)
+
+    def __online_update(self, feat, global_mean):
+        """Update the shell parameters with new features in O(d) per feature. Features already in
+            the shell are not renormalized against the new global mean, and the medians are tracked
+            with a stochastic approximation, so the result drifts until the next exact refit.
+        """
+        normalized_features, _ = normalize(feat, global_mean)
+        if self.noise_distance_mean is None:
+            self.noise_distance_mean = self.noise_mean
+        distances = []
+        for normalized_feature in normalized_features:
+            self.num_instances += 1
+            self.shell_mean = self.shell_mean + (normalized_feature - self.shell_mean) / self.num_instances
+            distance = np.linalg.norm(normalized_feature - self.shell_mean)
+            distances.append(distance)
+            self.noise_distance_mean += (distance - self.noise_distance_mean) / self.num_instances
+            if self.noise_sketch is None:
+                self.noise_mean += ONLINE_NOISE_MEAN_STEP * self.noise_std / self.num_instances * np.sign(distance - self.noise_mean)
+                absolute_deviation = np.absolute(distance - self.noise_distance_mean)
+                self.noise_std += ONLINE_NOISE_STD_STEP * self.noise_std / self.num_instances * np.sign(absolute_deviation - self.noise_std)
+        # With a noise sketch the medians are read from the sketch instead of being approximated
+        if self.noise_sketch is not None:
+            self.noise_sketch.add(distances)
+            self.refresh_noise_from_sketch()
+        self.version += 1
 
 
 class ShellFamily():
@@ -101,32 +342,98 @@ class ShellFamily():
         self.classifiers = OrderedDict()
         self.feature_extractor_model = None
         self.preprocessor = None
-        self.global_mean = None
+        # Version of the image preprocessing of the preprocessor, see feature_extractors.FEATURE_PREPROCESSING_VERSION
+        self.preprocessing_version = None
+        # Compiled and warmed up inference path of the preprocessor, see extract_features
+        self.feature_extractor = None
+        # Where quantized preprocessors are cached and the stored images they are converted with
+        self.quantized_model_directory = 'models'
+        self.calibration_image_paths = None
+        self.__global_mean = None
         self.instances = 0
+        # Running sum of all features and the instances it covers, used to maintain global_mean
+        self.feature_sum = None
+        self.feature_sum_instances = 0
         self.mapping = []
         self.created_at = None
         self.updated_at = None
+        # Contiguous copies of every fitted shell's parameters used for vectorized scoring
+        self.packed_shell_names = []
+        self.packed_shell_indexes = {}
+        self.packed_shell_means = None
+        self.packed_shell_means_squared_norms = None
+        self.packed_noise_means = None
+        self.packed_noise_stds = None
+        self.packed_shells_signature = None
+        # Optional approximate nearest shell index, see build_shell_index
+        self.shell_index = None
+        # Online shell updates for score(..., with_update=True), see ShellModel.update
+        self.online_update = False
+        self.online_update_refit_interval = None
+        # Keep a streaming noise sketch per shell, see ShellModel.refresh_noise_from_sketch
+        self.use_noise_sketch = False
+        # Lazy refit policy, see update_shells. A refit_tolerance of None refits every shell.
+        self.refit_tolerance = None
+        self.refit_score_margin = 3.0
+        self.full_refit_interval = None
+        self.update_cycles_since_full_refit = 0
+        # Number of worker processes used by refit_shells and the directory of the features
+        # shared with them, the feature store's directory if None and there is one
+        self.refit_workers = 1
+        self.refit_shared_features_directory = None
+        # Optional FeatureStore keeping the raw features of every shell on disk
+        self.feature_store = None
+        # Optional number of raw features each shell keeps, see ShellModel.raw_features_capacity
+        self.shell_capacity = None
+
+    def attach_feature_store(self, feature_store):
+        """Keep the raw features of every current and future shell in a FeatureStore.
+        """
+        self.feature_store = feature_store
+        for shell in self.classifiers.values():
+            shell.attach_feature_store(feature_store)
+
+    def create_shell(self, shell_id):
+        """Create an empty shell with the shell family's feature store and shell capacity.
+        """
+        shell = ShellModel()
+        shell.shell_id = shell_id
+        shell.raw_features_capacity = self.shell_capacity
+        if self.feature_store is not None:
+            shell.attach_feature_store(self.feature_store)
+        return shell
+
+    def sampling_error_report(self):
+        """Standard errors of the parameters of every shell fit on a reservoir sample of its features.
+        Returns:
+            report (dict): Shell name to ShellModel.sampling_error for every sampled shell
+        """
+        return {shell_name: shell.sampling_error for shell_name, shell in self.classifiers.items() if shell.sampling_error is not None}
+
+    def create_preprocessor(self, feature_extractor_model, target_size=224):
+        """Use the process-wide feature extractor of a backbone, which is only loaded the first
+            time any shell family in the process asks for it, and warm up its compiled inference
+            path for images of shape (target_size, target_size, 3). Quantized backbones such as
+            'resnet50_int8' are converted from calibration_image_paths the first time only.
+        """
+        # Imported here so that importing shell_v2, as the spawned refit workers do, never loads TensorFlow
+        from feature_extractors import FEATURE_PREPROCESSING_VERSION, get_feature_extractor, get_compiled_feature_extractor
+        self.preprocessor = get_feature_extractor(feature_extractor_model, target_size, self.calibration_image_paths, self.quantized_model_directory)
+        self.feature_extractor = get_compiled_feature_extractor(feature_extractor_model, target_size, self.calibration_image_paths, self.quantized_model_directory)
+        self.feature_extractor_model = feature_extractor_model
+        self.preprocessing_version = FEATURE_PREPROCESSING_VERSION
+
+    def extract_features(self, images):
+        """Extract features with the compiled inference path, for low latency on small batches
+            such as single images. Latency percentiles are kept by self.feature_extractor.
+        Args:
+            images (np.ndarray): uint8 image array of shape (N, H, W, 3)
+
+        Returns:
+            features (np.ndarray): Feature array of shape (N, D)
+        """
+        return self.feature_extractor(images)
 
-    def create_preprocessor(self, feature_extractor_model):
-        if feature_extractor_model in ACCEPTED_PREPROCESSORS:
-            model = Sequential()  
-            if feature_extractor_model == 'vgg':
-                vgg = VGG16(weights='imagenet', include_top=False)
-                model.add(vgg)
-            elif feature_extractor_model == 'resnet50':
-                resnet = ResNet50(weights='imagenet', include_top=False)
-                model.add(resnet)
-                model.add(GlobalAvgPool2D())
-            elif feature_extractor_model == 'mobilenet':
-                mobilenet = MobileNet(weights='imagenet', include_top=False)
-                model.add(mobilenet)
-                model.add(GlobalAvgPool2D())
-            self.preprocessor = model
-            self.feature_extractor_model = feature_extractor_model
-            self.preprocessor_preprocess_function = PREPROCESSORS_PREPROCESS_FUNCTIONS[self.feature_extractor_model]
-        else:
-            raise ValueError("Preprocessor model not found! Please enter the following models: {}".format(ACCEPTED_PREPROCESSORS))
-                
     def load(self, shell_file):
         with open(shell_file, "rb") as saved_data:
             shell_family_configuration = pickle.load(saved_data)
@@ -146,8 +453,10 @@ class ShellFamily():
         # Generate empty shell if needed
         for class_index in range(len(raw_mapping)):
             if raw_mapping[class_index] not in self.classifiers:
-                self.classifiers[raw_mapping[class_index]] = ShellModel()
+                self.classifiers[raw_mapping[class_index]] = self.create_shell(raw_mapping[class_index])
                 self.mapping.append(raw_mapping[class_index])
+        # Preallocate raw feature buffers when the generator knows how many images each class has
+        class_counts = np.bincount(np.asarray(data_generator.class_array), minlength=len(raw_mapping)) if hasattr(data_generator, 'class_array') else None
         # Extract features and prepare for shell creation
         for data in data_generator:
             images = data[0]
@@ -160,59 +469,296 @@ class ShellFamily():
                 target_images = images[indexes]
                 class_features = self.preprocessor.predict(target_images)
                 # Update shell family params
-                if self.global_mean is None:
-                    self.global_mean = np.mean(class_features,
-                                               axis=0,
-                                               keepdims=True)
-                else:
-                    self.global_mean = np.mean(
-                        np.concatenate(
-                            [
-                                np.repeat(
-                                    self.global_mean,
-                                    self.instances,
-                                    axis=0
-                                ),
-                                class_features
-                            ]
-                        ),
-                        axis=0,
-                        keepdims=True
-                    )
-                self.instances += class_features.shape[0]
+                self.update_global_mean(class_features)
                 class_name = raw_mapping[class_index]
                 # Append raw features to classifiers
-                if self.classifiers[class_name].raw_features is None:
-                    self.classifiers[class_name].raw_features = class_features
-                else:
-                    self.classifiers[class_name].raw_features =\
-                        np.concatenate([self.classifiers[class_name].raw_features,
-                                        class_features])
+                capacity = None
+                if class_counts is not None:
+                    capacity = self.classifiers[class_name].raw_features_count + class_counts[class_index]
+                self.classifiers[class_name].append_raw_features(class_features, capacity=capacity)
+                if class_counts is not None:
+                    class_counts[class_index] -= class_features.shape[0]
         # Create shells from features
         self.update_shells(self.global_mean)
         # self.save(output_datafile)
         # self.shell_file = output_datafile
+
+    @property
+    def global_mean(self):
+        return self.__global_mean
+
+    @global_mean.setter
+    def global_mean(self, global_mean):
+        """Set the global mean from outside of update_global_mean, for example when loaded from the
+            database. The running feature sum is resynchronised from it on the next update.
+        """
+        self.__global_mean = global_mean
+        self.feature_sum = None
     
-    def update_shells(self, global_mean):
-        for shell_name in self.classifiers:
-            self.classifiers[shell_name].fit(global_mean)
-    
-    def score(self, feat, threshold, with_update=True, return_full_results=True):
-        results = OrderedDict()
-        best_class_name = None
-        best_class_index = None
-        best_result = -9999999
-        for class_name, shell in self.classifiers.items():
-            results[class_name] = shell.score(feat, self.global_mean)
-            if results[class_name] > best_result:
-                best_class_name = class_name
-                best_result = results[class_name]
-                best_class_index = self.mapping.index(class_name)
+    def update_global_mean(self, features_sum, num_features=None):
+        """Add features to the running feature sum and recompute global_mean in O(D).
+        Args:
+            features_sum (np.ndarray): Feature array of shape (N, D), or the (1, D) sum of the
+                features when num_features is given. A negative num_features removes features.
+            num_features (int): Number of features summed in features_sum
+        """
+        if num_features is None:
+            num_features = features_sum.shape[0]
+            features_sum = np.sum(features_sum, axis=0, keepdims=True, dtype=np.float64)
+        # Resynchronise the running sum if global_mean or instances were assigned directly
+        if self.feature_sum is None or self.feature_sum_instances != self.instances:
+            if self.__global_mean is None or self.instances == 0:
+                self.feature_sum = np.zeros(features_sum.shape, dtype=np.float64)
+            else:
+                self.feature_sum = self.__global_mean.astype(np.float64) * self.instances
+        self.feature_sum = self.feature_sum + features_sum
+        self.instances += num_features
+        self.feature_sum_instances = self.instances
+        self.__global_mean = (self.feature_sum / self.instances).astype(np.float32)
+
+    def update_shells(self, global_mean, shells_to_refit=None, sketched_shells=None):
+        """Refit the shells on a new global mean. With a refit_tolerance set, only shells whose
+            score_error_bound exceeds it, or which are listed in shells_to_refit, are refit while
+            every shell is refit once every full_refit_interval calls. Shells in sketched_shells
+            had their new features merged into their noise sketch, see add_sketched_features, so
+            they are not refit for having new features, only when they drift past refit_tolerance
+            or on the periodic full refit.
+        Args:
+            global_mean (np.ndarray): Global mean to fit the shells on
+            shells_to_refit (list): Shells that must be refit, for example because they have new features
+            sketched_shells (list): Shells whose new features were merged into their noise sketch
+
+        Returns:
+            refitted_shells (list): Names of the shells that were refit
+        """
+        shells_to_refit = set(shells_to_refit or [])
+        sketched_shells = set(sketched_shells or [])
+        periodic_full_refit = self.full_refit_interval is not None and self.update_cycles_since_full_refit + 1 >= self.full_refit_interval
+        refitted_shells = [shell_name for shell_name, shell in self.classifiers.items()
+                           if periodic_full_refit or shell_name in shells_to_refit or
+                           (self.refit_tolerance is None and shell_name not in sketched_shells) or
+                           (self.refit_tolerance is not None and shell.score_error_bound(global_mean, self.refit_score_margin) > self.refit_tolerance)]
+        full_refit = periodic_full_refit or len(refitted_shells) == len(self.classifiers)
+        refitted_shells = self.refit_shells(refitted_shells, global_mean)
+        self.update_cycles_since_full_refit = 0 if full_refit else self.update_cycles_since_full_refit + 1
+        # Reassign the refitted shell means in the shell index straight away
+        if self.shell_index is not None:
+            self.pack_shells()
+        return refitted_shells
+
+    def add_sketched_features(self, shell_name, features):
+        """Add new features to a shell and refresh its noise statistics from its noise sketch
+            instead of refitting it on all of its features, see ShellModel.update with online=True.
+            Only shells that were fit and keep a noise sketch can be updated this way.
+        Args:
+            shell_name (str): Shell to add the features to
+            features (np.ndarray): Raw feature array of shape (N, D)
+
+        Returns:
+            sketched (bool): Whether the features were merged into the sketch, otherwise they
+                were only appended and the shell needs a refit
+        """
+        shell = self.classifiers[shell_name]
+        if not self.use_noise_sketch or shell.noise_sketch is None or shell.shell_mean is None:
+            shell.append_raw_features(features)
+            return False
+        shell.update(features, self.global_mean, online=True)
+        return True
+
+    def refit_shells(self, shell_names, global_mean):
+        """Refit several shells in one vectorized pass over their features, sharded across
+            refit_workers processes if more than one, see shell_statistics.segmented_shell_statistics.
+            Shells without features are left unfitted.
+        Args:
+            shell_names (list): Names of the shells to refit
+            global_mean (np.ndarray): Global mean to fit the shells on
+
+        Returns:
+            fitted_shell_names (list): Names of the shells that were refit
+        """
+        shell_names = [shell_name for shell_name in shell_names if self.classifiers[shell_name].raw_features_count > 0]
+        if not shell_names:
+            return shell_names
+        shells = [self.classifiers[shell_name] for shell_name in shell_names]
+        offsets = segment_offsets([shell.raw_features_count for shell in shells])
+        if self.refit_workers > 1:
+            shared_features_directory = self.refit_shared_features_directory
+            if shared_features_directory is None and self.feature_store is not None:
+                shared_features_directory = self.feature_store.directory
+            statistics = parallel_segmented_shell_statistics([shell.raw_features for shell in shells], offsets, global_mean,
+                                                             self.refit_workers, shared_features_directory)
+        else:
+            statistics = segmented_shell_statistics([shell.raw_features for shell in shells], offsets, global_mean)
+        for index, shell in enumerate(shells):
+            if self.use_noise_sketch and shell.noise_sketch is None:
+                shell.noise_sketch = QuantileSketch()
+            shell.set_fit_parameters(global_mean,
+                                     statistics['shell_means'][index : index + 1],
+                                     statistics['noise_means'][index],
+                                     statistics['noise_stds'][index],
+                                     statistics['noise_distance_means'][index],
+                                     float(statistics['min_centered_norms'][index]),
+                                     int(statistics['num_instances'][index]),
+                                     statistics['noise_distances'][offsets[index] : offsets[index + 1]])
+        return shell_names
+
+    def pack_shells(self):
+        """Pack every fitted shell's shell_mean, noise_mean and noise_std into contiguous
+            C x D and C length arrays. Arrays are only rebuilt when the shells have changed.
+        """
+        signature = [(shell_name, shell, shell.version) for shell_name, shell in self.classifiers.items()]
+        if signature == self.packed_shells_signature:
+            return
+        previous_signature = {shell_name: (shell, version) for shell_name, shell, version in (self.packed_shells_signature or [])}
+        # Shells created without any features yet have no parameters to score against
+        fitted_shell_names = [shell_name for shell_name, shell, _ in signature if shell.shell_mean is not None]
+        changed_shell_names = [shell_name for shell_name, shell, version in signature
+                               if shell.shell_mean is not None and previous_signature.get(shell_name) != (shell, version)]
+        removed_shell_names = list(set(self.packed_shell_names).difference(fitted_shell_names))
+        if fitted_shell_names == self.packed_shell_names and self.packed_shell_means is not None:
+            # Same shells in the same order, only overwrite the rows of the shells that changed
+            for shell_name in changed_shell_names:
+                shell = self.classifiers[shell_name]
+                row = self.packed_shell_indexes[shell_name]
+                self.packed_shell_means[row] = shell.shell_mean[0]
+                self.packed_shell_means_squared_norms[row] = np.dot(self.packed_shell_means[row], self.packed_shell_means[row])
+                self.packed_noise_means[row] = shell.noise_mean
+                self.packed_noise_stds[row] = shell.noise_std
+        elif fitted_shell_names:
+            fitted_shells = [self.classifiers[shell_name] for shell_name in fitted_shell_names]
+            self.packed_shell_means = np.ascontiguousarray(np.concatenate([shell.shell_mean for shell in fitted_shells], axis=0))
+            self.packed_noise_means = np.array([shell.noise_mean for shell in fitted_shells], dtype=self.packed_shell_means.dtype)
+            self.packed_noise_stds = np.array([shell.noise_std for shell in fitted_shells], dtype=self.packed_shell_means.dtype)
+            self.packed_shell_means_squared_norms = np.einsum('ij,ij->i', self.packed_shell_means, self.packed_shell_means)
+        else:
+            self.packed_shell_means = None
+            self.packed_shell_means_squared_norms = None
+            self.packed_noise_means = None
+            self.packed_noise_stds = None
+        self.packed_shell_names = fitted_shell_names
+        self.packed_shell_indexes = {shell_name: row for row, shell_name in enumerate(fitted_shell_names)}
+        self.packed_shells_signature = signature
+        # Keep the shell index in sync with the packed shell means
+        if self.shell_index is not None:
+            self.shell_index.remove(removed_shell_names)
+            changed_rows = [self.packed_shell_indexes[shell_name] for shell_name in changed_shell_names]
+            self.shell_index.update(changed_shell_names,
+                                    self.packed_shell_means[changed_rows] if changed_rows else None,
+                                    self.packed_shell_names,
+                                    self.packed_shell_means)
+
+    def build_shell_index(self, num_lists=None, num_probes=1):
+        """Build a clustered inverted-file index over the shell means so that score can
+            visit only the shells closest to a query. Kept in sync as shells change.
+        Args:
+            num_lists (int): Number of clusters, defaults to the square root of the number of shells
+            num_probes (int): Default number of closest clusters visited per query (recall/latency knob)
+        """
+        self.pack_shells()
+        self.shell_index = ShellIndex(num_lists=num_lists, num_probes=num_probes)
+        if self.packed_shell_names:
+            self.shell_index.build(self.packed_shell_names, self.packed_shell_means)
+
+    def score_all_shells(self, feat):
+        """Score features against all fitted shells with one normalization and one matrix operation.
+        Args:
+            feat (np.ndarray): Raw feature array of shape (N, D)
+
+        Returns:
+            scores (np.ndarray): Score array of shape (N, C) where the columns follow packed_shell_names
+        """
+        self.pack_shells()
+        normalized_feat, _ = normalize(feat, self.global_mean)
+        return self.__score_normalized_features(normalized_feat)
+
+    def score_nearest_shells(self, feat, top_k, num_probes=None):
+        """Score a feature against the candidate shells returned by the shell index only. Clusters
+            past the num_probes closest are visited until there are at least top_k candidates, so
+            fewer than top_k shells only come back if the shell family has fewer shells.
+        Args:
+            feat (np.ndarray): Raw feature array of shape (1, D)
+            top_k (int): Number of best scoring shells to return
+            num_probes (int): Number of closest clusters to visit, defaults to the shell index setting
+
+        Returns:
+            scores (np.ndarray): Score array of shape (1, min(top_k, number of shells)) sorted from best to worst
+            shell_names (list): Shell names for each column of scores
+        """
+        self.pack_shells()
+        normalized_feat, _ = normalize(feat, self.global_mean)
+        candidate_shell_names = self.shell_index.search(normalized_feat, num_probes, top_k) if len(self.shell_index) > 0 else []
+        if not candidate_shell_names:
+            candidate_shell_names = self.packed_shell_names
+        rows = np.array([self.packed_shell_indexes[shell_name] for shell_name in candidate_shell_names])
+        scores = self.__score_normalized_features(normalized_feat, rows)
+        best_columns = np.argsort(-scores[0], kind='stable')[:top_k]
+        return scores[:, best_columns], [candidate_shell_names[column] for column in best_columns]
+
+    def __score_normalized_features(self, normalized_feat, rows=None):
+        """Score normalized features against the packed shells, optionally restricted to some rows.
+        """
+        if rows is None:
+            shell_means = self.packed_shell_means
+            shell_means_squared_norms = self.packed_shell_means_squared_norms
+            noise_means = self.packed_noise_means
+            noise_stds = self.packed_noise_stds
+        else:
+            shell_means = self.packed_shell_means[rows]
+            shell_means_squared_norms = self.packed_shell_means_squared_norms[rows]
+            noise_means = self.packed_noise_means[rows]
+            noise_stds = self.packed_noise_stds[rows]
+        # ||x - m||^2 = ||x||^2 + ||m||^2 - 2x.m so that the bulk of the work is a single GEMM
+        squared_distances = np.einsum('ij,ij->i', normalized_feat, normalized_feat)[:, np.newaxis]\
+            + shell_means_squared_norms[np.newaxis, :]\
+            - 2 * np.dot(normalized_feat, shell_means.T)
+        # Clip tiny negative values caused by floating point cancellation
+        distances = np.sqrt(np.maximum(squared_distances, 0))
+        # smaller scores are better, muliply - to reverse that
+        return -(distances - noise_means) / noise_stds
+
+    def score_batch(self, features, batch_size=4096):
+        """Score a batch of features against all fitted shells without updating the shell family.
+        Args:
+            features (np.ndarray): Raw feature array of shape (N, D)
+            batch_size (int): Number of rows scored per GEMM to bound the size of temporaries
+
+        Returns:
+            scores (np.ndarray): Score array of shape (N, C) where the columns follow packed_shell_names
+            best_class_names (np.ndarray): Best matching class name for each row
+        """
+        self.pack_shells()
+        scores = np.empty((features.shape[0], len(self.packed_shell_names)), dtype=np.result_type(features, self.packed_shell_means))
+        for start in range(0, features.shape[0], batch_size):
+            scores[start : start + batch_size] = self.score_all_shells(features[start : start + batch_size])
+        best_class_names = np.array(self.packed_shell_names)[np.argmax(scores, axis=1)]
+        return scores, best_class_names
+
+    def score(self, feat, threshold, with_update=True, return_full_results=True, top_k=None, num_probes=None):
+        """Score a feature against the shells. When a shell index is built and top_k is given,
+            only the shells of the clusters closest to the feature are scored and the top_k best
+            are returned, see score_nearest_shells, otherwise every shell is.
+            The results of return_full_results then only hold those top_k shells, so leave
+            top_k as None where the score of every class is needed.
+        """
+        if top_k is not None and top_k < 1:
+            raise ValueError("top_k must be at least 1, got {}!".format(top_k))
+        if top_k is not None and self.shell_index is not None:
+            scores, shell_names = self.score_nearest_shells(feat, top_k, num_probes)
+        else:
+            scores = self.score_all_shells(feat)
+            shell_names = self.packed_shell_names
+        best_column = int(np.argmax(scores[0]))
+        best_class_name = shell_names[best_column]
+        best_result = scores[:, best_column]
+        best_class_index = self.mapping.index(best_class_name)
         if with_update:
-            self.global_mean = (self.global_mean * self.instances + feat) / (self.instances + 1)
-            self.instances += 1
-            self.classifiers[best_class_name].update(feat, self.global_mean)
+            self.update_global_mean(feat)
+            self.classifiers[best_class_name].update(feat,
+                                                    self.global_mean,
+                                                    online=self.online_update,
+                                                    refit_interval=self.online_update_refit_interval)
         if return_full_results:
+            results = OrderedDict(zip(shell_names, scores.T))
             return best_class_index, best_class_name, best_result, results
         else:
             return best_class_index, best_class_name, best_result
@@ -264,11 +810,10 @@ class ShellFamily():
     def delete_class(self, class_to_delete):
         """To be used when a shell needs to be deleted
         """
-        all_features_total_value = self.global_mean * self.instances
-        class_to_delete_raw_features_sum = np.sum(self.classifiers[class_to_delete].raw_features, axis=0)
-        class_to_delete_raw_features_sum = np.expand_dims(class_to_delete_raw_features_sum, 0)
-        self.global_mean = (all_features_total_value - class_to_delete_raw_features_sum) / (self.instances - self.classifiers[class_to_delete].num_instances)
-        self.instances -= self.classifiers[class_to_delete].num_instances
+        # The exact feature sum also covers features dropped from a reservoir sampled shell
+        self.update_global_mean(-self.classifiers[class_to_delete].feature_sum, -self.classifiers[class_to_delete].feature_count)
+        # Drops the class's features from the feature store too
+        self.classifiers[class_to_delete].raw_features = None
         del self.classifiers[class_to_delete]
         # Re update all shell configurations
         self.update_shells(self.global_mean)
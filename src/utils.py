@@ -3,24 +3,190 @@ import shutil
 import glob
 from random import sample 
 import timeit
+import atexit
+import threading
+import multiprocessing
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
 from PIL import Image
 
 import numpy as np
 from sklearn.metrics import roc_auc_score
 from sklearn.metrics import average_precision_score
-from tensorflow.keras.applications.vgg16 import VGG16
-from tensorflow.keras.applications.resnet50 import ResNet50
-from tensorflow.keras.applications import MobileNet
-from tensorflow.keras.preprocessing import image
-from tensorflow.keras.applications.resnet50 import preprocess_input, decode_predictions
-from tensorflow.keras.models import Model, Sequential
-from tensorflow.keras.layers import GlobalAvgPool2D, GlobalMaxPool2D
+
+# Process pool shared by every ImageBatchLoader decoding in processes, see get_decode_executor
+_DECODE_EXECUTOR = None
+_DECODE_EXECUTOR_WORKERS = 0
+_DECODE_EXECUTOR_LOCK = threading.Lock()
+
+##################
+# Image Decoding #
+##################
+def load_image(image_file, target_size, reduced_decode=False):
+    """Decode an image into an RGB array resized to target_size (width, height).
+        With reduced_decode, JPEGs are downscaled by up to 8 times in the DCT domain while decoding
+        and other formats are box reduced by an integer factor before the final resize, both staying
+        at least twice as large as target_size, so large photos are never fully decoded and resized.
+    Args:
+        image_file (str or file): Path or file object of the image
+        target_size (tuple): Width and height to resize to
+        reduced_decode (bool): Decode at a reduced size first, see decode_equivalence_report
+
+    Returns:
+        image (np.ndarray): uint8 image array of shape (height, width, 3)
+    """
+    img = Image.open(image_file)
+    if reduced_decode:
+        if img.format == 'JPEG':
+            img.draft('RGB', (2 * target_size[0], 2 * target_size[1]))
+        else:
+            reduce_factor = min(img.size[0] // target_size[0], img.size[1] // target_size[1]) // 2
+            if reduce_factor > 1:
+                img = img.reduce(reduce_factor)
+    return np.asarray(img.convert("RGB").resize(target_size))[..., :3]
+
+
+def decode_equivalence_report(image_files, target_size, extract_features=None):
+    """Compare load_image with and without reduced_decode on the same images.
+    Args:
+        image_files (list): Paths or file objects of the images
+        target_size (tuple): Width and height to resize to
+        extract_features (function): Optional function from an image batch to features, such as
+            ShellFamily.extract_features, to also compare the features of both decodes
+
+    Returns:
+        report (dict): Pixel differences, PSNR and, if extract_features is given, feature cosine similarities
+    """
+    full_images = np.array([load_image(image_file, target_size, reduced_decode=False) for image_file in image_files]).astype(np.float64)
+    reduced_images = np.array([load_image(image_file, target_size, reduced_decode=True) for image_file in image_files]).astype(np.float64)
+    absolute_differences = np.abs(full_images - reduced_images).reshape((len(image_files), -1))
+    squared_errors = np.mean(np.square(absolute_differences), axis=1)
+    # Identical images have an infinite PSNR, which is capped at 100 dB
+    psnrs = 10 * np.log10(255.0 ** 2 / np.maximum(squared_errors, 255.0 ** 2 * 1e-10))
+    report = {'num_images': len(image_files),
+              'mean_absolute_pixel_difference': float(np.mean(absolute_differences)),
+              'max_absolute_pixel_difference': float(np.max(absolute_differences)),
+              'identical_image_fraction': float(np.mean(np.max(absolute_differences, axis=1) == 0)),
+              'mean_psnr': float(np.mean(psnrs)),
+              'min_psnr': float(np.min(psnrs))}
+    if extract_features is not None:
+        full_features = extract_features(full_images.astype(np.uint8)).astype(np.float64)
+        reduced_features = extract_features(reduced_images.astype(np.uint8)).astype(np.float64)
+        cosine_similarities = np.einsum('ij,ij->i', full_features, reduced_features) /\
+            np.maximum(np.linalg.norm(full_features, axis=1) * np.linalg.norm(reduced_features, axis=1), np.finfo(np.float64).tiny)
+        report['mean_feature_cosine_similarity'] = float(np.mean(cosine_similarities))
+        report['min_feature_cosine_similarity'] = float(np.min(cosine_similarities))
+    return report
+
+
+##########################
+# ImageBatchLoader Class #
+##########################
+def get_decode_executor(num_workers):
+    """Get the process pool shared by every ImageBatchLoader with decode_pool 'process', created on
+        first use and kept until the application exits. Workers are spawned rather than forked so
+        they never inherit the threads and TensorFlow state of the application.
+    Args:
+        num_workers (int): Number of worker processes
+
+    Returns:
+        executor (concurrent.futures.ProcessPoolExecutor): Process pool with num_workers workers
+    """
+    global _DECODE_EXECUTOR, _DECODE_EXECUTOR_WORKERS
+    with _DECODE_EXECUTOR_LOCK:
+        if _DECODE_EXECUTOR is None or _DECODE_EXECUTOR_WORKERS != num_workers:
+            if _DECODE_EXECUTOR is not None:
+                _DECODE_EXECUTOR.shutdown(wait=True)
+            _DECODE_EXECUTOR = ProcessPoolExecutor(max_workers=num_workers, mp_context=multiprocessing.get_context('spawn'))
+            _DECODE_EXECUTOR_WORKERS = num_workers
+        return _DECODE_EXECUTOR
+
+
+def shutdown_decode_executor():
+    """Shut down the process pool of get_decode_executor, a later loader creates a new one.
+    """
+    global _DECODE_EXECUTOR, _DECODE_EXECUTOR_WORKERS
+    with _DECODE_EXECUTOR_LOCK:
+        if _DECODE_EXECUTOR is not None:
+            _DECODE_EXECUTOR.shutdown(wait=False)
+        _DECODE_EXECUTOR = None
+        _DECODE_EXECUTOR_WORKERS = 0
+
+
+atexit.register(shutdown_decode_executor)
+
+
+class ImageBatchLoader():
+    """Decodes and resizes batches of images on a pool of decode_workers threads, or on the shared
+        process pool of get_decode_executor if decode_pool is 'process', keeping up to prefetch_batches
+        batches decoding ahead of the batch being consumed so decoding overlaps with inference on the
+        current batch.
+    """
+    def __init__(self, filepath_array, batch_size, target_size, decode_workers=1, prefetch_batches=1, decode_pool='thread', reduced_decode=False):
+        self.loader_filepath_array = filepath_array
+        self.loader_batch_size = batch_size
+        self.loader_target_size = target_size
+        self.decode_workers = decode_workers
+        self.prefetch_batches = prefetch_batches
+        self.decode_pool = decode_pool
+        self.reduced_decode = reduced_decode
+        self.executor = None
+        self.pending_batches = deque()
+        self.next_batch_start = 0
+
+    def next_batch(self):
+        """Get the next batch of decoded images.
+        Returns:
+            batch_images (np.ndarray): uint8 image array of shape (N, height, width, 3)
+            batch_start (int): Index of the first image of the batch
+            batch_end (int): Index after the last image of the batch
+        """
+        if self.decode_workers <= 1 and self.prefetch_batches <= 0:
+            batch_start, batch_end = self.__next_batch_range()
+            return np.array([load_image(filepath, self.loader_target_size, self.reduced_decode) for filepath in self.loader_filepath_array[batch_start : batch_end]]), batch_start, batch_end
+        if self.executor is None:
+            if self.decode_pool == 'process':
+                self.executor = get_decode_executor(max(1, self.decode_workers))
+            else:
+                self.executor = ThreadPoolExecutor(max_workers=max(1, self.decode_workers))
+        while len(self.pending_batches) <= self.prefetch_batches and self.next_batch_start < len(self.loader_filepath_array):
+            batch_start, batch_end = self.__next_batch_range()
+            self.pending_batches.append(([self.executor.submit(load_image, filepath, self.loader_target_size, self.reduced_decode) for filepath in self.loader_filepath_array[batch_start : batch_end]],
+                                         batch_start,
+                                         batch_end))
+        if not self.pending_batches:
+            self.close()
+            raise StopIteration
+        batch_futures, batch_start, batch_end = self.pending_batches.popleft()
+        return np.array([future.result() for future in batch_futures]), batch_start, batch_end
+
+    def __next_batch_range(self):
+        if self.next_batch_start >= len(self.loader_filepath_array):
+            raise StopIteration
+        batch_start = self.next_batch_start
+        self.next_batch_start = min(batch_start + self.loader_batch_size, len(self.loader_filepath_array))
+        return batch_start, self.next_batch_start
+
+    def close(self):
+        """Stop the decode pool, dropping any prefetched batches. The shared process pool of
+            get_decode_executor is left running for the next loader.
+        """
+        if self.executor is not None:
+            for batch_futures, _, _ in self.pending_batches:
+                for future in batch_futures:
+                    future.cancel()
+            self.pending_batches.clear()
+            if self.decode_pool != 'process':
+                self.executor.shutdown(wait=True)
+            self.executor = None
+
 
 ########################
 # ImageGenerator Class #
 ########################
-class ImageGenerator():
-    def __init__(self, filepath_array, class_array, batch_size, target_size):
+class ImageGenerator(ImageBatchLoader):
+    def __init__(self, filepath_array, class_array, batch_size, target_size, decode_workers=1, prefetch_batches=1, decode_pool='thread', reduced_decode=False):
+        super().__init__(filepath_array, batch_size, target_size, decode_workers, prefetch_batches, decode_pool, reduced_decode)
         self.filepath_array = filepath_array
         self.class_array = class_array
         self.batch_size = batch_size
@@ -37,22 +203,11 @@ class ImageGenerator():
         return len(self.class_array)
     
     def __next__(self):
-        if self.index == self.__len__():
-            raise StopIteration
-        elif self.index + self.batch_size >= self.__len__():
-            batch_filepaths = np.array(self.filepath_array[self.index : self.__len__()])
-            batch_images = np.array([np.asarray(Image.open(i).convert("RGB").resize(self.target_size))[..., :3] for i in batch_filepaths]).astype(np.float32)
-            batch_images = preprocess_input(batch_images)
-            batch_classes = self.class_array[self.index : self.__len__()]
-            self.index = self.__len__()
-            return (batch_images, batch_filepaths, batch_classes)
-        else:
-            batch_filepaths = np.array(self.filepath_array[self.index : self.index + self.batch_size])
-            batch_images = np.array([np.asarray(Image.open(i).convert("RGB").resize(self.target_size))[..., :3] for i in batch_filepaths]).astype(np.float32)
-            batch_images = preprocess_input(batch_images)
-            batch_classes = self.class_array[self.index : self.index + self.batch_size]
-            self.index += self.batch_size
-            return (batch_images, batch_filepaths, batch_classes)
+        batch_images, batch_start, batch_end = self.next_batch()
+        batch_filepaths = np.array(self.filepath_array[batch_start : batch_end])
+        batch_classes = self.class_array[batch_start : batch_end]
+        self.index = batch_end
+        return (batch_images, batch_filepaths, batch_classes)
 
 
 
@@ -60,8 +215,9 @@ class ImageGenerator():
 # ImageGeneratorV2 Class #
 ##########################
 # ImageGeneratorV2 is for shell_v2 purpose
-class ImageGeneratorV2():
-    def __init__(self, filepath_array, batch_size, target_size):
+class ImageGeneratorV2(ImageBatchLoader):
+    def __init__(self, filepath_array, batch_size, target_size, decode_workers=1, prefetch_batches=1, decode_pool='thread', reduced_decode=False):
+        super().__init__(filepath_array, batch_size, (target_size, target_size), decode_workers, prefetch_batches, decode_pool, reduced_decode)
         self.filepath_array = filepath_array
         self.batch_size = batch_size
         self.target_size = target_size
@@ -75,20 +231,11 @@ class ImageGeneratorV2():
         return len(self.filepath_array)
     
     def __next__(self):
-        if self.index == self.__len__():
-            raise StopIteration
-        elif self.index + self.batch_size >= self.__len__():
-            batch_filepaths = np.array(self.filepath_array[self.index : self.__len__()])
-            batch_images = np.array([np.asarray(Image.open(i).convert("RGB").resize((self.target_size, self.target_size)))[..., :3] for i in batch_filepaths]).astype(np.float32)
-            batch_images = preprocess_input(batch_images)
-            self.index = self.__len__()
-            return (batch_images, batch_filepaths)
-        else:
-            batch_filepaths = np.array(self.filepath_array[self.index : self.index + self.batch_size])
-            batch_images = np.array([np.asarray(Image.open(i).convert("RGB").resize((self.target_size, self.target_size)))[..., :3] for i in batch_filepaths]).astype(np.float32)
-            batch_images = preprocess_input(batch_images)
-            self.index += self.batch_size
-            return (batch_images, batch_filepaths)
+        batch_images, batch_start, batch_end = self.next_batch()
+        batch_filepaths = np.array(self.filepath_array[batch_start : batch_end])
+        self.index = batch_end
+        # Batches stay uint8, the feature extractor model applies its backbone's preprocessing
+        return (batch_images, batch_filepaths)
 
 
 ##########################
@@ -253,35 +400,12 @@ def update_global_mean_and_shell_mean(self, data_generator, raw_mapping):
             # Generate class features
             indexes = np.where(classes == class_index)
             target_images = images[indexes]
-            # Update shell family params
-            if self.global_mean is None:
-                self.global_mean = np.mean(class_features,
-                                            axis=0,
-                                            keepdims=True)
-            else:
-                self.global_mean = np.mean(
-                    np.concatenate(
-                        [
-                            np.repeat(
-                                self.global_mean,
-                                self.instances,
-                                axis=0
-                            ),
-                            class_features
-                        ]
-                    ),
-                    axis=0,
-                    keepdims=True
-                )
-            self.instances += class_features.shape[0]
+            class_features = self.preprocessor.predict(target_images)
+            # Update shell family params with the running feature sum
+            self.update_global_mean(class_features)
             class_name = raw_mapping[class_index]
             # Append raw features to classifiers
-            if self.classifiers[class_name].raw_features is None:
-                self.classifiers[class_name].raw_features = class_features
-            else:
-                self.classifiers[class_name].raw_features =\
-                    np.concatenate([self.classifiers[class_name].raw_features,
-                                    class_features])
+            self.classifiers[class_name].append_raw_features(class_features)
     # Create shells from features
     self.update_shells(self.global_mean)
 
@@ -1,8 +1,8 @@
 import atexit
 import logging
 import datetime
-import pickle
 import os
+import sys
 # Mute tensorflow logs except for errors as it is flooding the cli
 os.environ['TF_CPP_MIN_LOG_LEVEL'] = '2'
 
@@ -10,32 +10,46 @@ from apscheduler.schedulers.background import BackgroundScheduler
 from flask import Flask
 import yaml
 import numpy as np
-import tensorflow as tf
 
-from src.shell_v2 import ShellModel, ShellFamily
-from sql_app import models, schemas
+# src modules import their siblings by bare name, so import them the same way to load each module once
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'src'))
+from src.shell_v2 import ShellFamily
+from feature_store import FeatureStore
+from sql_app import models
 from sql_app.database import SessionLocal, engine
+from sql_app.migrations import upgrade_database
+from sql_app.feature_encoding import encode_array, decode_array, decode_feature_matrix
 from sql_app.crud import (get_shell_families,
-                          get_shell_family_by_shell_family_id,
                           create_shell_family,
                           get_all_shells_by_shell_family_id,
-                          get_all_shell_images_by_shell_family_id_and_shell_id,
-                          get_latest_shell_image_by_shell_family_id,
-                          get_latest_shell_image_by_shell_family_id_and_shell_id,
-                          get_all_shell_images_by_shell_family_id_and_shell_id_with_no_image_features,
+                          get_shell_image_features_page,
+                          get_shell_images_watermark_by_shell_family_id,
+                          get_shell_images_summary_by_shell_family_id,
                           update_shell_family,
+                          update_shell_family_watermark,
                           update_shell_for_shell_family,
+                          update_shell_feature_sums_for_shell_family,
+                          get_shell_family_feature_sum_by_shell_family_id,
+                          feature_sum_from_bytes,
                           update_all_shell_images_by_shell_family_id_and_shell_id_with_no_image_features,
                           delete_shell_family,
                           delete_shell_for_shell_family,
                           delete_all_shell_images_by_shell_family_id_and_shell_id,
-                          delete_image)
+                          get_all_images)
 ### State dict to determine what operation to perform ###
 # State is to indicate what the task_app is doing.
 # changes_found is to indicate if during update in progress or reset in progress, a change is detected
 # this is because there are times where update is in progress for the task_app but no changes are found
 # which means shell_family's state has no updates.
 STATE_DICT = {"state": "update", "changes_found": False}
+### Shell families kept between update cycles ###
+# Per shell_family_id, the ShellFamily built by the last update along with the shell images
+# watermark (largest id, latest assigned_at, count) it reflects. An update only loads the
+# shells whose images changed since, and the refit state of every shell, such as the global
+# mean it was last fit on, carries over so update_shells can skip shells that barely moved.
+SHELL_FAMILIES = {}
+### Number of shell images whose features are loaded from the database at a time ###
+SHELL_IMAGE_FEATURES_PAGE_SIZE = 1000
 ### Load Config ###
 with open('config.yaml') as f:
     config = yaml.load(f, Loader=yaml.FullLoader)
@@ -51,7 +65,6 @@ if not os.path.isfile(config['task_app_environment']['log_filepath']):
 handler = logging.FileHandler(config['task_app_environment']['log_filepath'])
 formatter = logging.Formatter('%(asctime)s %(levelname)s %(message)s')
 handler.setFormatter(formatter)
-
 def perform_task_by_state():
     if STATE_DICT['state'] == "shell_family_reset":
         STATE_DICT['state'] = "shell_family_reset_in_progress"
@@ -88,6 +101,9 @@ def reset_shell_family_database_state():
             delete_all_shell_images_by_shell_family_id_and_shell_id(db, config['model']['shell_family_id'], shell)
             delete_shell_for_shell_family(db, config['model']['shell_family_id'], shell)
         delete_shell_family(db, config['model']['shell_family_id'])
+        SHELL_FAMILIES.pop(config['model']['shell_family_id'], None)
+        if config['model']['feature_store_directory'] is not None:
+            FeatureStore(config['model']['feature_store_directory'], config['model']['shell_family_id']).clear()
         app.logger.info('Successfully deleted all shells and records for shell_family_id: {}'.format(config['model']['shell_family_id']))
         # Recreate new learner with id same as previous
         app.logger.info('Recreating shell family as new record for shell_family_id: {}'.format(config['model']['shell_family_id']))
@@ -138,6 +154,18 @@ def full_reset_database_state():
     #     db.close()
 
 
+def iterate_shell_image_features(db, shell_family_id, shell_id, after_shell_image_id, max_shell_image_id):
+    """Yield the decoded features of the shell images of a shell with ids in (after_shell_image_id, max_shell_image_id],
+        one page of SHELL_IMAGE_FEATURES_PAGE_SIZE rows at a time so a shell is never materialized whole.
+    """
+    while True:
+        shell_images_page = get_shell_image_features_page(db, shell_family_id, shell_id, after_shell_image_id, max_shell_image_id, SHELL_IMAGE_FEATURES_PAGE_SIZE)
+        if not shell_images_page:
+            return
+        yield decode_feature_matrix([image_features for _, image_features in shell_images_page])
+        after_shell_image_id = shell_images_page[-1][0]
+
+
 def update_shells_in_database():
     db = SessionLocal()
     try:
@@ -147,107 +175,176 @@ def update_shells_in_database():
         if all_shell_families_results:
             for shell_family_details in all_shell_families_results:
                 app.logger.info('Checking Shell Family with shell_family_id={} for updates'.format(shell_family_details.shell_family_id))
-                app.logger.info('Instantiating Shell Family with shell_family_id={}'.format(shell_family_details.shell_family_id))
-                shell_family = ShellFamily()    
-                # Step 2: Load current shell family configuration
-                shell_family.shell_family_id = shell_family_details.shell_family_id
-                shell_family.instances = shell_family_details.instances
-                shell_family.mapping = shell_family_details.mapping
-                shell_family.created_at = shell_family_details.updated_at
-                shell_family.updated_at = shell_family_details.updated_at
-                shell_family.create_preprocessor(shell_family_details.feature_extractor_model)
-                app.logger.info('Successfully instantiate Shell Family with shell_family_id={}'.format(shell_family_details.shell_family_id))
-                # Step 3: Get all shells for shell family
+                # Step 2: Compare the shell images against the watermark processed by the last update, in one aggregate query
+                # Any added, reassigned or deleted shell image moves the largest id, the latest assigned_at or the count
+                shell_images_watermark = get_shell_images_watermark_by_shell_family_id(db, shell_family_details.shell_family_id)
+                last_shell_images_watermark = (shell_family_details.last_shell_image_id, shell_family_details.last_assigned_at, shell_family_details.shell_images_count)
+                if shell_images_watermark == last_shell_images_watermark:
+                    app.logger.info('Nothing to update for shell family with shell_family_id={}'.format(shell_family_details.shell_family_id))
+                    continue
+                # Rows added after the watermark was taken are left to the next update
+                max_shell_image_id = shell_images_watermark[0] or 0
+                # Step 3: Reuse the shell family kept by the last update if it reflects the last watermark, else load it from the database
+                cached_shell_family = SHELL_FAMILIES.get(shell_family_details.shell_family_id)
+                if cached_shell_family is not None and cached_shell_family['watermark'] == last_shell_images_watermark:
+                    app.logger.info('Reusing Shell Family with shell_family_id={} from the last update'.format(shell_family_details.shell_family_id))
+                    shell_family = cached_shell_family['shell_family']
+                    is_cached_shell_family = True
+                else:
+                    app.logger.info('Instantiating Shell Family with shell_family_id={}'.format(shell_family_details.shell_family_id))
+                    shell_family = ShellFamily()
+                    shell_family.shell_family_id = shell_family_details.shell_family_id
+                    shell_family.instances = shell_family_details.instances
+                    shell_family.mapping = shell_family_details.mapping
+                    shell_family.created_at = shell_family_details.updated_at
+                    shell_family.updated_at = shell_family_details.updated_at
+                    shell_family.quantized_model_directory = config['model']['quantized_model_directory']
+                    shell_family.calibration_image_paths = CALIBRATION_IMAGE_PATHS
+                    shell_family.create_preprocessor(shell_family_details.feature_extractor_model, config['model']['target_size'])
+                    shell_family.use_noise_sketch = config['model']['use_noise_sketch']
+                    shell_family.refit_tolerance = config['model']['refit_tolerance']
+                    shell_family.full_refit_interval = config['model']['full_refit_interval']
+                    shell_family.refit_workers = config['model']['refit_workers']
+                    shell_family.refit_shared_features_directory = config['model']['refit_shared_features_directory']
+                    shell_family.shell_capacity = config['model']['shell_capacity']
+                    if config['model']['feature_store_directory'] is not None:
+                        shell_family.attach_feature_store(FeatureStore(config['model']['feature_store_directory'], shell_family.shell_family_id))
+                    is_cached_shell_family = False
+                    app.logger.info('Successfully instantiate Shell Family with shell_family_id={}'.format(shell_family_details.shell_family_id))
+                # Step 4: Get all shells for shell family and load the ones not held yet
                 app.logger.info('Retrieving all shells for Shell Family with shell_family_id={}'.format(shell_family_details.shell_family_id))
                 all_shells_result = get_all_shells_by_shell_family_id(db, shell_family.shell_family_id)
                 if all_shells_result:
                     app.logger.info('Successfully retrieved shells for Shell Family with shell_family_id={}'.format(shell_family_details.shell_family_id))
-                # Step 3.1: Create variable to store all features for global mean recalculation and
-                # to help with tracking and for further calculations
-                shell_family_features = np.array([])
                 shell_has_updated = False
                 shell_has_been_deleted = False
                 shell_image_classes = []
-                app.logger.info('Checking retrieved shells for updates for Shell Family with shell_family_id={}'.format(shell_family_details.shell_family_id))
+                shells_to_reload = set()
+                persisted_feature_counts = {}
                 for shell_details in all_shells_result:
-                    # Step 4: Load shell configuration
-                    app.logger.info('Loading shell_id={} for Shell Family with shell_family_id={}'.format(shell_details.shell_id, shell_family_details.shell_family_id))
-                    shell_family.classifiers[shell_details.shell_id] = ShellModel()
-                    shell_family.classifiers[shell_details.shell_id].shell_id = shell_details.shell_id
                     shell_image_classes.append(shell_details.shell_id)
-                    # Shell Mean needs a pickle load due to binary storage of numpy array
-                    shell_family.classifiers[shell_details.shell_id].shell_mean = (shell_details.shell_mean if shell_details.shell_mean is None else pickle.loads(shell_details.shell_mean))
-                    shell_family.classifiers[shell_details.shell_id].num_instances = shell_details.num_instances
-                    shell_family.classifiers[shell_details.shell_id].noise_mean = shell_details.noise_mean
-                    shell_family.classifiers[shell_details.shell_id].noise_std = shell_details.noise_std
-                    shell_family.classifiers[shell_details.shell_id].created_at = shell_details.created_at
-                    shell_family.classifiers[shell_details.shell_id].updated_at = shell_details.updated_at
+                    persisted_feature_counts[shell_details.shell_id] = shell_details.feature_count
+                    if shell_details.shell_id in shell_family.classifiers:
+                        continue
+                    app.logger.info('Loading shell_id={} for Shell Family with shell_family_id={}'.format(shell_details.shell_id, shell_family_details.shell_family_id))
+                    shell = shell_family.create_shell(shell_details.shell_id)
+                    # Shell Mean needs decoding due to binary storage of numpy array
+                    shell.shell_mean = decode_array(shell_details.shell_mean)
+                    shell.num_instances = shell_details.num_instances
+                    shell.noise_mean = shell_details.noise_mean
+                    shell.noise_std = shell_details.noise_std
+                    shell.created_at = shell_details.created_at
+                    shell.updated_at = shell_details.updated_at
+                    # A shell's feature store only holds a reservoir sample past shell_capacity, restore its exact feature sum and count
+                    if shell_details.feature_sum is not None and shell_details.feature_count > shell.raw_features_count > 0:
+                        shell.feature_sum = feature_sum_from_bytes(shell_details.feature_sum)
+                        shell.feature_count = shell_details.feature_count
+                    shell_family.classifiers[shell_details.shell_id] = shell
+                    # A shell new to a cached shell family has no features loaded yet
+                    if is_cached_shell_family:
+                        shells_to_reload.add(shell_details.shell_id)
                     app.logger.info('shell_id={} successfully loaded for Shell Family with shell_family_id={}'.format(shell_details.shell_id, shell_family_details.shell_family_id))
-                    # Step 5: Check if class has any newly updated images by checking null in image_features column
-                    null_shell_images_results = get_all_shell_images_by_shell_family_id_and_shell_id_with_no_image_features(db, shell_family.shell_family_id, shell_details.shell_id)
-                    if null_shell_images_results:
-                        app.logger.info('Found new images for shell_id={} for Shell Family with shell_family_id={}'.format(shell_details.shell_id, shell_family_details.shell_family_id))
-                        # Step 5.5: Update STATE_DICT to indicate changes found
-                        if not STATE_DICT['changes_found']:
-                            STATE_DICT['changes_found'] = True
-                        # Step 6: Update all images with no image features with regards to shell_family_id and shell_id
-                        update_datetime = datetime.datetime.utcnow()
-                        shell_has_updated = True
-                        update_shell_images_results =\
-                            update_all_shell_images_by_shell_family_id_and_shell_id_with_no_image_features(db,
-                                                                                                           shell_family.shell_family_id,
-                                                                                                           shell_details.shell_id,
-                                                                                                           shell_family,
-                                                                                                           config['model']['batch_size'],
-                                                                                                           config['model']['target_size'],
-                                                                                                           update_datetime)
-                    # Step 7: Perform additional check to see if classification module has updates to database
-                    # This is done by checking for latest timestamp to determine if there is an update
-                    latest_shell_image_for_current_shell_result = get_latest_shell_image_by_shell_family_id_and_shell_id(db, shell_family.shell_family_id, shell_details.shell_id)
-                    if latest_shell_image_for_current_shell_result.assigned_at > shell_family.updated_at:
-                        shell_has_updated = True
-                    # Step 8: Get all shell images to append to shell_family_features
-                    app.logger.info('Adding features from shell_id={} to Shell Family raw_features attribute with shell_family_id={}'.format(shell_details.shell_id, shell_family_details.shell_family_id))
-                    all_images_for_shell_family_and_current_shell_results =\
-                        get_all_shell_images_by_shell_family_id_and_shell_id(db, shell_family.shell_family_id, shell_details.shell_id)
-                    shell_features = [pickle.loads(shell_image_details.image_features) for shell_image_details in all_images_for_shell_family_and_current_shell_results]
-                    if shell_family_features.shape[0] == 0:
-                        shell_family_features = np.array(shell_features)
-                    else:
-                        shell_family_features = np.concatenate(
-                            [
-                                shell_family_features,
-                                shell_features
-                            ],
-                            axis=0,
-                        )
-                    # Assign to raw features for potential calculations
-                    shell_family.classifiers[shell_details.shell_id].raw_features = np.array(shell_features)
-                # Step 9: Perform additional check to see if a class has been removed from the database
-                # This is done by checking if the shell_family's mapping matches the shell classes present in the shell images
-                shell_image_classes.sort()
-                shell_family_classes = list(shell_family.mapping)
-                shell_family_classes.sort()
-                if shell_image_classes != shell_family_classes:
-                    # Step 9.5: Update STATE_DICT to indicate changes found
+                # Step 5: Summarize the images of every shell in one grouped query to find the shells whose images changed
+                # since the last watermark. Shell images added since then are appended to their shell, any other change reloads the shell.
+                # Shell images with no features, such as ones cleared to be re-extracted by a migration, also reload a loaded shell
+                shell_images_summary = get_shell_images_summary_by_shell_family_id(db, shell_family.shell_family_id, max_shell_image_id)
+                last_shell_image_id = last_shell_images_watermark[0] or 0
+                last_assigned_at = last_shell_images_watermark[1] or datetime.datetime.min
+                shells_with_new_images = set()
+                for shell_class in shell_image_classes:
+                    shell_summary = shell_images_summary.get(shell_class)
+                    if shell_summary is None:
+                        if shell_family.classifiers[shell_class].feature_count > 0:
+                            shells_to_reload.add(shell_class)
+                    elif is_cached_shell_family and shell_summary.max_shell_image_id > last_shell_image_id:
+                        shells_with_new_images.add(shell_class)
+                    elif shell_family.classifiers[shell_class].feature_count != shell_summary.image_count or\
+                         (not is_cached_shell_family and shell_summary.pending_count > 0) or\
+                         (is_cached_shell_family and shell_summary.latest_assigned_at > last_assigned_at):
+                        shells_to_reload.add(shell_class)
+                shells_with_new_images -= shells_to_reload
+                updated_shell_classes = [shell_class for shell_class in shell_image_classes if shell_class in shells_to_reload or shell_class in shells_with_new_images]
+                if updated_shell_classes:
+                    app.logger.info('Found changed images for shell_ids={} for Shell Family with shell_family_id={}'.format(updated_shell_classes, shell_family_details.shell_family_id))
+                    # Step 5.5: Update STATE_DICT to indicate changes found
+                    if not STATE_DICT['changes_found']:
+                        STATE_DICT['changes_found'] = True
+                    shell_has_updated = True
+                # Step 6: Update all images with no image features of the changed shells
+                extraction_datetime = datetime.datetime.utcnow()
+                num_extracted_shell_images = 0
+                for shell_class in updated_shell_classes:
+                    if shell_class not in shell_images_summary or shell_images_summary[shell_class].pending_count == 0:
+                        continue
+                    num_extracted_shell_images +=\
+                        update_all_shell_images_by_shell_family_id_and_shell_id_with_no_image_features(db,
+                                                                                                       shell_family.shell_family_id,
+                                                                                                       shell_class,
+                                                                                                       shell_family,
+                                                                                                       DECODE_BATCH_SIZE,
+                                                                                                       INFERENCE_BATCH_SIZE,
+                                                                                                       config['model']['target_size'],
+                                                                                                       extraction_datetime,
+                                                                                                       config['model']['decode_workers'],
+                                                                                                       config['model']['prefetch_batches'],
+                                                                                                       config['model']['decode_pool'],
+                                                                                                       config['model']['reduced_decode'])
+                # Step 7: Load the features of the changed shells only, streamed page by page into the shells
+                # which keep at most shell_capacity of them. With use_noise_sketch, the new features of a shell
+                # are merged into its noise sketch instead of refitting the shell
+                sketched_shell_classes = set()
+                for shell_class in updated_shell_classes:
+                    app.logger.info('Adding features from shell_id={} to Shell Family raw_features attribute with shell_family_id={}'.format(shell_class, shell_family_details.shell_family_id))
+                    shell = shell_family.classifiers[shell_class]
+                    if shell_class in shells_with_new_images:
+                        if all([shell_family.add_sketched_features(shell_class, features)
+                                for features in iterate_shell_image_features(db, shell_family.shell_family_id, shell_class, last_shell_image_id, max_shell_image_id)]):
+                            sketched_shell_classes.add(shell_class)
+                        if shell.feature_count == shell_images_summary[shell_class].image_count:
+                            continue
+                        # Shell images were deleted or reassigned along with the new ones, reload and refit the shell
+                        sketched_shell_classes.discard(shell_class)
+                    shell.raw_features = None
+                    num_shell_images = shell_images_summary[shell_class].image_count if shell_class in shell_images_summary else None
+                    for features in iterate_shell_image_features(db, shell_family.shell_family_id, shell_class, 0, max_shell_image_id):
+                        shell.append_raw_features(features, num_shell_images)
+                # Step 7.5: Keep the feature sum and count of every shell in the shell table in step with its features
+                shell_feature_sums = {shell_class: (shell_family.classifiers[shell_class].feature_sum, shell_family.classifiers[shell_class].feature_count)
+                                      for shell_class in shell_image_classes
+                                      if shell_class in updated_shell_classes or persisted_feature_counts[shell_class] != shell_family.classifiers[shell_class].feature_count}
+                if shell_feature_sums:
+                    update_shell_feature_sums_for_shell_family(db, shell_family.shell_family_id, shell_feature_sums)
+                # Step 8: Perform additional check to see if a class has been added or removed from the database
+                # This is done by checking if the shell_family's mapping matches the shells present in the database
+                if sorted(shell_image_classes) != sorted(shell_family.mapping):
+                    # Step 8.5: Update STATE_DICT to indicate changes found
                     if not STATE_DICT['changes_found']:
                         STATE_DICT['changes_found'] = True
                     shell_has_updated = True
                     shell_has_been_deleted = True
                     update_datetime = datetime.datetime.utcnow()
+                    for shell_class in set(shell_family.classifiers) - set(shell_image_classes):
+                        # Drops the class's features from the feature store too
+                        shell_family.classifiers[shell_class].raw_features = None
+                        del shell_family.classifiers[shell_class]
                     for shell_class in shell_image_classes:
                         shell_family.classifiers[shell_class].updated_at = update_datetime
-                # Step 10: Update shell_family and shells if needed
+                    if shell_family.feature_store is not None:
+                        for shell_class in set(shell_family.feature_store.shell_ids()) - set(shell_image_classes):
+                            shell_family.feature_store.delete(shell_class)
+                # Step 9: Update shell_family and shells if needed
+                last_assigned_at = shell_images_watermark[1]
+                if num_extracted_shell_images > 0:
+                    last_assigned_at = extraction_datetime if last_assigned_at is None else max(last_assigned_at, extraction_datetime)
                 if (shell_has_updated):
-                    app.logger.info('Retrieved last uploaded image timestamp for shell_family_id={}'.format(shell_family_details.shell_family_id))
-                    latest_shell_image_result = get_latest_shell_image_by_shell_family_id(db, shell_family_details.shell_family_id)
                     if not shell_has_been_deleted:
-                        update_datetime = latest_shell_image_result.assigned_at
+                        update_datetime = last_assigned_at
                     app.logger.info('Updating Shell Family parameter as update was found in its shells for shell_family_id={}'.format(shell_family_details.shell_family_id))
-                    # Step 10.1: Update shell_family global mean
-                    new_global_mean = np.mean(shell_family_features, axis=0, keepdims=True)
+                    # Step 9.1: Update shell_family global mean from the feature sums of every shell in the shell table
+                    shell_family_features_sum, shell_family_instances = get_shell_family_feature_sum_by_shell_family_id(db, shell_family.shell_family_id)
+                    new_global_mean = (shell_family_features_sum / shell_family_instances).astype(np.float32)
                     shell_family.global_mean = new_global_mean
-                    shell_family.instances =  shell_family_features.shape[0]
+                    shell_family.instances = shell_family_instances
                     shell_family.mapping = list(shell_family.classifiers.keys())
                     shell_family.updated_at = update_datetime
                     update_shell_family_results = update_shell_family(db,
@@ -255,17 +352,26 @@ def update_shells_in_database():
                                                                     shell_family.feature_extractor_model,
                                                                     int(shell_family.instances),
                                                                     shell_family.mapping,
-                                                                    pickle.dumps(shell_family.global_mean),
+                                                                    encode_array(shell_family.global_mean),
                                                                     update_datetime)
-                    # Step 10.2: Update all shells
+                    # Step 9.2: Update shells with new images and shells that drifted past the refit tolerance
                     app.logger.info("Updating all Shells' parameters in Shell Family for shell_family_id={}".format(shell_family_details.shell_family_id))
-                    shell_family.update_shells(new_global_mean)
-                    for shell_class in shell_family.classifiers:
+                    refitted_shell_classes = shell_family.update_shells(new_global_mean,
+                                                                        [shell_class for shell_class in updated_shell_classes if shell_class not in sketched_shell_classes],
+                                                                        sketched_shell_classes)
+                    app.logger.info('Refitted {} of {} shells and refreshed {} shells from their noise sketch for shell_family_id={}'.format(
+                        len(refitted_shell_classes), len(shell_family.classifiers), len(sketched_shell_classes.difference(refitted_shell_classes)), shell_family_details.shell_family_id))
+                    for shell_class, sampling_error in shell_family.sampling_error_report().items():
+                        app.logger.info('shell_id={} fit on {} of {} features with standard errors shell_mean={:.2e}, noise_mean={:.2e}, noise_std={:.2e}'.format(
+                            shell_class, sampling_error['num_sampled'], sampling_error['num_instances'],
+                            sampling_error['shell_mean'], sampling_error['noise_mean'], sampling_error['noise_std']))
+                    for shell_class in refitted_shell_classes + [shell_class for shell_class in updated_shell_classes
+                                                                 if shell_class in sketched_shell_classes and shell_class not in refitted_shell_classes]:
                         shell_family.classifiers[shell_class].updated_at = update_datetime
                         update_shell_results = update_shell_for_shell_family(db,
                                                                             shell_family.shell_family_id,
                                                                             shell_class,
-                                                                            pickle.dumps(shell_family.classifiers[shell_class].shell_mean),
+                                                                            encode_array(shell_family.classifiers[shell_class].shell_mean),
                                                                             int(shell_family.classifiers[shell_class].num_instances),
                                                                             float(shell_family.classifiers[shell_class].noise_mean),
                                                                             float(shell_family.classifiers[shell_class].noise_std),
@@ -273,14 +379,19 @@ def update_shells_in_database():
                     app.logger.info('Successfully updated Shell Family with shell_family_id={}'.format(shell_family_details.shell_family_id))
                 else:
                     app.logger.info('Nothing to update for shell family with shell_family_id={}'.format(shell_family_details.shell_family_id))
+                # Step 10: Persist the watermark processed and keep the shell family for the next update
+                new_shell_images_watermark = (shell_images_watermark[0], last_assigned_at, shell_images_watermark[2])
+                update_shell_family_watermark(db, shell_family.shell_family_id, *new_shell_images_watermark)
+                SHELL_FAMILIES[shell_family.shell_family_id] = {'shell_family': shell_family, 'watermark': new_shell_images_watermark}
         else:
             app.logger.info('No Shell Family found!')
     except Exception as e:
+        # A shell family may be left half updated, reload every shell family from the database next update
+        SHELL_FAMILIES.clear()
         app.logger.info(e)
         app.logger.info('Update has failed!')
     finally:
         db.close()
-        tf.keras.backend.clear_session()
         # Reset STATE_DICT changes found to be back to False
         STATE_DICT['changes_found'] = False
 
@@ -291,13 +402,6 @@ job_defaults = {
 }
 
 
-### Create Scheduler ###
-sched = BackgroundScheduler(daemon=True, job_defaults=job_defaults)
-### Add jobs for scheduler ###
-sched.add_job(perform_task_by_state,'interval', seconds=config['task_app_environment']['seconds_interval'])
-### Start Scheduler ###
-sched.start()
-
 app = Flask(__name__)
 app.logger.addHandler(handler)
 
@@ -315,9 +419,46 @@ def set_shell_family_reset_state():
 def get_state():
     return STATE_DICT
 
-atexit.register(lambda: sched.shutdown(wait=False))
-
 if __name__ == "__main__":
+    # Startup only runs in the main process, refit worker processes are spawned and import this module.
+    # TensorFlow is only imported here so that the refit workers never load it
+    from feature_extractors import get_feature_extractor
+    from batch_sizing import batch_sizes_from_memory_budget, load_extraction_profile, apply_thread_settings
+    ### Create tables and add columns introduced after the database was created ###
+    models.Base.metadata.create_all(bind=engine)
+    upgrade_database(engine)
+    ### Load the feature extractor once so weights are never loaded on the update path ###
+    # Quantized feature extractors are converted here the first time, calibrated on stored images
+    startup_db = SessionLocal()
+    CALIBRATION_IMAGE_PATHS = [image_details.image_path for image_details in get_all_images(startup_db, limit=config['model']['num_calibration_images'])]
+    startup_db.close()
+    ### Pick the feature extraction batch sizes from the memory budget ###
+    # An autotuned profile also sets TensorFlow's thread counts, which must happen before the feature extractor is loaded
+    EXTRACTION_PROFILE = load_extraction_profile(config['model']['autotune_profile_filepath'],
+                                                 config['model']['feature_extractor_model'],
+                                                 config['model']['target_size'],
+                                                 config['model']['extraction_memory_budget_mb'])
+    if EXTRACTION_PROFILE is not None:
+        if not apply_thread_settings(EXTRACTION_PROFILE):
+            app.logger.warning('TensorFlow has already started, the thread counts of the extraction profile at {} were not applied'.format(config['model']['autotune_profile_filepath']))
+    else:
+        app.logger.info('No extraction profile found at {}, run autotune_extraction.py to create one'.format(config['model']['autotune_profile_filepath']))
+    DECODE_BATCH_SIZE, INFERENCE_BATCH_SIZE = batch_sizes_from_memory_budget(config['model']['extraction_memory_budget_mb'],
+                                                                             config['model']['feature_extractor_model'],
+                                                                             config['model']['target_size'],
+                                                                             config['model']['prefetch_batches'],
+                                                                             EXTRACTION_PROFILE['inference_batch_size'] if EXTRACTION_PROFILE is not None else None)
+    get_feature_extractor(config['model']['feature_extractor_model'],
+                          config['model']['target_size'],
+                          CALIBRATION_IMAGE_PATHS,
+                          config['model']['quantized_model_directory'])
+    ### Create Scheduler ###
+    sched = BackgroundScheduler(daemon=True, job_defaults=job_defaults)
+    ### Add jobs for scheduler ###
+    sched.add_job(perform_task_by_state,'interval', seconds=config['task_app_environment']['seconds_interval'])
+    ### Start Scheduler ###
+    sched.start()
+    atexit.register(lambda: sched.shutdown(wait=False))
     app.run(host=config['task_app_environment']['host'],
             port=config['task_app_environment']['port'],
             debug=config['task_app_environment']['debug'])
\ No newline at end of file
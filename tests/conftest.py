@@ -0,0 +1,7 @@
+import os
+import sys
+
+# src modules import their siblings by bare name, as when run from the src folder
+ROOT_DIRECTORY = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT_DIRECTORY)
+sys.path.insert(0, os.path.join(ROOT_DIRECTORY, 'src'))
@@ -0,0 +1,57 @@
+import json
+
+import pytest
+
+from batch_sizing import batch_sizes_from_memory_budget, load_extraction_profile, BACKBONE_WEIGHT_BYTES, BACKBONE_ACTIVATION_BYTES_PER_PIXEL, DECODE_MEMORY_FRACTION
+
+
+@pytest.mark.parametrize('feature_extractor_model', ['vgg16', 'resnet50', 'mobilenet'])
+@pytest.mark.parametrize('memory_budget_mb', [512, 2048])
+@pytest.mark.parametrize('prefetch_batches', [0, 1, 3])
+def test_batch_sizes_fit_the_memory_budget(feature_extractor_model, memory_budget_mb, prefetch_batches):
+    target_size = 224
+    decode_batch_size, inference_batch_size = batch_sizes_from_memory_budget(memory_budget_mb, feature_extractor_model, target_size, prefetch_batches)
+    memory_budget = memory_budget_mb * 2**20
+    assert inference_batch_size >= 1
+    assert decode_batch_size % inference_batch_size == 0
+    inference_memory = BACKBONE_WEIGHT_BYTES[feature_extractor_model] + inference_batch_size * BACKBONE_ACTIVATION_BYTES_PER_PIXEL[feature_extractor_model] * target_size ** 2
+    assert inference_memory <= memory_budget * (1 - DECODE_MEMORY_FRACTION)
+    decode_memory = (prefetch_batches + 1) * decode_batch_size * target_size ** 2 * 3
+    # A single inference batch of decoded images is always allowed, even past the decode budget
+    assert decode_memory <= max(memory_budget * DECODE_MEMORY_FRACTION, (prefetch_batches + 1) * inference_batch_size * target_size ** 2 * 3)
+
+
+def test_inference_batch_size_is_capped_by_the_budget():
+    _, max_inference_batch_size = batch_sizes_from_memory_budget(512, 'resnet50', 224)
+    decode_batch_size, inference_batch_size = batch_sizes_from_memory_budget(512, 'resnet50', 224, inference_batch_size=10 * max_inference_batch_size)
+    assert inference_batch_size == max_inference_batch_size
+    decode_batch_size, inference_batch_size = batch_sizes_from_memory_budget(512, 'resnet50', 224, inference_batch_size=3)
+    assert inference_batch_size == 3
+    assert decode_batch_size % 3 == 0
+
+
+def test_quantized_models_are_sized_as_their_backbone():
+    assert batch_sizes_from_memory_budget(1024, 'resnet50_int8', 224) == batch_sizes_from_memory_budget(1024, 'resnet50', 224)
+    assert batch_sizes_from_memory_budget(1024, 'mobilenet_float16', 224) == batch_sizes_from_memory_budget(1024, 'mobilenet', 224)
+
+
+def test_unknown_backbone_raises():
+    with pytest.raises(ValueError):
+        batch_sizes_from_memory_budget(1024, 'inception', 224)
+
+
+def test_too_small_budget_raises():
+    with pytest.raises(ValueError):
+        batch_sizes_from_memory_budget(64, 'vgg16', 224)
+
+
+def test_load_extraction_profile(tmp_path):
+    profile_filepath = str(tmp_path / 'profile.json')
+    assert load_extraction_profile(profile_filepath, 'resnet50', 224, 1024) is None
+    profile = {'feature_extractor_model': 'resnet50', 'target_size': 224, 'memory_budget_mb': 1024, 'inference_batch_size': 16}
+    with open(profile_filepath, 'w') as profile_file:
+        json.dump(profile, profile_file)
+    assert load_extraction_profile(profile_filepath, 'resnet50', 224, 1024) == profile
+    assert load_extraction_profile(profile_filepath, 'vgg16', 224, 1024) is None
+    assert load_extraction_profile(profile_filepath, 'resnet50', 160, 1024) is None
+    assert load_extraction_profile(profile_filepath, 'resnet50', 224, 2048) is None
@@ -0,0 +1,61 @@
+import pickle
+
+import numpy as np
+import pytest
+
+from sql_app.feature_encoding import encode_array, is_encoded_array, decode_array, decode_feature_matrix, FEATURE_ENCODING_HEADER
+
+
+@pytest.mark.parametrize('array', [np.arange(12, dtype=np.float32).reshape(3, 4),
+                                   np.random.RandomState(0).rand(1, 2048).astype(np.float32),
+                                   np.arange(5, dtype=np.float64),
+                                   np.arange(6, dtype='>f4').reshape(2, 3),
+                                   np.arange(24, dtype=np.int64).reshape(2, 3, 4)[:, ::2]])
+def test_encode_decode_roundtrip(array):
+    data = encode_array(array)
+    assert is_encoded_array(data)
+    decoded = decode_array(data)
+    assert decoded.shape == array.shape
+    assert decoded.dtype == array.dtype.newbyteorder('<')
+    np.testing.assert_array_equal(decoded, array)
+
+
+def test_decode_array_reads_pickled_arrays():
+    array = np.random.RandomState(1).rand(1, 8).astype(np.float32)
+    data = pickle.dumps(array)
+    assert not is_encoded_array(data)
+    np.testing.assert_array_equal(decode_array(data), array)
+    assert decode_array(None) is None
+
+
+def test_decode_array_rejects_other_versions():
+    data = bytearray(encode_array(np.zeros(3, dtype=np.float32)))
+    data[4] = 99
+    with pytest.raises(ValueError):
+        decode_array(bytes(data))
+
+
+def test_decode_feature_matrix_matches_decode_array():
+    random_state = np.random.RandomState(2)
+    vectors = [random_state.rand(1, 16).astype(np.float32), random_state.rand(16).astype(np.float32), random_state.rand(1, 16)]
+    data_list = [encode_array(vectors[0]), encode_array(vectors[1]), pickle.dumps(vectors[2])]
+    features = decode_feature_matrix(data_list)
+    assert features.shape == (3, 16)
+    assert features.dtype == np.float32
+    expected = np.concatenate([np.ravel(decode_array(data))[np.newaxis, :] for data in data_list]).astype(np.float32)
+    np.testing.assert_array_equal(features, expected)
+
+
+def test_decode_feature_matrix_empty():
+    assert decode_feature_matrix([]) is None
+
+
+def test_decode_feature_matrix_rejects_other_dimensions():
+    data_list = [encode_array(np.zeros((1, 8), dtype=np.float32)), encode_array(np.zeros((1, 9), dtype=np.float32))]
+    with pytest.raises(ValueError):
+        decode_feature_matrix(data_list)
+
+
+def test_encoded_header_size():
+    data = encode_array(np.zeros((1, 4), dtype=np.float32))
+    assert len(data) == FEATURE_ENCODING_HEADER.size + 2 * 4 + 4 * 4
@@ -0,0 +1,35 @@
+import numpy as np
+import pytest
+import tensorflow as tf
+
+from feature_extractors import CompiledFeatureExtractor, get_feature_extractor, loaded_feature_extractors
+
+IMAGES = np.random.RandomState(0).randint(0, 256, size=(9, 32, 32, 3)).astype(np.uint8)
+
+
+def test_unknown_backbone_is_not_registered():
+    with pytest.raises(ValueError):
+        get_feature_extractor('inception')
+    assert 'inception' not in loaded_feature_extractors()
+
+
+def test_int8_backbone_without_calibration_images_is_not_registered(tmp_path):
+    with pytest.raises(ValueError):
+        get_feature_extractor('mobilenet_int8', 32, [], str(tmp_path))
+    assert not any(feature_extractor_model.startswith('mobilenet') for feature_extractor_model in loaded_feature_extractors())
+
+
+def test_compiled_feature_extractor_matches_model():
+    # Backbones take uint8 images and preprocess them inside the model
+    inputs = tf.keras.Input(shape=(None, None, 3), dtype='uint8')
+    outputs = tf.keras.layers.Lambda(lambda images: tf.cast(images, tf.float32) / 127.5 - 1)(inputs)
+    outputs = tf.keras.layers.Conv2D(8, 3, activation='relu', kernel_initializer=tf.keras.initializers.GlorotUniform(seed=0))(outputs)
+    model = tf.keras.Model(inputs, tf.keras.layers.GlobalAveragePooling2D()(outputs))
+    feature_extractor = CompiledFeatureExtractor(model, batch_buckets=(1, 4))
+    assert feature_extractor.latency_percentiles() == {}
+    feature_extractor.warm_up(32)
+    features = model.predict(IMAGES, verbose=0)
+    # Batches padded up to a bucket and batches split over the largest bucket
+    for num_images in [1, 3, 9]:
+        np.testing.assert_allclose(feature_extractor(IMAGES[:num_images]), features[:num_images], rtol=1e-5, atol=1e-6)
+    assert sorted(feature_extractor.latency_percentiles()) == ['p50', 'p99']
@@ -0,0 +1,68 @@
+import os
+
+import numpy as np
+import pytest
+
+from feature_store import FeatureStore
+
+FEATURES = np.random.RandomState(0).rand(6, 4).astype(np.float32)
+
+
+def test_append_count_read(tmp_path):
+    feature_store = FeatureStore(str(tmp_path), 'family/1')
+    assert feature_store.read('shell a') is None
+    assert feature_store.count('shell a') == 0
+    feature_store.append('shell a', FEATURES[:3])
+    feature_store.append('shell a', FEATURES[3:].astype(np.float64))
+    assert feature_store.count('shell a') == 6
+    np.testing.assert_array_equal(feature_store.read('shell a'), FEATURES)
+    assert feature_store.shell_ids() == ['shell a']
+
+
+def test_write_replaces_features(tmp_path):
+    feature_store = FeatureStore(str(tmp_path), 'family')
+    feature_store.append('shell', FEATURES)
+    feature_store.write('shell', FEATURES[:2])
+    np.testing.assert_array_equal(feature_store.read('shell'), FEATURES[:2])
+    assert not os.path.exists(feature_store.segment_filepath('shell') + '.tmp')
+
+
+def test_update_rows_in_place(tmp_path):
+    feature_store = FeatureStore(str(tmp_path), 'family')
+    feature_store.write('shell', FEATURES)
+    feature_store.update_rows('shell', np.array([1, 3]), FEATURES[[4, 5]])
+    np.testing.assert_array_equal(feature_store.read('shell'), FEATURES[[0, 4, 2, 5, 4, 5]])
+
+
+def test_append_drops_partial_row(tmp_path):
+    feature_store = FeatureStore(str(tmp_path), 'family')
+    feature_store.append('shell', FEATURES[:2])
+    # Simulate an append interrupted half way through a row
+    with open(feature_store.segment_filepath('shell'), 'ab') as segment_file:
+        segment_file.write(b'\x00' * 6)
+    assert feature_store.count('shell') == 2
+    feature_store.append('shell', FEATURES[2:3])
+    np.testing.assert_array_equal(feature_store.read('shell'), FEATURES[:3])
+
+
+def test_delete_and_clear(tmp_path):
+    feature_store = FeatureStore(str(tmp_path), 'family')
+    feature_store.append('first', FEATURES)
+    feature_store.append('second', FEATURES)
+    feature_store.delete('first')
+    assert feature_store.count('first') == 0
+    assert feature_store.shell_ids() == ['second']
+    feature_store.clear()
+    assert feature_store.shell_ids() == []
+    # A cleared store takes any feature dimension again
+    feature_store.append('first', np.ones((1, 7), dtype=np.float32))
+    assert feature_store.feature_dimension == 7
+
+
+def test_reopened_store_keeps_feature_dimension(tmp_path):
+    FeatureStore(str(tmp_path), 'family').append('shell', FEATURES)
+    feature_store = FeatureStore(str(tmp_path), 'family')
+    assert feature_store.feature_dimension == 4
+    assert feature_store.count('shell') == 6
+    with pytest.raises(ValueError):
+        feature_store.append('shell', np.ones((1, 5), dtype=np.float32))
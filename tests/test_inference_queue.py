@@ -0,0 +1,59 @@
+import numpy as np
+import pytest
+
+from inference_queue import InferenceQueue, InferenceQueueFullError
+
+IMAGES = np.random.RandomState(0).rand(7, 4, 4, 3)
+
+
+def test_concurrent_requests_share_one_batch():
+    batch_sizes = []
+    def extract_features(images):
+        batch_sizes.append(images.shape[0])
+        return images.reshape((images.shape[0], -1)).sum(axis=1, keepdims=True)
+    inference_queue = InferenceQueue(extract_features, max_batch_size=16, max_wait_ms=1000)
+    # Requests queued before the worker starts are all waiting for the first batch
+    futures = [inference_queue.submit(IMAGES[start : start + 2]) for start in range(0, 7, 2)]
+    inference_queue.start()
+    try:
+        for start, future in zip(range(0, 7, 2), futures):
+            np.testing.assert_allclose(future.result(timeout=10), IMAGES[start : start + 2].reshape((-1, 48)).sum(axis=1, keepdims=True))
+    finally:
+        inference_queue.stop()
+    assert batch_sizes == [7]
+
+
+def test_requests_with_other_image_shapes_run_separately():
+    batch_shapes = []
+    def extract_features(images):
+        batch_shapes.append(images.shape)
+        return images.reshape((images.shape[0], -1)).mean(axis=1, keepdims=True)
+    inference_queue = InferenceQueue(extract_features, max_batch_size=16, max_wait_ms=1000)
+    small_future = inference_queue.submit(IMAGES[:2])
+    large_future = inference_queue.submit(np.ones((1, 8, 8, 3)))
+    inference_queue.start()
+    try:
+        np.testing.assert_allclose(small_future.result(timeout=10), IMAGES[:2].reshape((2, -1)).mean(axis=1, keepdims=True))
+        np.testing.assert_allclose(large_future.result(timeout=10), [[1.0]])
+    finally:
+        inference_queue.stop()
+    assert sorted(batch_shapes) == [(1, 8, 8, 3), (2, 4, 4, 3)]
+
+
+def test_full_queue_sheds_requests():
+    inference_queue = InferenceQueue(lambda images: images, max_queue_depth=2)
+    inference_queue.submit(IMAGES[:1])
+    inference_queue.submit(IMAGES[:1])
+    with pytest.raises(InferenceQueueFullError):
+        inference_queue.submit(IMAGES[:1])
+
+
+def test_extraction_errors_reach_every_caller():
+    def extract_features(images):
+        raise RuntimeError("extraction failed")
+    inference_queue = InferenceQueue(extract_features).start()
+    try:
+        with pytest.raises(RuntimeError):
+            inference_queue.extract_features(IMAGES[:1], timeout=10)
+    finally:
+        inference_queue.stop()
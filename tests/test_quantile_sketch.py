@@ -0,0 +1,38 @@
+import numpy as np
+import pytest
+
+from quantile_sketch import QuantileSketch
+
+VALUES = np.random.RandomState(0).beta(2, 5, size=20000) * 2
+
+
+def test_quantile_error_is_bounded_by_bin_width():
+    sketch = QuantileSketch.from_values(VALUES)
+    bin_width = sketch.upper_bound / sketch.num_bins
+    for q in [0.01, 0.1, 0.25, 0.5, 0.75, 0.9, 0.99]:
+        assert abs(sketch.quantile(q) - np.quantile(VALUES, q)) <= bin_width + 1e-12
+    assert sketch.mean() == pytest.approx(np.mean(VALUES))
+    assert len(sketch) == VALUES.shape[0]
+
+
+def test_median_absolute_deviation_is_bounded_by_bin_width():
+    sketch = QuantileSketch.from_values(VALUES)
+    center = np.mean(VALUES)
+    median_absolute_deviation = np.median(np.absolute(VALUES - center))
+    assert abs(sketch.median_absolute_deviation(center) - median_absolute_deviation) <= 2 * sketch.upper_bound / sketch.num_bins
+
+
+def test_merge_matches_sketch_of_all_values():
+    merged_sketch = QuantileSketch.from_values(VALUES[:3000])
+    merged_sketch.merge(QuantileSketch.from_values(VALUES[3000:]))
+    sketch = QuantileSketch.from_values(VALUES)
+    np.testing.assert_array_equal(merged_sketch.counts, sketch.counts)
+    assert merged_sketch.count == sketch.count
+    assert merged_sketch.quantile(0.5) == sketch.quantile(0.5)
+
+
+def test_merge_with_other_bins_raises():
+    with pytest.raises(ValueError):
+        QuantileSketch(num_bins=1024).merge(QuantileSketch(num_bins=2048))
+    with pytest.raises(ValueError):
+        QuantileSketch(upper_bound=1.0).merge(QuantileSketch(upper_bound=2.0))
@@ -0,0 +1,55 @@
+import numpy as np
+import pytest
+import tensorflow as tf
+
+from quantization import split_quantized_feature_extractor_model, convert_to_tflite, feature_drift_report
+from feature_extractors import CompiledFeatureExtractor, TFLiteFeatureExtractor
+
+CALIBRATION_IMAGES = np.random.RandomState(0).randint(0, 256, size=(16, 32, 32, 3)).astype(np.uint8)
+IMAGES = np.random.RandomState(1).randint(0, 256, size=(8, 32, 32, 3)).astype(np.uint8)
+FEATURES = np.random.RandomState(2).rand(10, 64)
+
+
+def test_split_quantized_feature_extractor_model():
+    assert split_quantized_feature_extractor_model('resnet50_int8') == ('resnet50', 'int8')
+    assert split_quantized_feature_extractor_model('mobilenet_float16') == ('mobilenet', 'float16')
+    assert split_quantized_feature_extractor_model('resnet50') == ('resnet50', None)
+
+
+def test_feature_drift_report_of_identical_features():
+    report = feature_drift_report(FEATURES, FEATURES.copy())
+    assert report['num_images'] == 10
+    assert report['mean_cosine_similarity'] == pytest.approx(1.0)
+    assert report['min_cosine_similarity'] == pytest.approx(1.0)
+    assert report['max_relative_error'] == 0.0
+
+
+def test_feature_drift_report_of_scaled_features():
+    report = feature_drift_report(FEATURES, 1.1 * FEATURES)
+    assert report['min_cosine_similarity'] == pytest.approx(1.0)
+    assert report['mean_relative_error'] == pytest.approx(0.1)
+
+
+@pytest.mark.parametrize('quantization_mode', ['int8', 'float16'])
+def test_quantized_feature_drift(quantization_mode):
+    # Small stand-in for a backbone: uint8 images in, preprocessing, convolutions and average pooling out
+    inputs = tf.keras.Input(shape=(None, None, 3), dtype='uint8')
+    outputs = tf.keras.layers.Lambda(lambda images: tf.cast(images, tf.float32) / 127.5 - 1)(inputs)
+    outputs = tf.keras.layers.Conv2D(16, 3, activation='relu', kernel_initializer=tf.keras.initializers.GlorotUniform(seed=0))(outputs)
+    outputs = tf.keras.layers.Conv2D(32, 3, activation='relu', kernel_initializer=tf.keras.initializers.GlorotUniform(seed=1))(outputs)
+    model = tf.keras.Model(inputs, tf.keras.layers.GlobalAveragePooling2D()(outputs))
+    model_content = convert_to_tflite(model, quantization_mode, 32, CALIBRATION_IMAGES)
+    reference_features = CompiledFeatureExtractor(model, batch_buckets=(1, 8)).predict(IMAGES)
+    quantized_features = TFLiteFeatureExtractor(model_content).predict(IMAGES, batch_size=3)
+    assert quantized_features.shape == reference_features.shape
+    report = feature_drift_report(reference_features, quantized_features)
+    assert report['min_cosine_similarity'] > 0.99
+    assert report['max_relative_error'] < 0.1
+
+
+def test_int8_quantization_needs_calibration_images():
+    inputs = tf.keras.Input(shape=(None, None, 3), dtype='uint8')
+    outputs = tf.keras.layers.Lambda(lambda images: tf.cast(images, tf.float32))(inputs)
+    model = tf.keras.Model(inputs, tf.keras.layers.GlobalAveragePooling2D()(outputs))
+    with pytest.raises(ValueError):
+        convert_to_tflite(model, 'int8', 32)
@@ -0,0 +1,88 @@
+import numpy as np
+
+from shell_index import ShellIndex
+
+SHELL_NAMES = ['shell_{}'.format(index) for index in range(30)]
+SHELL_MEANS = np.random.RandomState(0).randn(30, 8)
+SHELL_MEANS /= np.linalg.norm(SHELL_MEANS, axis=1, keepdims=True)
+
+
+def test_build_assigns_every_shell_once():
+    shell_index = ShellIndex(num_lists=5)
+    shell_index.build(SHELL_NAMES, SHELL_MEANS)
+    assert len(shell_index) == 30
+    assert sorted(shell_name for inverted_list in shell_index.inverted_lists for shell_name in inverted_list) == sorted(SHELL_NAMES)
+
+
+def test_exhaustive_search_returns_every_shell():
+    shell_index = ShellIndex(num_lists=5)
+    shell_index.build(SHELL_NAMES, SHELL_MEANS)
+    assert sorted(shell_index.search(SHELL_MEANS[:1], num_probes=5)) == sorted(SHELL_NAMES)
+
+
+def test_search_finds_the_query_shell():
+    shell_index = ShellIndex(num_lists=5, num_probes=1)
+    shell_index.build(SHELL_NAMES, SHELL_MEANS)
+    for row, shell_name in enumerate(SHELL_NAMES):
+        assert shell_name in shell_index.search(SHELL_MEANS[row : row + 1])
+
+
+def test_search_widens_probes_to_min_candidates():
+    shell_index = ShellIndex(num_lists=10, num_probes=1)
+    shell_index.build(SHELL_NAMES, SHELL_MEANS)
+    candidate_shell_names = shell_index.search(SHELL_MEANS[:1])
+    assert len(candidate_shell_names) < 20
+    # The clusters of the first search are visited first
+    widened_candidate_shell_names = shell_index.search(SHELL_MEANS[:1], min_candidates=20)
+    assert len(widened_candidate_shell_names) >= 20
+    assert widened_candidate_shell_names[:len(candidate_shell_names)] == candidate_shell_names
+    assert sorted(shell_index.search(SHELL_MEANS[:1], min_candidates=100)) == sorted(SHELL_NAMES)
+
+
+def test_update_reassigns_moved_shell():
+    shell_index = ShellIndex(num_lists=4, rebuild_ratio=0.5)
+    shell_index.build(SHELL_NAMES[:20], SHELL_MEANS[:20])
+    # Move shell_0 onto the shell mean of a shell in another cluster
+    other_row = next(row for row in range(20) if shell_index.assignments[SHELL_NAMES[row]] != shell_index.assignments['shell_0'])
+    target_label = shell_index.assignments[SHELL_NAMES[other_row]]
+    shell_means = SHELL_MEANS[:20].copy()
+    shell_means[0] = shell_means[other_row]
+    shell_index.update(['shell_0'], shell_means[:1], SHELL_NAMES[:20], shell_means)
+    assert shell_index.updates_since_build == 1
+    assert shell_index.assignments['shell_0'] == target_label
+    assert sum('shell_0' in inverted_list for inverted_list in shell_index.inverted_lists) == 1
+    assert 'shell_0' in shell_index.inverted_lists[target_label]
+
+
+def test_update_with_unchanged_means_does_not_count_towards_rebuild():
+    shell_index = ShellIndex(num_lists=4)
+    shell_index.build(SHELL_NAMES[:20], SHELL_MEANS[:20])
+    centroids = shell_index.centroids.copy()
+    shell_index.update(SHELL_NAMES[:20], SHELL_MEANS[:20], SHELL_NAMES[:20], SHELL_MEANS[:20])
+    assert shell_index.updates_since_build == 0
+    np.testing.assert_array_equal(shell_index.centroids, centroids)
+
+
+def test_update_rebuilds_past_rebuild_ratio():
+    shell_index = ShellIndex(num_lists=3, rebuild_ratio=0.2)
+    shell_index.build(SHELL_NAMES[:10], SHELL_MEANS[:10])
+    # 4 new shells out of 14 is past the rebuild ratio, so the clusters are retrained
+    shell_index.update(SHELL_NAMES[10:14], SHELL_MEANS[10:14], SHELL_NAMES[:14], SHELL_MEANS[:14])
+    assert shell_index.updates_since_build == 0
+    assert len(shell_index) == 14
+
+
+def test_update_before_build_builds():
+    shell_index = ShellIndex()
+    shell_index.update(SHELL_NAMES[:1], SHELL_MEANS[:1])
+    assert len(shell_index) == 1
+    assert shell_index.search(SHELL_MEANS[:1]) == SHELL_NAMES[:1]
+
+
+def test_remove():
+    shell_index = ShellIndex(num_lists=3)
+    shell_index.build(SHELL_NAMES[:10], SHELL_MEANS[:10])
+    shell_index.remove(['shell_3', 'shell_7', 'missing'])
+    assert len(shell_index) == 8
+    candidate_shell_names = shell_index.search(SHELL_MEANS[:1], num_probes=3)
+    assert sorted(candidate_shell_names) == sorted(set(SHELL_NAMES[:10]).difference(['shell_3', 'shell_7']))
@@ -0,0 +1,89 @@
+import os
+
+import numpy as np
+import pytest
+
+from shell_statistics import segment_offsets, segmented_medians, segmented_shell_statistics, parallel_segmented_shell_statistics
+
+FEATURE_DIMENSION = 16
+SEGMENT_COUNTS = [5, 1, 12, 2]
+SEGMENTS = [np.random.RandomState(index).rand(count, FEATURE_DIMENSION) + index for index, count in enumerate(SEGMENT_COUNTS)]
+GLOBAL_MEAN = np.mean(np.concatenate(SEGMENTS), axis=0, keepdims=True)
+
+
+def test_segment_offsets():
+    np.testing.assert_array_equal(segment_offsets([3, 1, 4]), [0, 3, 4, 8])
+
+
+@pytest.mark.parametrize('counts', [[1], [5], [4], [1, 2, 3, 4, 5], [7, 1, 8, 2, 2]])
+def test_segmented_medians_match_np_median(counts):
+    values = np.random.RandomState(sum(counts)).rand(sum(counts)) * 2
+    offsets = segment_offsets(counts)
+    medians = segmented_medians(values, offsets)
+    np.testing.assert_allclose(medians, [np.median(values[offsets[index] : offsets[index + 1]]) for index in range(len(counts))], rtol=1e-12)
+
+
+def test_segmented_medians_with_ties():
+    values = np.array([1.0, 1.0, 1.0, 0.0, 2.0, 2.0, 0.5])
+    np.testing.assert_allclose(segmented_medians(values, segment_offsets([3, 4])), [1.0, 1.25])
+
+
+def test_segmented_shell_statistics_match_per_shell_fit():
+    statistics = segmented_shell_statistics(np.concatenate(SEGMENTS), segment_offsets(SEGMENT_COUNTS), GLOBAL_MEAN)
+    for index, segment_features in enumerate(SEGMENTS):
+        # Same computation as ShellModel.fit on the segment alone
+        centered_features = segment_features - GLOBAL_MEAN
+        centered_norms = np.linalg.norm(centered_features, axis=1, keepdims=True)
+        normalized_features = centered_features / centered_norms
+        shell_mean = np.mean(normalized_features, axis=0, keepdims=True)
+        noise = np.linalg.norm(normalized_features - shell_mean, axis=1)
+        np.testing.assert_allclose(statistics['shell_means'][index : index + 1], shell_mean, rtol=1e-10, atol=1e-12)
+        np.testing.assert_allclose(statistics['noise_means'][index], np.median(noise), rtol=1e-10, atol=1e-12)
+        np.testing.assert_allclose(statistics['noise_stds'][index], np.median(np.absolute(noise - np.mean(noise))), rtol=1e-10, atol=1e-12)
+        np.testing.assert_allclose(statistics['noise_distance_means'][index], np.mean(noise), rtol=1e-10, atol=1e-12)
+        np.testing.assert_allclose(statistics['min_centered_norms'][index], np.min(centered_norms), rtol=1e-10)
+        assert statistics['num_instances'][index] == segment_features.shape[0]
+
+
+def test_segmented_shell_statistics_of_list_match_array():
+    offsets = segment_offsets(SEGMENT_COUNTS)
+    array_statistics = segmented_shell_statistics(np.concatenate(SEGMENTS), offsets, GLOBAL_MEAN)
+    list_statistics = segmented_shell_statistics(SEGMENTS, offsets, GLOBAL_MEAN)
+    for key in array_statistics:
+        np.testing.assert_allclose(list_statistics[key], array_statistics[key])
+
+
+def test_segmented_shell_statistics_leave_features_unchanged():
+    features = np.concatenate(SEGMENTS)
+    segments = [segment_features.copy() for segment_features in SEGMENTS]
+    segmented_shell_statistics(features, segment_offsets(SEGMENT_COUNTS), GLOBAL_MEAN)
+    segmented_shell_statistics(segments, segment_offsets(SEGMENT_COUNTS), GLOBAL_MEAN)
+    np.testing.assert_array_equal(features, np.concatenate(SEGMENTS))
+    np.testing.assert_array_equal(np.concatenate(segments), features)
+
+
+def test_segmented_shell_statistics_leave_empty_segments_unfitted():
+    segments = [SEGMENTS[0], SEGMENTS[0][:0], SEGMENTS[2], SEGMENTS[0][:0]]
+    statistics = segmented_shell_statistics(segments, segment_offsets([5, 0, 12, 0]), GLOBAL_MEAN)
+    np.testing.assert_array_equal(statistics['num_instances'], [5, 0, 12, 0])
+    for index in [1, 3]:
+        assert np.all(np.isnan(statistics['shell_means'][index]))
+        assert np.isnan(statistics['noise_means'][index])
+        assert np.isnan(statistics['noise_stds'][index])
+    fitted_statistics = segmented_shell_statistics([SEGMENTS[0], SEGMENTS[2]], segment_offsets([5, 12]), GLOBAL_MEAN)
+    for key in ['noise_means', 'noise_stds', 'noise_distance_means', 'min_centered_norms']:
+        np.testing.assert_allclose(statistics[key][[0, 2]], fitted_statistics[key])
+    np.testing.assert_allclose(statistics['noise_distances'], fitted_statistics['noise_distances'])
+
+
+def test_parallel_segmented_shell_statistics_match_serial(tmp_path):
+    offsets = segment_offsets(SEGMENT_COUNTS)
+    statistics = segmented_shell_statistics(SEGMENTS, offsets, GLOBAL_MEAN)
+    shared_features = np.memmap(str(tmp_path / 'features.dat'), dtype=np.float64, mode='w+', shape=(offsets[-1], FEATURE_DIMENSION))
+    shared_features[:] = np.concatenate(SEGMENTS)
+    for features in [SEGMENTS, np.concatenate(SEGMENTS), shared_features]:
+        parallel_statistics = parallel_segmented_shell_statistics(features, offsets, GLOBAL_MEAN, 2, str(tmp_path))
+        for key in statistics:
+            np.testing.assert_allclose(parallel_statistics[key], statistics[key], rtol=1e-10)
+    # Temporary shared feature files are removed, a given memory-mapped file is kept
+    assert sorted(os.listdir(str(tmp_path))) == ['features.dat']
@@ -0,0 +1,450 @@
+import os
+import subprocess
+import sys
+
+import numpy as np
+import pytest
+
+from shell_v2 import ShellModel, ShellFamily
+from quantile_sketch import QuantileSketch
+from feature_store import FeatureStore
+
+FEATURE_DIMENSION = 16
+CLASS_NAMES = ['class_0', 'class_1', 'class_2', 'class_3']
+# Features of each class scattered around its own axis of the feature space
+CLASS_FEATURES = [(3 * np.eye(FEATURE_DIMENSION)[class_index] + np.random.RandomState(class_index).rand(num_features, FEATURE_DIMENSION)).astype(np.float32)
+                  for class_index, num_features in enumerate([15, 25, 10, 30])]
+QUERY_FEATURES = np.concatenate([(3 * np.eye(FEATURE_DIMENSION)[class_index] + np.random.RandomState(100 + class_index).rand(5, FEATURE_DIMENSION)).astype(np.float32)
+                                 for class_index in range(len(CLASS_NAMES))])
+QUERY_CLASS_NAMES = np.repeat(CLASS_NAMES, 5)
+
+
+def test_score_matches_shell_scores():
+    shell_family = ShellFamily()
+    for class_name, class_features in zip(CLASS_NAMES, CLASS_FEATURES):
+        shell_family.classifiers[class_name] = ShellModel()
+        shell_family.classifiers[class_name].raw_features = class_features
+        shell_family.mapping.append(class_name)
+    shell_family.global_mean = np.mean(np.concatenate(CLASS_FEATURES), axis=0, keepdims=True)
+    shell_family.update_shells(shell_family.global_mean)
+    for row in range(QUERY_FEATURES.shape[0]):
+        feat = QUERY_FEATURES[row : row + 1]
+        best_class_index, best_class_name, best_result, results = shell_family.score(feat, 0, with_update=False)
+        shell_scores = [shell_family.classifiers[class_name].score(feat, shell_family.global_mean)[0] for class_name in CLASS_NAMES]
+        np.testing.assert_allclose([results[class_name][0] for class_name in CLASS_NAMES], shell_scores, rtol=1e-4, atol=1e-4)
+        assert best_class_name == QUERY_CLASS_NAMES[row]
+        assert best_class_index == CLASS_NAMES.index(best_class_name)
+        np.testing.assert_allclose(best_result, [np.max(shell_scores)], rtol=1e-4, atol=1e-4)
+
+
+def test_score_skips_shells_without_features():
+    shell_family = ShellFamily()
+    for class_name, class_features in zip(CLASS_NAMES, CLASS_FEATURES):
+        shell_family.classifiers[class_name] = ShellModel()
+        shell_family.classifiers[class_name].raw_features = class_features
+        shell_family.mapping.append(class_name)
+    shell_family.global_mean = np.mean(np.concatenate(CLASS_FEATURES), axis=0, keepdims=True)
+    shell_family.update_shells(shell_family.global_mean)
+    shell_family.classifiers['empty'] = ShellModel()
+    shell_family.mapping.append('empty')
+    _, best_class_name, _, results = shell_family.score(QUERY_FEATURES[:1], 0, with_update=False)
+    assert best_class_name == 'class_0'
+    assert list(results) == CLASS_NAMES
+
+
+def test_score_with_update_refits_the_best_shell():
+    shell_family = ShellFamily()
+    for class_name, class_features in zip(CLASS_NAMES, CLASS_FEATURES):
+        shell_family.classifiers[class_name] = ShellModel()
+        shell_family.classifiers[class_name].raw_features = class_features
+        shell_family.mapping.append(class_name)
+    all_features = np.concatenate(CLASS_FEATURES)
+    shell_family.global_mean = np.mean(all_features, axis=0, keepdims=True)
+    shell_family.instances = all_features.shape[0]
+    shell_family.update_shells(shell_family.global_mean)
+    feat = QUERY_FEATURES[5:6]
+    _, best_class_name, _, _ = shell_family.score(feat, 0)
+    assert best_class_name == 'class_1'
+    assert shell_family.instances == all_features.shape[0] + 1
+    np.testing.assert_allclose(shell_family.global_mean, np.mean(np.concatenate([all_features, feat]), axis=0, keepdims=True), rtol=1e-5)
+    shell = shell_family.classifiers['class_1']
+    assert shell.raw_features.shape[0] == 26
+    reference_shell = ShellModel()
+    reference_shell.raw_features = np.concatenate([CLASS_FEATURES[1], feat])
+    reference_shell.fit(shell_family.global_mean)
+    np.testing.assert_allclose(shell.shell_mean, reference_shell.shell_mean, rtol=1e-5, atol=1e-6)
+    # Scores use the refitted shell straight away
+    _, _, _, results = shell_family.score(feat, 0, with_update=False)
+    np.testing.assert_allclose(results['class_1'], reference_shell.score(feat, shell_family.global_mean), rtol=1e-4, atol=1e-4)
+
+
+def test_score_batch_matches_score():
+    shell_family = ShellFamily()
+    for class_name, class_features in zip(CLASS_NAMES, CLASS_FEATURES):
+        shell_family.classifiers[class_name] = ShellModel()
+        shell_family.classifiers[class_name].raw_features = class_features
+        shell_family.mapping.append(class_name)
+    shell_family.global_mean = np.mean(np.concatenate(CLASS_FEATURES), axis=0, keepdims=True)
+    shell_family.update_shells(shell_family.global_mean)
+    global_mean = shell_family.global_mean.copy()
+    # A batch size that does not divide the number of features
+    scores, best_class_names = shell_family.score_batch(QUERY_FEATURES, batch_size=3)
+    assert scores.shape == (QUERY_FEATURES.shape[0], len(CLASS_NAMES))
+    np.testing.assert_array_equal(best_class_names, QUERY_CLASS_NAMES)
+    for row in range(QUERY_FEATURES.shape[0]):
+        _, best_class_name, best_result, results = shell_family.score(QUERY_FEATURES[row : row + 1], 0, with_update=False)
+        assert best_class_name == best_class_names[row]
+        # Packed scores are float32 distances through the GEMM expansion, hence the absolute tolerance
+        np.testing.assert_allclose(best_result, [np.max(scores[row])], rtol=1e-4, atol=1e-4)
+        np.testing.assert_allclose([results[class_name][0] for class_name in shell_family.packed_shell_names], scores[row], rtol=1e-4, atol=1e-4)
+    # Scoring a batch leaves the shell family unchanged
+    np.testing.assert_array_equal(shell_family.global_mean, global_mean)
+    assert shell_family.classifiers['class_0'].raw_features.shape[0] == CLASS_FEATURES[0].shape[0]
+
+
+def test_score_with_exhaustive_shell_index_matches_score():
+    shell_family = ShellFamily()
+    for class_name, class_features in zip(CLASS_NAMES, CLASS_FEATURES):
+        shell_family.classifiers[class_name] = ShellModel()
+        shell_family.classifiers[class_name].raw_features = class_features
+        shell_family.mapping.append(class_name)
+    shell_family.global_mean = np.mean(np.concatenate(CLASS_FEATURES), axis=0, keepdims=True)
+    shell_family.update_shells(shell_family.global_mean)
+    feat = QUERY_FEATURES[10:11]
+    _, best_class_name, best_result, results = shell_family.score(feat, 0, with_update=False)
+    shell_family.build_shell_index(num_lists=2)
+    _, indexed_best_class_name, indexed_best_result, indexed_results = shell_family.score(feat, 0, with_update=False, top_k=4, num_probes=2)
+    assert indexed_best_class_name == best_class_name
+    np.testing.assert_allclose(indexed_best_result, best_result, rtol=1e-6)
+    assert sorted(indexed_results) == sorted(results)
+    for class_name in results:
+        np.testing.assert_allclose(indexed_results[class_name], results[class_name], rtol=1e-6)
+    # The best shell is always among the top_k
+    _, indexed_best_class_name, _, indexed_results = shell_family.score(feat, 0, with_update=False, top_k=1, num_probes=2)
+    assert indexed_best_class_name == best_class_name
+    assert list(indexed_results) == [best_class_name]
+    # Clusters past num_probes are visited until top_k shells are found
+    shell_family.build_shell_index(num_lists=4)
+    _, indexed_best_class_name, _, indexed_results = shell_family.score(feat, 0, with_update=False, top_k=3, num_probes=1)
+    assert indexed_best_class_name == best_class_name
+    assert len(indexed_results) == 3
+    _, _, _, indexed_results = shell_family.score(feat, 0, with_update=False, top_k=100, num_probes=1)
+    assert sorted(indexed_results) == sorted(results)
+    with pytest.raises(ValueError):
+        shell_family.score(feat, 0, with_update=False, top_k=0)
+
+
+def test_append_raw_features_matches_concatenation():
+    shell = ShellModel()
+    for page_start in range(0, 30, 7):
+        shell.append_raw_features(CLASS_FEATURES[3][page_start : page_start + 7])
+    np.testing.assert_array_equal(shell.raw_features, CLASS_FEATURES[3])
+
+
+def test_online_update_tracks_exact_fit():
+    global_mean = np.mean(np.concatenate(CLASS_FEATURES), axis=0, keepdims=True)
+    shell = ShellModel()
+    shell.raw_features = CLASS_FEATURES[3][:10]
+    shell.fit(global_mean)
+    for row in range(10, 30):
+        shell.update(CLASS_FEATURES[3][row : row + 1], global_mean, online=True)
+    reference_shell = ShellModel()
+    reference_shell.raw_features = CLASS_FEATURES[3]
+    reference_shell.fit(global_mean)
+    assert shell.num_instances == 30
+    np.testing.assert_array_equal(shell.raw_features, CLASS_FEATURES[3])
+    # With a fixed global mean the running shell mean is exact while the medians are approximated
+    np.testing.assert_allclose(shell.shell_mean, reference_shell.shell_mean, rtol=1e-5, atol=1e-6)
+    np.testing.assert_allclose(shell.noise_mean, reference_shell.noise_mean, rtol=0.2)
+
+
+def test_online_update_refits_every_refit_interval():
+    global_mean = np.mean(np.concatenate(CLASS_FEATURES), axis=0, keepdims=True)
+    shell = ShellModel()
+    shell.raw_features = CLASS_FEATURES[3][:20]
+    shell.fit(global_mean)
+    for row in range(20, 25):
+        shell.update(CLASS_FEATURES[3][row : row + 1], global_mean, online=True, refit_interval=5)
+    reference_shell = ShellModel()
+    reference_shell.raw_features = CLASS_FEATURES[3][:25]
+    reference_shell.fit(global_mean)
+    assert shell.online_updates_since_refit == 0
+    np.testing.assert_allclose(shell.noise_mean, reference_shell.noise_mean, rtol=1e-6)
+    np.testing.assert_allclose(shell.noise_std, reference_shell.noise_std, rtol=1e-6)
+
+
+def test_legacy_pickled_shell_is_upgraded():
+    # Shells pickled before the raw features buffer only had these attributes
+    shell = ShellModel.__new__(ShellModel)
+    shell.__setstate__({'raw_features': CLASS_FEATURES[0], 'shell_mean': None, 'num_instances': 15})
+    np.testing.assert_array_equal(shell.raw_features, CLASS_FEATURES[0])
+    assert shell.feature_count == 15
+    assert shell.feature_store is None and shell.noise_sketch is None
+    shell.fit(np.mean(CLASS_FEATURES[0], axis=0, keepdims=True))
+    assert shell.shell_mean.shape == (1, FEATURE_DIMENSION)
+
+
+def test_online_update_reads_medians_from_noise_sketch():
+    global_mean = np.mean(np.concatenate(CLASS_FEATURES), axis=0, keepdims=True)
+    shell = ShellModel()
+    shell.noise_sketch = QuantileSketch()
+    shell.raw_features = CLASS_FEATURES[3][:20]
+    shell.fit(global_mean)
+    assert len(shell.noise_sketch) == 20
+    shell.update(CLASS_FEATURES[3][20:], global_mean, online=True)
+    assert len(shell.noise_sketch) == 30
+    assert shell.noise_mean == shell.noise_sketch.quantile(0.5)
+    assert shell.noise_std == shell.noise_sketch.median_absolute_deviation(shell.noise_sketch.mean())
+
+
+def test_merge_noise_sketch():
+    global_mean = np.mean(np.concatenate(CLASS_FEATURES), axis=0, keepdims=True)
+    shell = ShellModel()
+    shell.raw_features = CLASS_FEATURES[3]
+    shell.fit(global_mean)
+    other_shell = ShellModel()
+    other_shell.noise_sketch = QuantileSketch()
+    other_shell.raw_features = CLASS_FEATURES[3]
+    other_shell.fit(global_mean)
+    shell.merge_noise_sketch(other_shell.noise_sketch)
+    np.testing.assert_array_equal(shell.noise_sketch.counts, other_shell.noise_sketch.counts)
+    assert shell.noise_mean == other_shell.noise_sketch.quantile(0.5)
+
+
+def test_add_sketched_features():
+    shell_family = ShellFamily()
+    shell_family.use_noise_sketch = True
+    for class_name, class_features in zip(CLASS_NAMES, CLASS_FEATURES):
+        shell_family.classifiers[class_name] = ShellModel()
+        shell_family.classifiers[class_name].raw_features = class_features[:10]
+        shell_family.mapping.append(class_name)
+    shell_family.global_mean = np.mean(np.concatenate(CLASS_FEATURES), axis=0, keepdims=True)
+    shell_family.update_shells(shell_family.global_mean)
+    shell = shell_family.classifiers['class_3']
+    assert len(shell.noise_sketch) == 10
+    assert shell_family.add_sketched_features('class_3', CLASS_FEATURES[3][10:])
+    assert shell.num_instances == 30
+    assert shell.raw_features_count == 30
+    assert len(shell.noise_sketch) == 30
+    assert shell.noise_mean == shell.noise_sketch.quantile(0.5)
+    # Sketched shells are not refit for their new features
+    assert shell_family.update_shells(shell_family.global_mean, shells_to_refit=['class_1'], sketched_shells=['class_3']) == ['class_0', 'class_1', 'class_2']
+
+
+def test_add_sketched_features_without_sketch_only_appends():
+    shell = ShellModel()
+    shell_family = ShellFamily()
+    shell_family.classifiers['class_3'] = shell
+    shell.raw_features = CLASS_FEATURES[3][:10]
+    shell_family.global_mean = np.mean(CLASS_FEATURES[3], axis=0, keepdims=True)
+    shell_family.update_shells(shell_family.global_mean)
+    noise_mean = shell.noise_mean
+    assert not shell_family.add_sketched_features('class_3', CLASS_FEATURES[3][10:])
+    assert shell.raw_features_count == 30
+    assert shell.noise_mean == noise_mean
+
+
+def test_update_global_mean_matches_mean():
+    shell_family = ShellFamily()
+    for class_features in CLASS_FEATURES:
+        shell_family.update_global_mean(class_features)
+    all_features = np.concatenate(CLASS_FEATURES)
+    assert shell_family.instances == all_features.shape[0]
+    np.testing.assert_allclose(shell_family.global_mean, np.mean(all_features, axis=0, keepdims=True), rtol=1e-6)
+    # Removing the features of a class with a negative count
+    shell_family.update_global_mean(-np.sum(CLASS_FEATURES[0], axis=0, keepdims=True, dtype=np.float64), -CLASS_FEATURES[0].shape[0])
+    assert shell_family.instances == all_features.shape[0] - CLASS_FEATURES[0].shape[0]
+    np.testing.assert_allclose(shell_family.global_mean, np.mean(np.concatenate(CLASS_FEATURES[1:]), axis=0, keepdims=True), rtol=1e-6)
+
+
+def test_global_mean_setter_resynchronises_running_sum():
+    shell_family = ShellFamily()
+    shell_family.update_global_mean(np.ones((2, 3), dtype=np.float32))
+    shell_family.global_mean = np.full((1, 3), 2.0, dtype=np.float32)
+    shell_family.instances = 4
+    shell_family.update_global_mean(np.full((4, 3), 4.0, dtype=np.float32))
+    np.testing.assert_allclose(shell_family.global_mean, [[3.0, 3.0, 3.0]])
+    assert shell_family.instances == 8
+
+
+def test_score_error_bound_holds_after_global_mean_drift():
+    global_mean = np.mean(np.concatenate(CLASS_FEATURES), axis=0, keepdims=True)
+    drifted_global_mean = global_mean + 0.002 * np.random.RandomState(1).randn(1, FEATURE_DIMENSION).astype(np.float32)
+    shell = ShellModel()
+    shell.raw_features = CLASS_FEATURES[1]
+    shell.fit(global_mean)
+    refitted_shell = ShellModel()
+    refitted_shell.raw_features = CLASS_FEATURES[1]
+    refitted_shell.fit(drifted_global_mean)
+    bound = shell.score_error_bound(drifted_global_mean, score_margin=3.0)
+    assert 0 < bound < np.inf
+    assert shell.score_error_bound(shell.fit_global_mean) == 0
+    scores = shell.score(QUERY_FEATURES, drifted_global_mean)
+    refitted_scores = refitted_shell.score(QUERY_FEATURES, drifted_global_mean)
+    within_margin = np.absolute(refitted_scores) <= 3.0
+    assert np.any(within_margin)
+    assert np.all(np.absolute(scores - refitted_scores)[within_margin] <= bound)
+
+
+def test_update_shells_refits_drifted_shells_only():
+    shell_family = ShellFamily()
+    for class_name, class_features in zip(CLASS_NAMES, CLASS_FEATURES):
+        shell_family.classifiers[class_name] = ShellModel()
+        shell_family.classifiers[class_name].raw_features = class_features
+        shell_family.mapping.append(class_name)
+    shell_family.global_mean = np.mean(np.concatenate(CLASS_FEATURES), axis=0, keepdims=True)
+    assert shell_family.update_shells(shell_family.global_mean) == CLASS_NAMES
+    shell_family.refit_tolerance = 0.5
+    shell_family.full_refit_interval = 3
+    # A tiny drift stays within the tolerance, so only the shells asked for are refit
+    assert shell_family.update_shells(shell_family.global_mean + 1e-6, shells_to_refit=['class_2']) == ['class_2']
+    assert shell_family.update_shells(shell_family.global_mean + 1e-6) == []
+    # Every full_refit_interval calls every shell is refit
+    assert shell_family.update_shells(shell_family.global_mean + 1e-6) == CLASS_NAMES
+    # A large drift refits every shell
+    assert shell_family.update_shells(shell_family.global_mean + 1.0) == CLASS_NAMES
+
+
+def test_refit_shells_matches_shell_fit():
+    shell_family = ShellFamily()
+    for class_name, class_features in zip(CLASS_NAMES, CLASS_FEATURES):
+        shell_family.classifiers[class_name] = ShellModel()
+        shell_family.classifiers[class_name].raw_features = class_features
+        shell_family.mapping.append(class_name)
+    shell_family.global_mean = np.mean(np.concatenate(CLASS_FEATURES), axis=0, keepdims=True)
+    shell_family.refit_shells(CLASS_NAMES, shell_family.global_mean)
+    for class_name, class_features in zip(CLASS_NAMES, CLASS_FEATURES):
+        shell = shell_family.classifiers[class_name]
+        reference_shell = ShellModel()
+        reference_shell.raw_features = class_features
+        reference_shell.fit(shell_family.global_mean)
+        np.testing.assert_allclose(shell.shell_mean, reference_shell.shell_mean, rtol=1e-5, atol=1e-6)
+        np.testing.assert_allclose(shell.noise_mean, reference_shell.noise_mean, rtol=1e-5)
+        np.testing.assert_allclose(shell.noise_std, reference_shell.noise_std, rtol=1e-5)
+        np.testing.assert_allclose(shell.noise_distance_mean, reference_shell.noise_distance_mean, rtol=1e-5)
+        np.testing.assert_allclose(shell.min_centered_norm, reference_shell.min_centered_norm, rtol=1e-5)
+        assert shell.num_instances == reference_shell.num_instances
+
+
+def test_update_shells_leaves_empty_shells_unfitted():
+    shell_family = ShellFamily()
+    for class_name, class_features in zip(CLASS_NAMES, [CLASS_FEATURES[0], CLASS_FEATURES[1][:0], CLASS_FEATURES[2]]):
+        shell_family.classifiers[class_name] = ShellModel()
+        shell_family.classifiers[class_name].raw_features = class_features
+        shell_family.mapping.append(class_name)
+    shell_family.global_mean = np.mean(np.concatenate(CLASS_FEATURES[::2]), axis=0, keepdims=True)
+    assert shell_family.update_shells(shell_family.global_mean) == ['class_0', 'class_2']
+    assert shell_family.classifiers['class_1'].shell_mean is None
+    scores, best_class_names = shell_family.score_batch(QUERY_FEATURES[10:15])
+    assert scores.shape == (5, 2)
+    assert list(best_class_names) == ['class_2'] * 5
+
+
+def test_parallel_refit_shells_matches_serial():
+    shell_family = ShellFamily()
+    parallel_shell_family = ShellFamily()
+    parallel_shell_family.refit_workers = 2
+    for class_name, class_features in zip(CLASS_NAMES, CLASS_FEATURES):
+        shell_family.classifiers[class_name] = ShellModel()
+        shell_family.classifiers[class_name].raw_features = class_features
+        parallel_shell_family.classifiers[class_name] = ShellModel()
+        parallel_shell_family.classifiers[class_name].raw_features = class_features
+    global_mean = np.mean(np.concatenate(CLASS_FEATURES), axis=0, keepdims=True)
+    shell_family.refit_shells(CLASS_NAMES, global_mean)
+    parallel_shell_family.refit_shells(CLASS_NAMES, global_mean)
+    for class_name in CLASS_NAMES:
+        shell = shell_family.classifiers[class_name]
+        parallel_shell = parallel_shell_family.classifiers[class_name]
+        np.testing.assert_allclose(parallel_shell.shell_mean, shell.shell_mean, rtol=1e-6)
+        np.testing.assert_allclose(parallel_shell.noise_mean, shell.noise_mean, rtol=1e-6)
+        np.testing.assert_allclose(parallel_shell.noise_std, shell.noise_std, rtol=1e-6)
+
+
+def test_importing_shell_v2_does_not_import_tensorflow():
+    # Spawned refit workers import the modules of the application, which must not load TensorFlow
+    src_directory = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'src')
+    subprocess.run([sys.executable, '-c', "import sys; import shell_v2; assert 'tensorflow' not in sys.modules"], cwd=src_directory, check=True)
+
+
+def test_paged_append_to_feature_store_matches_reload(tmp_path):
+    global_mean = np.mean(np.concatenate(CLASS_FEATURES), axis=0, keepdims=True)
+    shell = ShellModel()
+    shell.shell_id = 'class 3'
+    shell.attach_feature_store(FeatureStore(str(tmp_path), 'family'))
+    for page_start in range(0, 30, 7):
+        shell.append_raw_features(CLASS_FEATURES[3][page_start : page_start + 7])
+    np.testing.assert_array_equal(shell.raw_features, CLASS_FEATURES[3])
+    # A shell attached to the same store later reloads the stored features
+    reloaded_shell = ShellModel()
+    reloaded_shell.shell_id = 'class 3'
+    reloaded_shell.attach_feature_store(FeatureStore(str(tmp_path), 'family'))
+    assert reloaded_shell.raw_features_count == reloaded_shell.feature_count == 30
+    np.testing.assert_allclose(reloaded_shell.feature_sum, shell.feature_sum, rtol=1e-6)
+    shell.fit(global_mean)
+    reloaded_shell.fit(global_mean)
+    np.testing.assert_allclose(reloaded_shell.shell_mean, shell.shell_mean)
+    np.testing.assert_allclose(reloaded_shell.noise_mean, shell.noise_mean)
+    np.testing.assert_allclose(reloaded_shell.noise_std, shell.noise_std)
+
+
+def test_attach_feature_store_moves_features_to_the_store(tmp_path):
+    shell_family = ShellFamily()
+    for class_name, class_features in zip(CLASS_NAMES, CLASS_FEATURES):
+        shell_family.classifiers[class_name] = ShellModel()
+        shell_family.classifiers[class_name].shell_id = class_name
+        shell_family.classifiers[class_name].raw_features = class_features
+    feature_store = FeatureStore(str(tmp_path), 'family')
+    shell_family.attach_feature_store(feature_store)
+    assert sorted(feature_store.shell_ids()) == CLASS_NAMES
+    for class_name, class_features in zip(CLASS_NAMES, CLASS_FEATURES):
+        assert shell_family.classifiers[class_name].raw_features_buffer is None
+        np.testing.assert_array_equal(shell_family.classifiers[class_name].raw_features, class_features)
+
+
+def test_paged_append_matches_reload():
+    global_mean = np.mean(np.concatenate(CLASS_FEATURES), axis=0, keepdims=True)
+    shell = ShellModel()
+    for page_start in range(0, 30, 7):
+        shell.append_raw_features(CLASS_FEATURES[3][page_start : page_start + 7])
+    reloaded_shell = ShellModel()
+    reloaded_shell.raw_features = CLASS_FEATURES[3]
+    assert shell.feature_count == reloaded_shell.feature_count == 30
+    np.testing.assert_allclose(shell.feature_sum, reloaded_shell.feature_sum)
+    shell.fit(global_mean)
+    reloaded_shell.fit(global_mean)
+    np.testing.assert_allclose(shell.shell_mean, reloaded_shell.shell_mean)
+    np.testing.assert_allclose(shell.noise_mean, reloaded_shell.noise_mean)
+    assert shell.sampling_error is None
+
+
+@pytest.mark.parametrize('use_feature_store', [False, True])
+def test_reservoir_keeps_exact_sums(tmp_path, use_feature_store):
+    features = np.random.RandomState(0).rand(500, FEATURE_DIMENSION).astype(np.float32)
+    shell = ShellModel()
+    shell.shell_id = 'shell'
+    shell.raw_features_capacity = 50
+    shell.reservoir_random_state = np.random.RandomState(0)
+    if use_feature_store:
+        shell.attach_feature_store(FeatureStore(str(tmp_path), 'family'))
+    for page_start in range(0, 500, 64):
+        shell.append_raw_features(features[page_start : page_start + 64])
+    assert shell.raw_features_count == 50
+    assert shell.feature_count == 500
+    np.testing.assert_allclose(shell.feature_sum, np.sum(features, axis=0, keepdims=True, dtype=np.float64), rtol=1e-10)
+    # Every kept feature was seen once, and not only the first ones were kept
+    kept_rows = [int(np.flatnonzero(np.all(features == kept_feature, axis=1))[0]) for kept_feature in shell.raw_features]
+    assert len(set(kept_rows)) == 50
+    assert max(kept_rows) >= 50
+    shell.fit(np.mean(features, axis=0, keepdims=True))
+    assert shell.num_instances == 500
+    assert shell.sampling_error['num_sampled'] == 50
+
+
+def test_reservoir_setter_samples_features():
+    features = np.random.RandomState(0).rand(200, FEATURE_DIMENSION).astype(np.float32)
+    shell = ShellModel()
+    shell.raw_features_capacity = 30
+    shell.raw_features = features
+    assert shell.raw_features_count == 30
+    assert shell.feature_count == 200
+    np.testing.assert_allclose(shell.feature_sum, np.sum(features, axis=0, keepdims=True, dtype=np.float64))
@@ -0,0 +1,88 @@
+import numpy as np
+import pytest
+from PIL import Image
+
+from utils import load_image, decode_equivalence_report, get_decode_executor, ImageBatchLoader, ImageGenerator
+
+IMAGE_SIZES = [(40, 30), (24, 24), (50, 20), (33, 61), (16, 48)]
+# Smooth 1600 x 1200 gradient image, large enough for reduced decode to kick in at 64 x 64
+GRID_X, GRID_Y = np.meshgrid(np.linspace(0, 1, 1600), np.linspace(0, 1, 1200))
+LARGE_IMAGE = np.stack([255 * GRID_X, 255 * GRID_Y, 127.5 * (1 + np.sin(2 * np.pi * (GRID_X + GRID_Y)))], axis=-1).astype(np.uint8)
+SMALL_IMAGE = LARGE_IMAGE[::12, ::16]
+
+
+def test_load_image_shape_and_dtype(tmp_path):
+    image_path = str(tmp_path / 'image.png')
+    Image.fromarray(np.random.RandomState(0).randint(0, 256, (80, 120, 4)).astype(np.uint8)).save(image_path)
+    image = load_image(image_path, (64, 48))
+    assert image.shape == (48, 64, 3)
+    assert image.dtype == np.uint8
+
+
+def test_reduced_decode_of_small_images_is_identical(tmp_path):
+    image_paths = [str(tmp_path / 'image.jpg'), str(tmp_path / 'image.png')]
+    Image.fromarray(SMALL_IMAGE).save(image_paths[0], quality=90)
+    Image.fromarray(SMALL_IMAGE).save(image_paths[1])
+    report = decode_equivalence_report(image_paths, (64, 64))
+    assert report['num_images'] == 2
+    assert report['identical_image_fraction'] == 1.0
+    assert report['max_absolute_pixel_difference'] == 0.0
+    assert report['min_psnr'] == pytest.approx(100.0)
+
+
+def test_reduced_decode_of_large_images_is_close(tmp_path):
+    image_paths = [str(tmp_path / 'image.jpg'), str(tmp_path / 'image.png')]
+    Image.fromarray(LARGE_IMAGE).save(image_paths[0], quality=90)
+    Image.fromarray(LARGE_IMAGE).save(image_paths[1])
+    # Average pooled pixels stand in for backbone features
+    report = decode_equivalence_report(image_paths, (64, 64), extract_features=lambda images: images.reshape((len(images), 8, 8, 8, 8, 3)).mean(axis=(2, 4)).reshape((len(images), -1)))
+    assert report['mean_absolute_pixel_difference'] < 2.0
+    assert report['min_psnr'] > 35.0
+    assert report['min_feature_cosine_similarity'] > 0.999
+
+
+def test_image_batch_loader_matches_serial_decode(tmp_path):
+    image_paths = []
+    for image_index, (width, height) in enumerate(IMAGE_SIZES):
+        image_paths.append(str(tmp_path / 'image_{}.png'.format(image_index)))
+        Image.fromarray(np.random.RandomState(image_index).randint(0, 256, (height, width, 3)).astype(np.uint8)).save(image_paths[-1])
+    expected_images = np.array([load_image(image_path, (32, 32)) for image_path in image_paths])
+    for decode_workers, prefetch_batches in [(1, 0), (2, 1), (3, 2)]:
+        image_batch_loader = ImageBatchLoader(image_paths, 2, (32, 32), decode_workers=decode_workers, prefetch_batches=prefetch_batches)
+        batch_ranges = []
+        for _ in range(3):
+            batch_images, batch_start, batch_end = image_batch_loader.next_batch()
+            np.testing.assert_array_equal(batch_images, expected_images[batch_start : batch_end])
+            batch_ranges.append((batch_start, batch_end))
+        assert batch_ranges == [(0, 2), (2, 4), (4, 5)]
+        with pytest.raises(StopIteration):
+            image_batch_loader.next_batch()
+        image_batch_loader.close()
+
+
+def test_process_decode_pool_is_shared_between_loaders(tmp_path):
+    image_paths = []
+    for image_index, (width, height) in enumerate(IMAGE_SIZES):
+        image_paths.append(str(tmp_path / 'image_{}.png'.format(image_index)))
+        Image.fromarray(np.random.RandomState(image_index).randint(0, 256, (height, width, 3)).astype(np.uint8)).save(image_paths[-1])
+    expected_images = np.array([load_image(image_path, (32, 32)) for image_path in image_paths])
+    for _ in range(2):
+        image_batch_loader = ImageBatchLoader(image_paths, 5, (32, 32), decode_workers=2, decode_pool='process')
+        batch_images, _, _ = image_batch_loader.next_batch()
+        np.testing.assert_array_equal(batch_images, expected_images)
+        assert image_batch_loader.executor is get_decode_executor(2)
+        image_batch_loader.close()
+
+
+def test_image_generator_yields_uint8_images(tmp_path):
+    image_paths = []
+    for image_index, (width, height) in enumerate(IMAGE_SIZES):
+        image_paths.append(str(tmp_path / 'image_{}.png'.format(image_index)))
+        Image.fromarray(np.random.RandomState(image_index).randint(0, 256, (height, width, 3)).astype(np.uint8)).save(image_paths[-1])
+    image_generator = ImageGenerator(image_paths, np.array([0, 0, 1, 1, 1]), 2, (32, 32), prefetch_batches=0)
+    # Backbone preprocessing is left to the feature extractor model
+    batch_images, batch_filepaths, batch_classes = next(image_generator)
+    assert batch_images.dtype == np.uint8
+    np.testing.assert_array_equal(batch_images, [load_image(image_path, (32, 32)) for image_path in image_paths[:2]])
+    assert list(batch_filepaths) == image_paths[:2]
+    assert list(batch_classes) == [0, 0]